@@ -4,10 +4,11 @@ from flask_migrate import Migrate
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
+from app.database import RoutingSession, init_read_engine
 
 load_dotenv()
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 migrate = Migrate()
 
 def create_app(config_name='development'):
@@ -21,6 +22,7 @@ def create_app(config_name='development'):
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     app.config['DEBUG'] = os.environ.get('FLASK_ENV') == 'development'
     app.config['ENV'] = os.environ.get('FLASK_ENV', 'production')
+    app.config['API_READ_ENGINE'] = os.environ.get('API_READ_ENGINE', '1') == '1'
     
     # SQLite optimizations for concurrent access
     app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
@@ -46,8 +48,18 @@ def create_app(config_name='development'):
     from app.routes import register_routes
     register_routes(app)
     
+    # Trip inserts and deletes update the statistics rollups
+    from app.utils import rollups  # noqa: F401
+    
     # Create tables
     with app.app_context():
         db.create_all()
     
+    # gzip/br compression of API responses
+    from app.utils.encoding import init_compression
+    init_compression(app)
+    
+    # GET requests read through their own read-only connections
+    init_read_engine(app, db)
+    
     return app
\ No newline at end of file
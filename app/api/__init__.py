@@ -2,7 +2,7 @@ from flask import Blueprint
 
 api_bp = Blueprint('api', __name__)
 
-from . import stations, bikes, trips, statistics, recovery, queue_status
+from . import stations, bikes, trips, statistics, recovery, queue_status, live
 
 # Register queue status routes
 from .queue_status import queue_bp
@@ -1,9 +1,11 @@
 from flask import jsonify, request
 from app.api import api_bp
+from app.utils.response_cache import response_cache
+from app.utils.encoding import list_response
 from app.models import Bike, Trip, MalfunctionLog, BikeSnapshot, Station
 from app import db
 from datetime import datetime, timedelta
-from sqlalchemy import func, desc
+from sqlalchemy import func, desc, and_
 from sqlalchemy.orm import joinedload
 
 
@@ -37,13 +39,13 @@ def get_bikes():
     # Paginate
     paginated = query.paginate(page=page, per_page=per_page, error_out=False)
     
-    return jsonify({
-        'bikes': [bike.to_dict() for bike in paginated.items],
-        'total': paginated.total,
-        'page': page,
-        'pages': paginated.pages,
-        'per_page': per_page
-    })
+    return list_response(
+        'bikes', [bike.to_dict() for bike in paginated.items],
+        total=paginated.total,
+        page=page,
+        pages=paginated.pages,
+        per_page=per_page
+    )
 
 
 @api_bp.route('/bikes/<bike_name>', methods=['GET'])
@@ -163,36 +165,46 @@ def get_bike_malfunctions(bike_name):
 
 
 @api_bp.route('/bikes/malfunctioning', methods=['GET'])
+@response_cache.cached
 def get_malfunctioning_bikes():
-    """Get bikes with active malfunctions"""
+    """Get bikes with active malfunctions - all of them unless page or per_page is given"""
     malfunction_type = request.args.get('type')
     min_severity = request.args.get('min_severity', 1, type=int)
+    paginated = 'page' in request.args or 'per_page' in request.args
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = max(request.args.get('per_page', 100, type=int), 1)
     
-    query = db.session.query(Bike).join(MalfunctionLog).filter(
-        MalfunctionLog.is_active == True,
-        MalfunctionLog.severity >= min_severity
-    )
-    
+    criteria = [MalfunctionLog.is_active == True, MalfunctionLog.severity >= min_severity]
     if malfunction_type:
-        query = query.filter(MalfunctionLog.malfunction_type == malfunction_type)
-    
-    bikes = query.distinct().all()
+        criteria.append(MalfunctionLog.malfunction_type == malfunction_type)
+    
+    # Sorted and paginated in SQL; the IN subquery starts from the active logs index, no DISTINCT
+    flagged = db.session.query(MalfunctionLog.bike_id).filter(*criteria)
+    query = Bike.query.filter(Bike.id.in_(flagged)).order_by(desc(Bike.malfunction_score), Bike.id)
+    total = query.order_by(None).count()
+    if not paginated:
+        page, per_page = 1, max(total, 1)
+    page_ids = query.with_entities(Bike.id).limit(per_page).offset((page - 1) * per_page).subquery()
+    
+    # The page of bikes with all their active malfunctions, in one query
+    rows = db.session.query(Bike, MalfunctionLog)\
+        .join(page_ids, page_ids.c.id == Bike.id)\
+        .join(MalfunctionLog, and_(MalfunctionLog.bike_id == Bike.id, MalfunctionLog.is_active == True))\
+        .order_by(desc(Bike.malfunction_score), Bike.id, desc(MalfunctionLog.detected_at))\
+        .all()
     
     results = []
-    for bike in bikes:
-        bike_dict = bike.to_dict()
-        # Add active malfunctions
-        active_malfunctions = MalfunctionLog.query.filter_by(
-            bike_id=bike.id,
-            is_active=True
-        ).all()
-        bike_dict['malfunctions'] = [m.to_dict() for m in active_malfunctions]
-        results.append(bike_dict)
-    
-    # Sort by malfunction score
-    results.sort(key=lambda x: x['malfunction_score'], reverse=True)
+    for bike, malfunction in rows:
+        if not results or results[-1]['id'] != bike.id:
+            bike_dict = bike.to_dict()
+            bike_dict['malfunctions'] = []
+            results.append(bike_dict)
+        results[-1]['malfunctions'].append(malfunction.to_dict())
     
     return jsonify({
         'bikes': results,
-        'total': len(results)
+        'total': total,
+        'page': page,
+        'pages': (total + per_page - 1) // per_page,
+        'per_page': per_page
     })
\ No newline at end of file
@@ -0,0 +1,17 @@
+from flask import Response, jsonify, current_app
+from app.api import api_bp
+from app.utils.live_stream import live_broadcaster
+
+
+@api_bp.route('/live', methods=['GET'])
+def live_stream():
+    """Server-Sent Events: station deltas, new trips and overview counters after each scrape"""
+    client = live_broadcaster.subscribe(current_app._get_current_object())
+    if client is None:
+        # Over the per-process limit - the map falls back to polling
+        return jsonify({'error': 'Too many live clients'}), 503
+    
+    response = Response(live_broadcaster.stream(client), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Don't let nginx buffer the stream
+    return response
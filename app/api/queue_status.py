@@ -1,5 +1,9 @@
 from flask import Blueprint, jsonify
 from app.queue_manager import get_queue_status
+from app.utils.write_behind import write_behind
+from app.utils.leader import leader
+from app.utils.response_cache import response_cache
+from app.utils.live_stream import live_broadcaster
 
 queue_bp = Blueprint('queue', __name__)
 
@@ -7,4 +11,8 @@ queue_bp = Blueprint('queue', __name__)
 def queue_status():
     """Get current queue status for monitoring"""
     status = get_queue_status()
+    status['commits'] = write_behind.stats()
+    status['leader'] = leader.status()
+    status['response_cache'] = response_cache.stats()
+    status['live'] = live_broadcaster.stats()
     return jsonify(status)
\ No newline at end of file
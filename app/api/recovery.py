@@ -1,7 +1,8 @@
 from flask import jsonify, request, current_app, abort
 from app.api import api_bp
 from app.utils.data_recovery import DataRecovery
-from app import db
+from app.utils.recovery_jobs import RECOVERY_ACTIONS, request_recovery_job, get_recovery_job, list_recovery_jobs
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from datetime import datetime
 import logging
 
@@ -29,55 +30,52 @@ def get_recovery_status():
 
 @api_bp.route('/recovery/run', methods=['POST'])
 def run_manual_recovery():
-    """Manually trigger data recovery"""
+    """Submit a recovery action as a background job on the database queue"""
     check_dev_mode()
     try:
         action = request.json.get('action', 'full') if request.json else 'full'
         
-        recovery = DataRecovery()
-        
-        if action == 'full':
-            recovery.run_full_recovery()
-            message = "Full data recovery completed"
-        elif action == 'cleanup_trips':
-            recovery.cleanup_incomplete_trips()
-            db.session.commit()
-            message = "Trip cleanup completed"
-        elif action == 'fix_transit':
-            recovery.fix_stuck_in_transit_bikes()
-            db.session.commit()
-            message = "Fixed bikes stuck in transit"
-        elif action == 'reset_status':
-            recovery.reset_bike_status_from_snapshots()
-            message = "Reset bike statuses from snapshots"
-        elif action == 'cleanup_duplicates':
-            recovery.cleanup_duplicate_trips()
-            message = "Removed duplicate trips"
-        elif action == 'cleanup_old':
-            recovery.cleanup_old_station_states()
-            recovery.cleanup_old_snapshots()
-            db.session.commit()
-            message = "Cleaned up old data"
-        else:
+        if action not in RECOVERY_ACTIONS:
             return jsonify({'error': 'Invalid action'}), 400
         
-        logger.info(f"Manual recovery action '{action}' completed")
-        
-        # Get updated status
-        report = recovery.get_recovery_report()
+        # Written by the database worker in the leader, recorded as pending for it elsewhere
+        job = request_recovery_job(action)
+        logger.info(f"Manual recovery action '{action}' submitted as job {job['job_id']}")
         
         return jsonify({
             'success': True,
-            'message': message,
+            'job_id': job['job_id'],
+            'message': f"Recovery action '{action}' queued",
             'timestamp': datetime.utcnow().isoformat(),
-            'status': report
-        })
+            'job': job
+        }), 202
         
+    except FutureTimeoutError:
+        logger.warning(f"Timed out submitting recovery action '{action}'")
+        return jsonify({'error': 'Database queue is busy, try again shortly'}), 503
     except Exception as e:
         logger.error(f"Error in manual recovery: {e}")
         return jsonify({'error': f'Recovery failed: {str(e)}'}), 500
 
 
+@api_bp.route('/recovery/jobs/<job_id>', methods=['GET'])
+def get_recovery_job_status(job_id):
+    """Progress of a recovery job: current step, rows processed and ETA"""
+    check_dev_mode()
+    job = get_recovery_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+
+@api_bp.route('/recovery/jobs', methods=['GET'])
+def get_recovery_jobs():
+    """Most recent recovery jobs"""
+    check_dev_mode()
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    return jsonify({'jobs': [job.to_dict() for job in list_recovery_jobs(limit)]})
+
+
 @api_bp.route('/recovery/actions', methods=['GET'])
 def get_available_actions():
     """Get list of available recovery actions"""
@@ -112,6 +110,11 @@ def get_available_actions():
             'name': 'Clean Old Data',
             'description': 'Remove old snapshots and station states',
             'risk': 'low'
+        },
+        'rebuild_rollups': {
+            'name': 'Rebuild Statistics Rollups',
+            'description': 'Recompute hourly trip, station and route aggregates from all trips',
+            'risk': 'low'
         }
     }
     
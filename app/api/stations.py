@@ -1,6 +1,15 @@
 from flask import jsonify, request
 from app.api import api_bp
-from app.models import Station, Bike, BikeSnapshot, Trip
+from app.utils.response_cache import response_cache
+from app.utils.encoding import list_response
+from app.models import Station, Bike, Trip
+from app.utils.partitions import bike_snapshots, tolerate_dropped_partitions
+from app.utils.time_buckets import BUCKET_MINUTES, bucket_seconds, time_bucket, bucket_start
+from app.utils.rollups import trip_rollups
+from app.utils.scrape_generation import scrape_generation
+from app.utils.station_changes import changes_since
+from app.utils.spatial_index import station_index
+from app.utils.station_clusters import station_clusters
 from app import db
 from datetime import datetime, timedelta
 from sqlalchemy import func
@@ -8,25 +17,82 @@ from app.utils.timezone import calculate_duration_since, format_duration, format
 
 
 @api_bp.route('/stations', methods=['GET'])
+@response_cache.cached
 def get_stations():
-    """Get all stations with current status"""
+    """Get all stations with current status, or only those changed since a generation"""
+    generation = scrape_generation.current()
+    since = request.args.get('since', type=int)
+    
+    if since is not None:
+        changes = changes_since(since, generation)
+        if changes is not None:
+            return list_response(
+                'stations', [station.to_dict() for station in changes['updated']],
+                removed=changes['removed'],
+                total=len(changes['updated']),
+                generation=generation,
+                delta=True
+            )
+        # Too far behind (or ahead) for the change log - send everything
+    
     stations = Station.query.all()
-    return jsonify({
-        'stations': [station.to_dict() for station in stations],
-        'total': len(stations)
-    })
+    return list_response(
+        'stations', [station.to_dict() for station in stations],
+        total=len(stations),
+        generation=generation,
+        delta=False
+    )
+
+
+@api_bp.route('/stations/clusters', methods=['GET'])
+def get_station_clusters():
+    """Station aggregates for the map viewport at a zoom level"""
+    zoom = request.args.get('zoom', 12, type=int)
+    bbox = request.args.get('bbox')  # south,west,north,east
+    
+    bounds = None
+    if bbox:
+        try:
+            bounds = tuple(float(value) for value in bbox.split(','))
+        except ValueError:
+            bounds = ()
+        if len(bounds) != 4:
+            return jsonify({'error': 'bbox must be south,west,north,east'}), 400
+    
+    clusters = station_clusters.clusters(zoom, bounds)
+    return list_response(
+        'clusters', clusters,
+        total=len(clusters),
+        zoom=zoom,
+        clustered=zoom < station_clusters.max_zoom,
+        max_zoom=station_clusters.max_zoom,
+        generation=station_clusters.generation
+    )
 
 
 @api_bp.route('/stations/<station_code>', methods=['GET'])
+@response_cache.cached
 def get_station(station_code):
     """Get detailed information about a specific station"""
     station = Station.query.filter_by(code=station_code).first()
     if not station:
         return jsonify({'error': 'Station not found'}), 404
     
+    last_24h = datetime.utcnow() - timedelta(hours=24)
+    
     # Get bikes currently at station with enhanced info
     current_bikes = Bike.query.filter_by(current_station_id=station.id).all()
     
+    # Recent boomerangs at this station (last 24h), for all bikes in one grouped query
+    recent_boomerangs = dict(db.session.query(
+        Trip.bike_id, func.count(Trip.id)
+    ).filter(
+        Trip.start_station_id == station.id,
+        Trip.end_station_id == station.id,
+        Trip.is_boomerang == True,
+        Trip.start_time >= last_24h
+    ).group_by(Trip.bike_id).all()) if current_bikes else {}
+    
     # Enhance bike data with boomerang count and time at station
     enhanced_bikes = []
     for bike in current_bikes:
@@ -54,23 +120,13 @@ def get_station(station_code):
         # Add boomerang count (already in bike.to_dict() but let's ensure it's there)
         bike_dict['boomerang_count'] = bike.boomerang_count
         
-        # Recent boomerangs at this station (last 24h)
-        recent_boomerangs = Trip.query.filter(
-            Trip.bike_id == bike.id,
-            Trip.start_station_id == station.id,
-            Trip.end_station_id == station.id,
-            Trip.is_boomerang == True,
-            Trip.start_time >= datetime.utcnow() - timedelta(hours=24)
-        ).count()
-        
-        bike_dict['recent_boomerangs_24h'] = recent_boomerangs
+        bike_dict['recent_boomerangs_24h'] = recent_boomerangs.get(bike.id, 0)
         
         enhanced_bikes.append(bike_dict)
     
-    # Get station activity stats
-    last_24h = datetime.utcnow() - timedelta(hours=24)
-    departures = station.trip_starts.filter(Trip.start_time >= last_24h).count()
-    arrivals = station.trip_ends.filter(Trip.end_time >= last_24h).count()
+    # Get station activity stats from the hourly station rollup
+    activity = trip_rollups.station_activity(station.id, last_24h)
+    departures, arrivals = activity['departures'], activity['arrivals']
     
     response = station.to_dict()
     response.update({
@@ -86,6 +142,8 @@ def get_station(station_code):
 
 
 @api_bp.route('/stations/<station_code>/history', methods=['GET'])
+@response_cache.cached
+@tolerate_dropped_partitions
 def get_station_history(station_code):
     """Get historical availability for a station"""
     station = Station.query.filter_by(code=station_code).first()
@@ -96,21 +154,26 @@ def get_station_history(station_code):
     hours = request.args.get('hours', 24, type=int)
     interval = request.args.get('interval', 60, type=int)  # minutes
     
+    width = bucket_seconds(interval)
+    if width is None:
+        return jsonify({'error': f'interval must be one of {list(BUCKET_MINUTES)} minutes'}), 400
+    
     cutoff = datetime.utcnow() - timedelta(hours=hours)
     
-    # Get bike counts over time
+    # Get bike counts over time, reading only the partitions inside the window
+    Snapshot = bike_snapshots.between(cutoff)
+    bucket = time_bucket(Snapshot.timestamp, width)
     snapshots = db.session.query(
-        func.date_trunc('hour', BikeSnapshot.timestamp).label('hour'),
-        func.count(func.distinct(BikeSnapshot.bike_id)).label('bike_count')
+        bucket.label('bucket'),
+        func.count(func.distinct(Snapshot.bike_id)).label('bike_count')
     ).filter(
-        BikeSnapshot.station_id == station.id,
-        BikeSnapshot.timestamp >= cutoff
-    ).group_by('hour').order_by('hour').all()
+        Snapshot.station_id == station.id
+    ).group_by(bucket).order_by(bucket).all()
     
     history = []
     for snapshot in snapshots:
         history.append({
-            'timestamp': snapshot.hour.isoformat(),
+            'timestamp': bucket_start(snapshot.bucket).isoformat(),
             'bike_count': snapshot.bike_count,
             'free_docks': station.total_capacity - snapshot.bike_count
         })
@@ -118,17 +181,21 @@ def get_station_history(station_code):
     return jsonify({
         'station_code': station_code,
         'history': history,
-        'hours': hours
+        'hours': hours,
+        'interval': interval
     })
 
 
 @api_bp.route('/stations/search', methods=['GET'])
+@response_cache.cached
 def search_stations():
-    """Search stations by name or location"""
+    """Search stations by name, around a point (radius or k nearest) or in a bounding box"""
     query = request.args.get('q', '')
     lat = request.args.get('lat', type=float)
     lon = request.args.get('lon', type=float)
     radius = request.args.get('radius', 1.0, type=float)  # km
+    k = request.args.get('k', type=int)  # k nearest instead of everything within radius
+    bbox = request.args.get('bbox')  # south,west,north,east
     
     stations_query = Station.query
     
@@ -137,25 +204,34 @@ def search_stations():
             Station.name.ilike(f'%{query}%')
         )
     
-    if lat and lon:
-        # Simple distance calculation (not perfect but fast)
-        # For production, use PostGIS or similar
-        stations = stations_query.all()
-        nearby_stations = []
+    if lat is not None and lon is not None:
+        # Candidates come from the in-memory grid, with haversine distances
+        if k:
+            matches = station_index.nearest(lat, lon, k, max_km=request.args.get('radius', type=float))
+        else:
+            matches = station_index.within_radius(lat, lon, radius)
         
-        for station in stations:
-            # Approximate distance calculation
-            dlat = abs(station.latitude - lat) * 111  # km per degree
-            dlon = abs(station.longitude - lon) * 111 * 0.7  # rough approximation
-            distance = (dlat**2 + dlon**2)**0.5
-            
-            if distance <= radius:
+        stations = {station.id: station for station in
+                    stations_query.filter(Station.id.in_([station_id for station_id, _ in matches]))} \
+            if matches else {}
+        nearby_stations = []
+        for station_id, distance in matches:
+            station = stations.get(station_id)
+            if station:
                 station_dict = station.to_dict()
                 station_dict['distance'] = round(distance, 2)
                 nearby_stations.append(station_dict)
         
-        nearby_stations.sort(key=lambda x: x['distance'])
         return jsonify({'stations': nearby_stations})
     
+    if bbox:
+        try:
+            south, west, north, east = (float(value) for value in bbox.split(','))
+        except ValueError:
+            return jsonify({'error': 'bbox must be south,west,north,east'}), 400
+        ids = station_index.in_bbox(south, west, north, east)
+        stations = stations_query.filter(Station.id.in_(ids)).all() if ids else []
+        return jsonify({'stations': [s.to_dict() for s in stations]})
+    
     stations = stations_query.limit(50).all()
     return jsonify({'stations': [s.to_dict() for s in stations]})
\ No newline at end of file
@@ -1,12 +1,15 @@
 from flask import jsonify, request
 from app.api import api_bp
+from app.utils.response_cache import response_cache
 from app.models import Bike, Trip, Station, MalfunctionLog
 from app import db
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc, and_
+from app.utils.rollups import trip_rollups
 
 
 @api_bp.route('/statistics/overview', methods=['GET'])
+@response_cache.cached
 def get_overview_statistics():
     """Get system-wide statistics"""
     # Basic counts
@@ -42,69 +45,34 @@ def get_overview_statistics():
 
 
 @api_bp.route('/statistics/awards', methods=['GET'])
+@response_cache.cached
 def get_velib_awards():
     """Get Velib Awards - interesting statistics"""
     days = request.args.get('days', 7, type=int)
     cutoff = datetime.utcnow() - timedelta(days=days)
     
-    # Most used bike
-    most_used = db.session.query(
-        Bike.bike_name,
-        func.count(Trip.id).label('trip_count')
-    ).join(Trip).filter(
-        Trip.start_time >= cutoff
-    ).group_by(Bike.bike_name).order_by(
-        desc('trip_count')
-    ).first()
-    
-    # Longest trip
+    # Per-bike and per-station leaders come from the rollups
+    most_used = trip_rollups.top_bike(cutoff, 'trip_count')
+    fastest_bike = trip_rollups.top_bike(cutoff, 'avg_speed')
+    most_boomeranged = trip_rollups.top_bike(cutoff, 'boomerang_count')
+    busiest = trip_rollups.busiest_station(cutoff)
+    
+    bike_ids = {row.bike_id for row in (most_used, fastest_bike, most_boomeranged) if row}
+    bike_names = dict(db.session.query(Bike.id, Bike.bike_name).filter(Bike.id.in_(bike_ids)).all()) \
+        if bike_ids else {}
+    busiest_station = db.session.get(Station, busiest.station_id) if busiest else None
+    
+    # Longest trip - a range scan on the start time index, ordered by distance
     longest_trip = Trip.query.filter(
         Trip.start_time >= cutoff,
         Trip.distance.isnot(None)
     ).order_by(desc(Trip.distance)).first()
     
-    # Fastest average speed (excluding very short trips)
-    fastest_bike = db.session.query(
-        Bike.bike_name,
-        func.avg(Trip.avg_speed).label('avg_speed')
-    ).join(Trip).filter(
-        Trip.start_time >= cutoff,
-        Trip.duration > 300,  # At least 5 minutes
-        Trip.avg_speed.isnot(None)
-    ).group_by(Bike.bike_name).order_by(
-        desc('avg_speed')
-    ).first()
-    
-    # Most boomeranged bike
-    most_boomeranged = db.session.query(
-        Bike.bike_name,
-        func.count(Trip.id).label('boomerang_count')
-    ).join(Trip).filter(
-        Trip.start_time >= cutoff,
-        Trip.is_boomerang == True
-    ).group_by(Bike.bike_name).order_by(
-        desc('boomerang_count')
-    ).first()
-    
-    # Busiest station
-    busiest_station = db.session.query(
-        Station.code,
-        Station.name,
-        func.count(Trip.id).label('activity_count')
-    ).join(
-        Trip,
-        db.or_(Trip.start_station_id == Station.id, Trip.end_station_id == Station.id)
-    ).filter(
-        Trip.start_time >= cutoff
-    ).group_by(Station.code, Station.name).order_by(
-        desc('activity_count')
-    ).first()
-    
     awards = {
         'period_days': days,
         'most_used_bike': {
-            'bike_name': most_used.bike_name if most_used else None,
-            'trip_count': most_used.trip_count if most_used else 0
+            'bike_name': bike_names.get(most_used.bike_id),
+            'trip_count': int(most_used.value)
         } if most_used else None,
         'longest_trip': {
             'bike_name': longest_trip.bike.bike_name if longest_trip else None,
@@ -113,17 +81,17 @@ def get_velib_awards():
             'date': longest_trip.start_time.isoformat() if longest_trip else None
         } if longest_trip else None,
         'fastest_bike': {
-            'bike_name': fastest_bike.bike_name if fastest_bike else None,
-            'avg_speed': round(fastest_bike.avg_speed, 2) if fastest_bike else 0
+            'bike_name': bike_names.get(fastest_bike.bike_id),
+            'avg_speed': round(fastest_bike.value, 2)
         } if fastest_bike else None,
         'most_boomeranged': {
-            'bike_name': most_boomeranged.bike_name if most_boomeranged else None,
-            'boomerang_count': most_boomeranged.boomerang_count if most_boomeranged else 0
+            'bike_name': bike_names.get(most_boomeranged.bike_id),
+            'boomerang_count': int(most_boomeranged.value)
         } if most_boomeranged else None,
         'busiest_station': {
-            'code': busiest_station.code if busiest_station else None,
-            'name': busiest_station.name if busiest_station else None,
-            'activity_count': busiest_station.activity_count if busiest_station else 0
+            'code': busiest_station.code,
+            'name': busiest_station.name,
+            'activity_count': int(busiest.activity_count)
         } if busiest_station else None
     }
     
@@ -131,27 +99,17 @@ def get_velib_awards():
 
 
 @api_bp.route('/statistics/hourly-activity', methods=['GET'])
+@response_cache.cached
 def get_hourly_activity():
     """Get hourly activity patterns"""
     days = request.args.get('days', 7, type=int)
     cutoff = datetime.utcnow() - timedelta(days=days)
     
-    # Get trips grouped by hour of day
-    hourly_stats = db.session.query(
-        func.extract('hour', Trip.start_time).label('hour'),
-        func.count(Trip.id).label('trip_count'),
-        func.avg(Trip.duration).label('avg_duration')
-    ).filter(
-        Trip.start_time >= cutoff
-    ).group_by('hour').order_by('hour').all()
-    
-    activity = []
-    for stat in hourly_stats:
-        activity.append({
-            'hour': int(stat.hour),
-            'trip_count': stat.trip_count,
-            'avg_duration': round(stat.avg_duration or 0)
-        })
+    # Summed from the hourly rollup, per hour of day
+    activity = [
+        {'hour': row['hour'], 'trip_count': row['trip_count'], 'avg_duration': row['avg_duration']}
+        for row in trip_rollups.hourly_activity(cutoff)
+    ]
     
     return jsonify({
         'hourly_activity': activity,
@@ -160,6 +118,7 @@ def get_hourly_activity():
 
 
 @api_bp.route('/statistics/malfunction-summary', methods=['GET'])
+@response_cache.cached
 def get_malfunction_summary():
     """Get summary of current malfunctions"""
     # Count by type
@@ -208,6 +167,7 @@ def get_malfunction_summary():
 
 
 @api_bp.route('/statistics/system-health', methods=['GET'])
+@response_cache.cached
 def get_system_health():
     """Get overall system health metrics"""
     # Calculate various health indicators
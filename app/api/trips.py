@@ -1,11 +1,14 @@
 from flask import jsonify, request
 from app.api import api_bp
+from app.utils.response_cache import response_cache
+from app.utils.encoding import list_response
 from app.models import Trip, Bike, Station
 from app import db
 from datetime import datetime, timedelta
 from sqlalchemy import func, desc
 from sqlalchemy.orm import joinedload
 from app.utils.timezone import format_paris_time
+from app.utils.rollups import trip_rollups
 
 
 @api_bp.route('/trips', methods=['GET'])
@@ -45,13 +48,13 @@ def get_trips():
         trip_dict['end_station_name'] = trip.end_station.name if trip.end_station else None
         trips.append(trip_dict)
     
-    return jsonify({
-        'trips': trips,
-        'total': paginated.total,
-        'page': page,
-        'pages': paginated.pages,
-        'per_page': per_page
-    })
+    return list_response(
+        'trips', trips,
+        total=paginated.total,
+        page=page,
+        pages=paginated.pages,
+        per_page=per_page
+    )
 
 
 @api_bp.route('/trips/<int:trip_id>', methods=['GET'])
@@ -87,6 +90,7 @@ def get_trip(trip_id):
 
 
 @api_bp.route('/trips/live', methods=['GET'])
+@response_cache.cached
 def get_live_trips():
     """Get bikes currently in transit"""
     in_transit_bikes = Bike.query.filter_by(current_status='in_transit').all()
@@ -120,6 +124,7 @@ def get_live_trips():
 
 
 @api_bp.route('/trips/popular-routes', methods=['GET'])
+@response_cache.cached
 def get_popular_routes():
     """Get most popular routes"""
     hours = request.args.get('hours', 24, type=int)
@@ -127,26 +132,17 @@ def get_popular_routes():
     
     cutoff = datetime.utcnow() - timedelta(hours=hours)
     
-    popular_routes = db.session.query(
-        Trip.start_station_id,
-        Trip.end_station_id,
-        func.count(Trip.id).label('trip_count'),
-        func.avg(Trip.duration).label('avg_duration'),
-        func.avg(Trip.distance).label('avg_distance')
-    ).filter(
-        Trip.start_time >= cutoff,
-        Trip.start_station_id != Trip.end_station_id  # Exclude boomerangs
-    ).group_by(
-        Trip.start_station_id,
-        Trip.end_station_id
-    ).order_by(
-        desc('trip_count')
-    ).limit(limit).all()
+    # Summed from the hourly route rollup
+    popular_routes = trip_rollups.popular_routes(cutoff, limit)
+    station_ids = {route.start_station_id for route in popular_routes} | \
+                  {route.end_station_id for route in popular_routes}
+    stations = {station.id: station for station in Station.query.filter(Station.id.in_(station_ids))} \
+        if station_ids else {}
     
     routes = []
     for route in popular_routes:
-        start_station = Station.query.get(route.start_station_id)
-        end_station = Station.query.get(route.end_station_id)
+        start_station = stations.get(route.start_station_id)
+        end_station = stations.get(route.end_station_id)
         
         if start_station and end_station:
             routes.append({
@@ -162,9 +158,9 @@ def get_popular_routes():
                     'lat': end_station.latitude,
                     'lon': end_station.longitude
                 },
-                'trip_count': route.trip_count,
-                'avg_duration': round(route.avg_duration or 0),
-                'avg_distance': round(route.avg_distance or 0, 2)
+                'trip_count': int(route.trip_count),
+                'avg_duration': round(route.duration_sum / route.duration_count) if route.duration_count else 0,
+                'avg_distance': round(route.distance_sum / route.distance_count, 2) if route.distance_count else 0
             })
     
     return jsonify({
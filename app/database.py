@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import logging
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Applied to every SQLite connection. WAL lets readers run while the queue worker writes.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # Safe with WAL, only the last commits can be lost on power failure
+    'cache_size': -64000,  # 64MB page cache per connection
+    'mmap_size': 268435456,  # 256MB memory-mapped I/O
+    'temp_store': 'MEMORY',
+}
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tune every new SQLite connection, whichever engine opened it"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def create_read_engine(engine):
+    """
+    Read-only engine over the same database as the main engine.
+
+    On SQLite the file is opened with mode=ro, so its connections never take
+    the write lock and, with WAL, never wait on the queue worker's transactions.
+    """
+    url = engine.url
+    if url.get_backend_name() == 'sqlite':
+        database = url.database
+        if not database or database == ':memory:':
+            return None
+        read_url = f"sqlite:///file:{os.path.abspath(database)}?mode=ro&uri=true"
+        read_engine = create_engine(read_url, connect_args={'timeout': 10, 'check_same_thread': False})
+
+        @event.listens_for(read_engine, 'connect')
+        def set_query_only(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA query_only=ON')
+
+        return read_engine
+
+    if url.get_backend_name() == 'postgresql':
+        return create_engine(url, pool_pre_ping=True, pool_recycle=300,
+                             execution_options={'postgresql_readonly': True})
+
+    return None
+
+
+def init_read_engine(app, db):
+    """Create the API read engine once the main engine exists"""
+    if not app.config.get('API_READ_ENGINE', True):
+        return
+    with app.app_context():
+        read_engine = create_read_engine(db.engine)
+    if read_engine is not None:
+        app.extensions['read_engine'] = read_engine
+        logger.info(f"API reads use a separate read-only engine ({read_engine.url.get_backend_name()})")
+
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read-only HTTP requests to the read engine.
+
+    Everything else - the queue worker, the scheduler, POST handlers and any
+    flush - keeps using the main engine.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context() \
+                and request.method in READ_METHODS:
+            read_engine = current_app.extensions.get('read_engine')
+            if read_engine is not None:
+                return read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
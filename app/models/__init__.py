@@ -4,5 +4,9 @@ from .trip import Trip
 from .malfunction import MalfunctionLog
 from .station_state import StationState
 from .bike_movement import BikeMovement
+from .recovery_job import RecoveryJob
+from .station_change import StationChange
+from .rollup import TripRollup, StationRollup, RouteRollup, BikeRollup, RollupState
 
-__all__ = ['Station', 'Bike', 'BikeSnapshot', 'Trip', 'MalfunctionLog', 'StationState', 'BikeMovement']
\ No newline at end of file
+__all__ = ['Station', 'Bike', 'BikeSnapshot', 'Trip', 'MalfunctionLog', 'StationState', 'BikeMovement', 'RecoveryJob',
+           'StationChange', 'TripRollup', 'StationRollup', 'RouteRollup', 'BikeRollup', 'RollupState']
\ No newline at end of file
@@ -39,6 +39,13 @@ class Bike(db.Model):
     current_station = db.relationship('Station', foreign_keys=[current_station_id])
     previous_station = db.relationship('Station', foreign_keys=[previous_station_id])
     
+    __table_args__ = (
+        Index('idx_bike_status_seen', 'current_status', 'last_seen_at'),
+        Index('idx_bike_last_seen', 'last_seen_at'),
+        Index('idx_bike_station', 'current_station_id'),
+        Index('idx_bike_potential_malfunction', 'potential_malfunction'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
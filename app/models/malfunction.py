@@ -1,5 +1,6 @@
 from app import db
 from datetime import datetime
+from sqlalchemy import Index
 
 class MalfunctionLog(db.Model):
     __tablename__ = 'malfunction_logs'
@@ -19,6 +20,12 @@ class MalfunctionLog(db.Model):
     related_trip_id = db.Column(db.Integer, db.ForeignKey('trips.id'))
     station_id = db.Column(db.Integer, db.ForeignKey('stations.id'))
     
+    __table_args__ = (
+        Index('idx_malfunction_bike_active', 'bike_id', 'is_active', 'malfunction_type'),
+        Index('idx_malfunction_active_type', 'is_active', 'malfunction_type'),
+        Index('idx_malfunction_detected', 'detected_at'),
+    )
+    
     def to_dict(self):
         return {
             'id': self.id,
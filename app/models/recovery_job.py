@@ -0,0 +1,62 @@
+from app import db
+from datetime import datetime
+import json
+
+class RecoveryJob(db.Model):
+    """Background recovery run, checkpointed after every step so it can resume"""
+    __tablename__ = 'recovery_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)
+    action = db.Column(db.String(30), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, running, completed, failed
+
+    # Progress
+    steps = db.Column(db.Text, nullable=False)  # JSON list of step names
+    current_step = db.Column(db.Integer, default=0)  # Index of the next step to run
+    checkpoint = db.Column(db.Text)  # JSON state of a partially finished step
+    rows_processed = db.Column(db.Integer, default=0)
+    results = db.Column(db.Text)  # JSON {step: rows}
+    error = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('idx_recovery_job_status', 'status', 'created_at'),
+    )
+
+    @property
+    def step_names(self):
+        return json.loads(self.steps) if self.steps else []
+
+    @property
+    def step_results(self):
+        return json.loads(self.results) if self.results else {}
+
+    def estimate_remaining(self):
+        """Seconds left, extrapolated from the time spent on completed steps"""
+        if self.status != 'running' or not self.started_at or not self.current_step:
+            return None
+        elapsed = (datetime.utcnow() - self.started_at).total_seconds()
+        remaining_steps = len(self.step_names) - self.current_step
+        return int(elapsed / self.current_step * remaining_steps)
+
+    def to_dict(self):
+        steps = self.step_names
+        return {
+            'job_id': self.id,
+            'action': self.action,
+            'status': self.status,
+            'step': steps[self.current_step] if self.current_step < len(steps) else None,
+            'steps_completed': self.current_step,
+            'steps_total': len(steps),
+            'rows_processed': self.rows_processed,
+            'results': self.step_results,
+            'eta_seconds': self.estimate_remaining(),
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
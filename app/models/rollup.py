@@ -0,0 +1,73 @@
+from app import db
+from sqlalchemy import Index
+
+# Rollups are keyed by epoch seconds of the bucket start (see app.utils.time_buckets).
+# Averages are kept as sums plus the number of values summed, so buckets add up.
+
+
+class TripRollup(db.Model):
+    """System-wide trips per hour, bucketed by start time"""
+    __tablename__ = 'rollup_trips_hourly'
+
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    trip_count = db.Column(db.Integer, nullable=False, default=0)
+    boomerang_count = db.Column(db.Integer, nullable=False, default=0)
+    duration_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    duration_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_sum = db.Column(db.Float, nullable=False, default=0)
+    distance_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class StationRollup(db.Model):
+    """Departures (by start time) and arrivals (by end time) per station and hour"""
+    __tablename__ = 'rollup_stations_hourly'
+
+    station_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    departures = db.Column(db.Integer, nullable=False, default=0)
+    arrivals = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_rollup_station_bucket', 'bucket'),
+    )
+
+
+class RouteRollup(db.Model):
+    """Trips per origin-destination pair and hour, bucketed by start time"""
+    __tablename__ = 'rollup_routes_hourly'
+
+    bucket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    start_station_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    end_station_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    trip_count = db.Column(db.Integer, nullable=False, default=0)
+    duration_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    duration_count = db.Column(db.Integer, nullable=False, default=0)
+    distance_sum = db.Column(db.Float, nullable=False, default=0)
+    distance_count = db.Column(db.Integer, nullable=False, default=0)
+    speed_sum = db.Column(db.Float, nullable=False, default=0)
+    speed_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class BikeRollup(db.Model):
+    """Trips per bike and day, bucketed by start time"""
+    __tablename__ = 'rollup_bikes_daily'
+
+    bike_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    trip_count = db.Column(db.Integer, nullable=False, default=0)
+    boomerang_count = db.Column(db.Integer, nullable=False, default=0)
+    speed_sum = db.Column(db.Float, nullable=False, default=0)  # Trips over 5 minutes with a speed
+    speed_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('idx_rollup_bike_day', 'day'),
+    )
+
+
+class RollupState(db.Model):
+    """Marker of the last full rebuild - incremental upserts alone don't cover older trips"""
+    __tablename__ = 'rollup_state'
+
+    name = db.Column(db.String(50), primary_key=True)
+    rebuilt_at = db.Column(db.DateTime, nullable=False)
+    max_trip_id = db.Column(db.Integer)  # Highest trip id folded in by the rebuild
@@ -0,0 +1,17 @@
+from app import db
+from datetime import datetime
+from sqlalchemy import Index
+
+class StationChange(db.Model):
+    """Stations whose live status changed in a scrape, by scrape generation"""
+    __tablename__ = 'station_changes'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False)
+    station_id = db.Column(db.Integer, db.ForeignKey('stations.id'), nullable=False)
+    change_type = db.Column(db.String(10), nullable=False, default='updated')  # updated, removed
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index('idx_station_change_generation', 'generation', 'station_id'),
+    )
@@ -20,6 +20,7 @@ class Trip(db.Model):
     # Trip classification
     is_boomerang = db.Column(db.Boolean, default=False)
     is_short_trip = db.Column(db.Boolean, default=False)
+    low_confidence = db.Column(db.Boolean, default=False)  # Departure or arrival fell inside a scrape gap
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
@@ -27,6 +28,8 @@ class Trip(db.Model):
         Index('idx_trip_bike_time', 'bike_id', 'start_time'),
         Index('idx_trip_stations', 'start_station_id', 'end_station_id'),
         Index('idx_trip_time', 'start_time', 'end_time'),
+        Index('idx_trip_boomerang', 'is_boomerang', 'start_time'),
+        Index('idx_trip_end_station', 'end_station_id', 'end_time'),
     )
     
     def calculate_metrics(self):
@@ -85,7 +88,8 @@ class Trip(db.Model):
             'distance': round(self.distance, 2) if self.distance else None,
             'avg_speed': round(self.avg_speed, 2) if self.avg_speed else None,
             'is_boomerang': self.is_boomerang,
-            'is_short_trip': self.is_short_trip
+            'is_short_trip': self.is_short_trip,
+            'low_confidence': bool(self.low_confidence)
         }
     
     def _format_duration(self, seconds):
@@ -1,136 +1,463 @@
 import threading
 import queue
+import asyncio
+import itertools
+import bisect
 import logging
-from typing import Callable, Any
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Callable, Any, Dict, Optional
 from functools import wraps
 import time
 
 logger = logging.getLogger(__name__)
 
+# Task priorities - lower runs first
+PRIORITY_SCRAPE = 0
+PRIORITY_INTERACTIVE = 5  # Work a request handler is waiting on
+PRIORITY_TRIPS = 10
+PRIORITY_MALFUNCTIONS = 20
+PRIORITY_DEFAULT = 25
+PRIORITY_RECOVERY = 30
+
+
+class QueueError(Exception):
+    """A task could not be run by the database queue"""
+
+
+class TaskExpired(QueueError):
+    """The task's deadline passed before the worker reached it"""
+
+
+class LatencyHistogram:
+    """Fixed log-spaced buckets of durations, cheap enough to update on every task"""
+
+    # Upper bounds in seconds, from 1ms to 30 minutes
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+              1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)  # Last bucket holds everything above the bounds
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Upper bound of the bucket holding the p-th percentile"""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                return min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict:
+        if not self.count:
+            return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p99': None, 'max': None}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 4),
+            'p50': round(self.percentile(50), 4),
+            'p90': round(self.percentile(90), 4),
+            'p99': round(self.percentile(99), 4),
+            'max': round(self.max, 4)
+        }
+
+
+class TaskStats:
+    """Counters and latency histograms for one task key"""
+
+    def __init__(self):
+        self.enqueued = 0
+        self.coalesced = 0
+        self.expired = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.wait = LatencyHistogram()  # Enqueue to start
+        self.execution = LatencyHistogram()  # Start to end
+
+    def to_dict(self) -> Dict:
+        return {
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'expired': self.expired,
+            'dropped': self.dropped,
+            'cancelled': self.cancelled,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'wait_seconds': self.wait.to_dict(),
+            'execution_seconds': self.execution.to_dict()
+        }
+
+
+class QueuedTask:
+    """A database task waiting for the worker"""
+
+    __slots__ = ('func', 'args', 'kwargs', 'result_callback', 'error_callback', 'future',
+                 'key', 'priority', 'coalesce', 'deadline', 'enqueued_at', 'started_at', 'finished_at')
+
+    def __init__(self, func, args, kwargs, result_callback, error_callback,
+                 key, priority, coalesce, deadline):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result_callback = result_callback
+        self.error_callback = error_callback
+        self.future = Future()
+        self.key = key
+        self.priority = priority
+        self.coalesce = coalesce
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.deadline = self.enqueued_at + deadline if deadline else None  # Absolute, monotonic
+
+    def expired(self, now: float) -> bool:
+        return self.deadline is not None and now > self.deadline
+
 
 class DatabaseQueue:
-    """Simple in-memory queue for serializing database operations"""
-    
+    """
+    In-memory priority queue for serializing database operations.
+
+    Tasks run by priority, then in submission order. A task submitted with
+    coalesce=True is dropped while another task with the same key is still
+    pending, and a task with a deadline is dropped if the worker only gets
+    to it after the deadline passed.
+
+    Every submission returns a concurrent.futures.Future resolved with the
+    task's result. Cancelling the future before the task starts skips it.
+    """
+
     def __init__(self):
-        self.task_queue = queue.Queue()
+        self.task_queue = queue.PriorityQueue()
         self.worker_thread = None
         self.running = False
         self.app_context = None
-        
+
+        self.sequence = itertools.count()  # Keeps FIFO order within a priority
+        self.lock = threading.RLock()
+        self.pending: Dict[str, QueuedTask] = {}  # Coalescable tasks waiting, by key
+        self.stats: Dict[str, TaskStats] = {}  # Per-key counters and latencies
+        self.current_task: Optional[QueuedTask] = None
+
     def start_worker(self, app):
         """Start the database worker thread"""
         if self.worker_thread and self.worker_thread.is_alive():
-            return
-            
+            if self.running:
+                return
+            # Stopped but still finishing its last task - let it exit first
+            self.worker_thread.join()
+
         self.app_context = app
         self.running = True
         self.worker_thread = threading.Thread(target=self._worker, daemon=True)
         self.worker_thread.start()
         logger.info("Database queue worker started")
-        
-    def stop_worker(self):
-        """Stop the database worker thread"""
+
+    def stop_worker(self, timeout: Optional[float] = 5) -> bool:
+        """
+        Stop the database worker thread.
+
+        Waits up to `timeout` seconds (None waits as long as it takes) for the
+        task in flight. Tasks still queued stay queued for the next start.
+        Returns False if the worker was still busy when the wait ended.
+        """
         self.running = False
+        stopped = True
         if self.worker_thread:
-            self.worker_thread.join(timeout=5)
-        logger.info("Database queue worker stopped")
-        
+            self.worker_thread.join(timeout=timeout)
+            stopped = not self.worker_thread.is_alive()
+        if stopped:
+            logger.info("Database queue worker stopped")
+        else:
+            task = self.current_task
+            logger.warning(f"Database queue worker still running {task.key if task else 'a task'} "
+                           f"after {timeout}s")
+        return stopped
+
     def _worker(self):
         """Main worker loop - processes queued database tasks"""
+        # Imported here - the write-behind buffer needs the app's database
+        from app.utils.write_behind import write_behind
+        
         while self.running:
             try:
                 # Get task with timeout to allow periodic checks
-                task = self.task_queue.get(timeout=1)
-                
+                item = self.task_queue.get(timeout=1)
+                _, _, task = item
+
                 if task is None:  # Poison pill to stop worker
                     break
-                    
-                func, args, kwargs, result_callback, error_callback = task
-                
-                # Execute task within app context
+
+                if not self.running:
+                    # Stopped while waiting - leave the task for the next start
+                    self.task_queue.put(item)
+                    self.task_queue.task_done()
+                    break
+
+                self._dequeued(task)
+
+                if task.expired(time.monotonic()):
+                    self._count(task.key, 'expired')
+                    logger.warning(f"Dropping stale task {task.key} - deadline passed while queued")
+                    if task.future.set_running_or_notify_cancel():
+                        task.future.set_exception(TaskExpired(f"Task {task.key} expired before it started"))
+                    self.task_queue.task_done()
+                    continue
+
+                if not task.future.set_running_or_notify_cancel():
+                    self._count(task.key, 'cancelled')
+                    self.task_queue.task_done()
+                    continue
+
+                task.started_at = time.monotonic()
+                self.current_task = task
+                succeeded = False
+
+                # Execute task within app context, its commits batched into one transaction
                 with self.app_context.app_context():
                     try:
-                        result = func(*args, **kwargs)
-                        if result_callback:
-                            result_callback(result)
+                        with write_behind.unit():
+                            result = task.func(*task.args, **task.kwargs)
+                        succeeded = True
+                        if task.result_callback:
+                            task.result_callback(result)
+                        task.future.set_result(result)
                     except Exception as e:
                         logger.error(f"Database task failed: {e}")
-                        if error_callback:
-                            error_callback(e)
-                        
+                        if task.error_callback:
+                            task.error_callback(e)
+                        if not task.future.done():
+                            task.future.set_exception(e)
+
+                task.finished_at = time.monotonic()
+                self.current_task = None
+                self._record(task, succeeded)
+
                 self.task_queue.task_done()
-                
+
             except queue.Empty:
                 continue
             except Exception as e:
                 logger.error(f"Worker thread error: {e}")
-                
-    def enqueue_task(self, func: Callable, *args, 
+
+    def enqueue_task(self, func: Callable, *args,
                     result_callback: Callable = None,
                     error_callback: Callable = None,
-                    **kwargs) -> bool:
+                    priority: int = PRIORITY_DEFAULT,
+                    key: str = None,
+                    coalesce: bool = False,
+                    deadline: float = None,
+                    **kwargs) -> Future:
         """
         Enqueue a database task to be executed by the worker thread
-        
+
         Args:
             func: Function to execute
             *args: Function arguments
             result_callback: Called with result if task succeeds
             error_callback: Called with exception if task fails
+            priority: Lower values run first (see PRIORITY_* constants)
+            key: Name used for coalescing and counters, defaults to the function name
+            coalesce: Skip this task if one with the same key is already pending
+            deadline: Seconds after which the task is dropped if it has not started
             **kwargs: Function keyword arguments
-            
+
         Returns:
-            True if task was enqueued successfully
+            Future resolved with the task's result. A coalesced submission gets
+            the future of the pending task; a task that could not be queued
+            gets a future failed with QueueError.
         """
         if not self.running:
             logger.warning("Cannot enqueue task - worker not running")
-            return False
-            
+            return self._failed(QueueError("Database queue worker not running"))
+
+        key = key or func.__name__
+
         try:
-            task = (func, args, kwargs, result_callback, error_callback)
-            self.task_queue.put(task, timeout=5)
-            return True
+            with self.lock:
+                pending = self.pending.get(key) if coalesce else None
+                if pending is not None:
+                    self._count(key, 'coalesced')
+                    logger.debug(f"Task {key} already pending - coalesced")
+                    return pending.future
+
+                task = QueuedTask(func, args, kwargs, result_callback, error_callback,
+                                  key, priority, coalesce, deadline)
+                if coalesce:
+                    self.pending[key] = task
+                self._count(key, 'enqueued')
+
+            self.task_queue.put((priority, next(self.sequence), task), timeout=5)
+            return task.future
         except queue.Full:
+            self._dequeued(task)
+            self._count(key, 'dropped')
             logger.error("Task queue is full - dropping task")
-            return False
+            return self._failed(QueueError("Database queue is full"))
         except Exception as e:
             logger.error(f"Failed to enqueue task: {e}")
-            return False
+            return self._failed(e)
+
+    @staticmethod
+    def _failed(error: Exception) -> Future:
+        future = Future()
+        future.set_exception(error)
+        return future
+
+    def _dequeued(self, task: QueuedTask):
+        if not task.coalesce:
+            return
+        with self.lock:
+            if self.pending.get(task.key) is task:
+                del self.pending[task.key]
+
+    def on_worker_thread(self) -> bool:
+        return self.worker_thread is not None and threading.current_thread() is self.worker_thread
+
+    def _task_stats(self, key: str) -> TaskStats:
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = TaskStats()
+        return stats
+
+    def _count(self, key: str, event: str):
+        with self.lock:
+            stats = self._task_stats(key)
+            setattr(stats, event, getattr(stats, event) + 1)
+
+    def _record(self, task: QueuedTask, succeeded: bool):
+        with self.lock:
+            stats = self._task_stats(task.key)
+            stats.wait.record(task.started_at - task.enqueued_at)
+            stats.execution.record(task.finished_at - task.started_at)
+            if succeeded:
+                stats.succeeded += 1
+            else:
+                stats.failed += 1
+
+    def has_pending(self, above_priority: Optional[int] = None) -> bool:
+        """Whether tasks are waiting, optionally only those more urgent than a priority"""
+        with self.task_queue.mutex:
+            if not self.task_queue.queue:
+                return False
+            if above_priority is None:
+                return True
+            return self.task_queue.queue[0][0] < above_priority
+
+    def task_stats(self) -> Dict[str, Dict]:
+        with self.lock:
+            return {key: stats.to_dict() for key, stats in self.stats.items()}
+
+    def running_task(self) -> Optional[Dict]:
+        """The task the worker is executing right now, with its elapsed time"""
+        task = self.current_task
+        if task is None or task.started_at is None:
+            return None
+        now = time.monotonic()
+        return {
+            'key': task.key,
+            'priority': task.priority,
+            'waited_seconds': round(task.started_at - task.enqueued_at, 3),
+            'elapsed_seconds': round(now - task.started_at, 3)
+        }
 
 
 # Global queue instance
 db_queue = DatabaseQueue()
 
 
-def queued_db_operation(func):
+def queued_db_operation(func=None, *, priority: int = PRIORITY_DEFAULT, key: str = None,
+                        coalesce: bool = False, deadline: float = None):
     """
     Decorator to automatically queue database operations
-    
+
+    Calling the decorated function returns a Future for its result.
+
     Usage:
         @queued_db_operation
         def my_db_function():
             # database operations here
             pass
+
+        @queued_db_operation(priority=PRIORITY_SCRAPE, coalesce=True, deadline=120)
+        def scheduled_job():
+            pass
     """
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        if db_queue.running:
-            # Extract callbacks if provided
-            result_callback = kwargs.pop('_result_callback', None)
-            error_callback = kwargs.pop('_error_callback', None)
-            
-            return db_queue.enqueue_task(
-                func, *args, 
-                result_callback=result_callback,
-                error_callback=error_callback,
-                **kwargs
-            )
-        else:
-            # Fallback to direct execution if queue not running
-            logger.warning(f"Queue not running, executing {func.__name__} directly")
-            return func(*args, **kwargs)
-    
-    return wrapper
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if db_queue.running:
+                # Extract callbacks if provided
+                result_callback = kwargs.pop('_result_callback', None)
+                error_callback = kwargs.pop('_error_callback', None)
+
+                return db_queue.enqueue_task(
+                    func, *args,
+                    result_callback=result_callback,
+                    error_callback=error_callback,
+                    priority=priority,
+                    key=key or func.__name__,
+                    coalesce=coalesce,
+                    deadline=deadline,
+                    **kwargs
+                )
+            else:
+                # Fallback to direct execution if queue not running - the future is already resolved
+                logger.warning(f"Queue not running, executing {func.__name__} directly")
+                future = Future()
+                future.set_running_or_notify_cancel()
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except Exception as e:
+                    logger.error(f"Database task {func.__name__} failed: {e}")
+                    future.set_exception(e)
+                return future
+
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
+
+
+def run_queued(func: Callable, *args, timeout: float = None,
+               priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Any:
+    """
+    Run func on the database worker and wait for its result.
+
+    Lets request handlers hand their writes to the single writer instead of
+    taking the write lock themselves. Raises concurrent.futures.TimeoutError
+    after `timeout` seconds (the task is cancelled if it has not started), and
+    re-raises the task's own exception. Runs func directly when the worker is
+    not running or when called from the worker itself.
+    """
+    if not db_queue.running or db_queue.on_worker_thread():
+        return func(*args, **kwargs)
+
+    future = db_queue.enqueue_task(func, *args, priority=priority, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+
+async def run_queued_async(func: Callable, *args, priority: int = PRIORITY_INTERACTIVE, **kwargs) -> Any:
+    """asyncio counterpart of run_queued - awaits the worker without blocking the event loop"""
+    future = db_queue.enqueue_task(func, *args, priority=priority, **kwargs)
+    return await asyncio.wrap_future(future)
 
 
 def start_queue_worker(app):
@@ -148,5 +475,7 @@ def get_queue_status():
     return {
         'running': db_queue.running,
         'queue_size': db_queue.task_queue.qsize(),
-        'worker_alive': db_queue.worker_thread.is_alive() if db_queue.worker_thread else False
+        'worker_alive': db_queue.worker_thread.is_alive() if db_queue.worker_thread else False,
+        'running_task': db_queue.running_task(),
+        'tasks': db_queue.task_stats()
     }
\ No newline at end of file
@@ -2,8 +2,12 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from app.scrapers import VelibScraper
 from app.scrapers.movement_trip_detector import MovementTripDetector
 from app.utils import MalfunctionDetector
-from app.utils.data_recovery import DataRecovery
-from app.queue_manager import db_queue, queued_db_operation
+from app.utils.recovery_jobs import submit_recovery_job, resume_recovery_jobs
+from app.queue_manager import (db_queue, queued_db_operation, PRIORITY_SCRAPE, PRIORITY_TRIPS,
+                               PRIORITY_MALFUNCTIONS, PRIORITY_RECOVERY)
+from app.utils.bike_stats import bike_stats
+from app.utils.write_behind import write_behind
+from app.utils.leader import leader
 import logging
 import os
 
@@ -12,13 +16,24 @@ logger = logging.getLogger(__name__)
 scheduler = BackgroundScheduler()
 app_instance = None
 
+# A scheduled run still queued when the next one is due is stale
+SCRAPE_INTERVAL = int(os.environ.get('API_SCRAPE_INTERVAL', 60))
 
-@queued_db_operation
+# Recovery jobs recorded by other processes are started within this many seconds
+RECOVERY_POLL_INTERVAL = int(os.environ.get('RECOVERY_POLL_INTERVAL', 30))
+
+# How long a stepping-down leader waits for the task in flight before releasing the lock
+HANDOFF_TIMEOUT = float(os.environ.get('LEADER_HANDOFF_TIMEOUT', 60))
+
+
+@queued_db_operation(priority=PRIORITY_SCRAPE, coalesce=True, deadline=SCRAPE_INTERVAL)
 def scrape_velib_data():
     """Scrape Velib data from API - queued to prevent database locks"""
     try:
         scraper = VelibScraper()
         success = scraper.run_update()
+        # Persist the stats once the trips folded into them are committed
+        write_behind.after_commit(bike_stats.save)
         if success:
             logger.info("Successfully scraped Velib data")
         else:
@@ -29,12 +44,13 @@ def scrape_velib_data():
         raise
 
 
-@queued_db_operation
+@queued_db_operation(priority=PRIORITY_TRIPS, coalesce=True, deadline=120)
 def detect_trips_from_movements():
     """Detect trips from precise bike movements - queued to prevent database locks"""
     try:
         detector = MovementTripDetector()
         trips_created = detector.detect_trips_from_movements()
+        write_behind.after_commit(bike_stats.save)
         logger.info(f"Successfully detected {trips_created} trips from movements")
         return True
     except Exception as e:
@@ -42,7 +58,7 @@ def detect_trips_from_movements():
         raise
 
 
-@queued_db_operation
+@queued_db_operation(priority=PRIORITY_MALFUNCTIONS, coalesce=True, deadline=15 * 60)
 def detect_malfunctions():
     """Run malfunction detection algorithms - queued to prevent database locks"""
     try:
@@ -56,13 +72,12 @@ def detect_malfunctions():
         raise
 
 
-@queued_db_operation
+@queued_db_operation(priority=PRIORITY_RECOVERY, coalesce=True)
 def run_data_recovery():
-    """Run data recovery and cleanup - queued to prevent database locks"""
+    """Submit a full recovery job - its steps run one by one on the queue"""
     try:
-        recovery = DataRecovery()
-        recovery.run_full_recovery()
-        logger.info("Successfully ran data recovery")
+        job = submit_recovery_job('full')
+        logger.info(f"Submitted data recovery job {job.id}")
         return True
     except Exception as e:
         logger.error(f"Error in data recovery: {e}")
@@ -70,22 +85,38 @@ def run_data_recovery():
 
 
 def start_scheduler(app):
-    """Start the background scheduler"""
+    """Start the background jobs in whichever process wins the leader election"""
     global app_instance
     app_instance = app
-    
+
+    # Every process campaigns, only the leader scrapes and runs the queue worker
+    leader.start(app, on_elected=_start_background_jobs, on_demoted=_stop_background_jobs)
+
+
+def _start_background_jobs():
+    """Start the queue worker and the scheduled jobs - runs once this process is leader"""
+    app = app_instance
+
     # Start the database queue worker first
     db_queue.start_worker(app)
     
+    # Pick up recovery jobs interrupted by the last shutdown
+    resume_recovery_jobs()
+    
+    if scheduler.running:
+        # Leader again after a demotion - the jobs are already registered
+        scheduler.resume()
+        logger.info("Scheduler resumed")
+        scrape_velib_data()
+        return
+
     with app.app_context():
         # Schedule tasks
-        scrape_interval = int(os.environ.get('API_SCRAPE_INTERVAL', 60))
-        
         # Scrape every minute (or configured interval)
         scheduler.add_job(
             func=scrape_velib_data,
             trigger="interval",
-            seconds=scrape_interval,
+            seconds=SCRAPE_INTERVAL,
             id='scrape_velib',
             name='Scrape Velib data',
             replace_existing=True
@@ -121,6 +152,17 @@ def start_scheduler(app):
             replace_existing=True
         )
         
+        # Start recovery jobs requested through other processes
+        scheduler.add_job(
+            func=resume_recovery_jobs,
+            trigger="interval",
+            seconds=RECOVERY_POLL_INTERVAL,
+            kwargs={'statuses': ('pending',)},
+            id='resume_recovery_jobs',
+            name='Pick up pending recovery jobs',
+            replace_existing=True
+        )
+        
         scheduler.start()
         logger.info("Scheduler started successfully")
         
@@ -131,11 +173,24 @@ def start_scheduler(app):
         detect_trips_from_movements()
 
 
+def _stop_background_jobs():
+    """Pause the jobs and stop the queue worker once another process may lead"""
+    if scheduler.running:
+        scheduler.pause()
+    # The lock is released once this returns. A task still running after the
+    # timeout cannot commit any more, its unit checks the lock first.
+    db_queue.stop_worker(timeout=HANDOFF_TIMEOUT)
+    bike_stats.save()
+    # The next leader keeps updating the file, reload it if this process leads again
+    bike_stats.unload()
+
+
 def shutdown_scheduler():
     """Shutdown the scheduler"""
     try:
-        scheduler.shutdown()
-        db_queue.stop_worker()
+        leader.stop()
+        if scheduler.running:
+            scheduler.shutdown()
         logger.info("Scheduler shutdown successfully")
     except Exception as e:
         logger.error(f"Error shutting down scheduler: {e}")
\ No newline at end of file
@@ -3,6 +3,9 @@ from typing import List, Dict
 from app import db
 from app.models import Trip, Bike, Station
 from app.models.bike_movement import BikeMovement
+from app.utils.partitions import bike_movements
+from app.utils.bike_stats import bike_stats
+from app.utils.write_behind import write_behind
 from sqlalchemy import and_
 import logging
 
@@ -21,25 +24,26 @@ class MovementTripDetector:
         cutoff = datetime.utcnow() - timedelta(hours=lookback_hours)
         
         # Get all departure events that don't have corresponding trips yet
-        departures = BikeMovement.query.filter(
-            and_(
-                BikeMovement.event_type == 'departed',
-                BikeMovement.timestamp >= cutoff
-            )
-        ).order_by(BikeMovement.timestamp).all()
+        Movement = bike_movements.between(cutoff)
+        departures = db.session.query(Movement).filter(
+            Movement.event_type == 'departed'
+        ).order_by(Movement.timestamp).all()
         
         trips_created = 0
         
+        # Every departure is after the cutoff, so one UNION covers all their arrivals
+        Arrival = bike_movements.between(cutoff)
+        
         for departure in departures:
             # Find corresponding arrival for this bike after this departure
-            arrival = BikeMovement.query.filter(
+            arrival = db.session.query(Arrival).filter(
                 and_(
-                    BikeMovement.bike_id == departure.bike_id,
-                    BikeMovement.event_type == 'arrived',
-                    BikeMovement.timestamp > departure.timestamp,
-                    BikeMovement.timestamp <= departure.timestamp + timedelta(seconds=self.max_trip_duration)
+                    Arrival.bike_id == departure.bike_id,
+                    Arrival.event_type == 'arrived',
+                    Arrival.timestamp > departure.timestamp,
+                    Arrival.timestamp <= departure.timestamp + timedelta(seconds=self.max_trip_duration)
                 )
-            ).order_by(BikeMovement.timestamp).first()
+            ).order_by(Arrival.timestamp).first()
             
             if arrival:
                 # Check if trip already exists
@@ -57,7 +61,7 @@ class MovementTripDetector:
                         trips_created += 1
         
         if trips_created > 0:
-            db.session.commit()
+            write_behind.commit()
             logger.info(f"Created {trips_created} trips from movement detection")
         
         return trips_created
@@ -98,10 +102,13 @@ class MovementTripDetector:
             bike.boomerang_count += 1
         
         db.session.add(trip)
+        # Folded into the in-memory stats only once the trip is committed
+        sample = bike_stats.trip_sample(trip)
+        write_behind.after_commit(lambda: bike_stats.record_samples([sample]))
         
         logger.info(f"Created movement-based trip for bike {bike.bike_name}: "
                    f"{departure.station.name} -> {arrival.station.name}, "
-                   f"duration: {duration}s, distance: {trip.distance:.2f if trip.distance else 0}km")
+                   f"duration: {duration}s, distance: {(trip.distance or 0):.2f}km")
         
         return trip
     
@@ -112,20 +119,20 @@ class MovementTripDetector:
         # Get all departures without corresponding arrivals
         incomplete = []
         
-        departures = BikeMovement.query.filter(
-            and_(
-                BikeMovement.event_type == 'departed',
-                BikeMovement.timestamp >= cutoff
-            )
+        Movement = bike_movements.between(cutoff)
+        departures = db.session.query(Movement).filter(
+            Movement.event_type == 'departed'
         ).all()
         
+        Arrival = bike_movements.between(cutoff)
+        
         for departure in departures:
             # Check if there's a corresponding arrival
-            arrival = BikeMovement.query.filter(
+            arrival = db.session.query(Arrival).filter(
                 and_(
-                    BikeMovement.bike_id == departure.bike_id,
-                    BikeMovement.event_type == 'arrived',
-                    BikeMovement.timestamp > departure.timestamp
+                    Arrival.bike_id == departure.bike_id,
+                    Arrival.event_type == 'arrived',
+                    Arrival.timestamp > departure.timestamp
                 )
             ).first()
             
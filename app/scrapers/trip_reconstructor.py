@@ -2,8 +2,11 @@ import json
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Optional
 from app import db
-from app.models import Trip, Bike, Station, StationState
+from app.models import Trip, Bike, Station
+from app.utils.partitions import station_states
 from geopy.distance import geodesic
+from app.utils.bike_stats import bike_stats
+from app.utils.write_behind import write_behind
 import logging
 
 logger = logging.getLogger(__name__)
@@ -20,11 +23,11 @@ class TripReconstructor:
         cutoff = datetime.utcnow() - timedelta(hours=3)
         
         # Get pairs of consecutive timestamps
-        timestamps = db.session.query(StationState.timestamp)\
-                              .filter(StationState.timestamp >= cutoff)\
-                              .filter(StationState.processed == False)\
+        State = station_states.between(cutoff)
+        timestamps = db.session.query(State.timestamp)\
+                              .filter(State.processed == False)\
                               .distinct()\
-                              .order_by(StationState.timestamp)\
+                              .order_by(State.timestamp)\
                               .all()
         
         timestamps = [ts[0] for ts in timestamps]
@@ -49,11 +52,12 @@ class TripReconstructor:
                 # Mark states as processed
                 self._mark_processed(current_time)
         
-        db.session.commit()
+        write_behind.commit()
     
     def _get_station_state(self, timestamp: datetime) -> Optional[Dict]:
         """Get station state from database"""
-        states = StationState.query.filter_by(timestamp=timestamp).all()
+        State = station_states.between(timestamp, timestamp)
+        states = db.session.query(State).all()
         
         if not states:
             return None
@@ -162,6 +166,9 @@ class TripReconstructor:
             bike.boomerang_count += 1
         
         db.session.add(trip)
+        # Folded into the in-memory stats only once the trip is committed
+        sample = bike_stats.trip_sample(trip)
+        write_behind.after_commit(lambda: bike_stats.record_samples([sample]))
         
         # Get station names for logging
         start_station_name = trip.start_station.name if trip.start_station else "Unknown"
@@ -179,18 +186,18 @@ class TripReconstructor:
     
     def _mark_processed(self, timestamp: datetime):
         """Mark timestamp as processed"""
-        StationState.query.filter_by(timestamp=timestamp).update({'processed': True})
-        db.session.commit()
+        station_states.update({'processed': True}, timestamp, timestamp)
+        write_behind.commit()
     
     def find_incomplete_trips(self, lookback_hours=3):
         """Find bikes that departed but haven't arrived yet"""
         cutoff_time = datetime.utcnow() - timedelta(hours=lookback_hours)
         
         # Get recent timestamps
-        timestamps = db.session.query(StationState.timestamp)\
-                              .filter(StationState.timestamp >= cutoff_time)\
+        State = station_states.between(cutoff_time)
+        timestamps = db.session.query(State.timestamp)\
                               .distinct()\
-                              .order_by(StationState.timestamp.desc())\
+                              .order_by(State.timestamp.desc())\
                               .limit(20)\
                               .all()
         
@@ -2,12 +2,17 @@ import cloudscraper
 import json
 import os
 from datetime import datetime, timedelta
-from typing import Dict, List, Set
+from typing import Dict, List, Set, Optional
+from sqlalchemy import select, insert, update, and_, case
 from app import db
-from app.models import Station, Bike, BikeSnapshot, StationState, Trip
-from app.models.bike_movement import BikeMovement
+from app.models import Station, Bike, Trip
+from app.utils.partitions import bike_snapshots, bike_movements, station_states, ensure_current_partitions
 from geopy.distance import geodesic
 from app.utils.timezone import get_paris_time
+from app.utils.bike_stats import bike_stats
+from app.utils.scrape_generation import scrape_generation
+from app.utils.write_behind import write_behind
+from app.utils.station_changes import dynamic_state, record_station_changes
 import logging
 
 logger = logging.getLogger(__name__)
@@ -28,6 +33,10 @@ class VelibScraper:
             "Authorization": os.environ.get('VELIB_AUTH_TOKEN'),
             "Content-Type": "application/json; charset=utf-8",
         }
+        # A longer silence between two scrapes is treated as an outage
+        self.gap_threshold = timedelta(seconds=int(os.environ.get('SCRAPE_GAP_THRESHOLD', 300)))
+        # Stations whose live status changed in the scrape being applied
+        self.changed_stations: Set[int] = set()
         
     def fetch_all_stations(self) -> List[Dict]:
         """Fetch all station data from Velib API"""
@@ -49,45 +58,26 @@ class VelibScraper:
         # Use Paris time for everything
         timestamp = get_paris_time()
         
+        # Partition DDL must run before this session takes the write lock
+        ensure_current_partitions(timestamp)
+        
+        # After an outage thousands of bikes move at once - apply that state in bulk
+        previous_scrape = scrape_generation.last_updated()
+        if previous_scrape and timestamp - previous_scrape > self.gap_threshold:
+            return self._reconcile_after_gap(station_data_list, timestamp, previous_scrape)
+        
         # Track bikes seen in this update
         seen_bike_ids = set()
         station_bikes_current = {}  # {station_id: set(bike_names)}
         
+        # Append-only rows, written to their daily partitions in bulk
+        movement_rows = []
+        snapshot_rows = []
+        
         for data in station_data_list:
-            station_info = data['station']
-            station_code = station_info['code']
-            
-            # Update or create station with error handling
-            station = Station.query.filter_by(code=station_code).first()
+            station = self._update_station(data, timestamp)
             if not station:
-                try:
-                    station = Station(
-                        code=station_code,
-                        name=station_info['name'],
-                        latitude=station_info['gps']['latitude'],
-                        longitude=station_info['gps']['longitude'],
-                        station_type=station_info.get('stationType', 'PUBLIC'),
-                        state=station_info.get('state', 'Operative')
-                    )
-                    db.session.add(station)
-                    db.session.flush()  # Get station ID
-                except Exception as e:
-                    # Station might have been created by another process
-                    db.session.rollback()
-                    station = Station.query.filter_by(code=station_code).first()
-                    if not station:
-                        logger.error(f"Failed to create or find station {station_code}: {e}")
-                        continue
-            
-            # Update station metrics
-            station.nb_bike = data.get('nbBike', 0)
-            station.nb_ebike = data.get('nbEbike', 0)
-            station.nb_free_dock = data.get('nbFreeDock', 0)
-            station.nb_free_edock = data.get('nbFreeEDock', 0)
-            station.total_capacity = data.get('nbDock', 0) + data.get('nbEDock', 0)
-            station.credit_card = data.get('creditCard', 'no') == 'yes'
-            station.kiosk_state = data.get('kioskState', 'no')
-            station.updated_at = timestamp
+                continue
             
             # Process bikes at this station
             bikes_at_station = set()
@@ -123,48 +113,50 @@ class VelibScraper:
                 # Track precise bike movements
                 if bike.current_station_id != station.id:
                     station_changed = True
+                    # When the departure was first noticed - it happened after last_seen_at
+                    departure_noticed_at = bike.left_station_at
                     
-                    # If bike was at a different station, record departure from old station
+                    # Bike went straight to another station between two scrapes -
+                    # it was last seen docked at the old one at last_seen_at
                     if bike.current_station_id is not None:
-                        departure = BikeMovement(
+                        departure_noticed_at = timestamp
+                        movement_rows.append(dict(
                             bike_id=bike.id,
                             event_type='departed',
                             station_id=bike.current_station_id,
-                            timestamp=bike.left_station_at or timestamp,  # Use precise time if available
+                            timestamp=bike.last_seen_at,
                             bike_status=bike.current_status
-                        )
-                        db.session.add(departure)
-                        bike.left_station_at = timestamp
+                        ))
+                        bike.left_station_at = bike.last_seen_at
                         bike.previous_station_id = bike.current_station_id
                     
                     # Record arrival at new station
-                    arrival = BikeMovement(
+                    movement_rows.append(dict(
                         bike_id=bike.id,
                         event_type='arrived',
                         station_id=station.id,
                         timestamp=timestamp,
                         dock_position=current_dock_position,
                         bike_status=current_bike_status
-                    )
-                    db.session.add(arrival)
+                    ))
                     bike.arrived_at_station = timestamp
                     
                     # Create trip if we have both departure and arrival
                     if bike.previous_station_id and bike.left_station_at:
-                        self._create_trip_from_movement(bike, timestamp)
+                        bike.current_station_id = station.id  # The trip ends here
+                        self._create_trip_from_movement(bike, timestamp, departure_noticed_at)
                 
                 elif bike.arrived_at_station is None:
                     # Handle initial state - bike was already at station when we started tracking
                     bike.arrived_at_station = timestamp
-                    arrival = BikeMovement(
+                    movement_rows.append(dict(
                         bike_id=bike.id,
                         event_type='arrived',
                         station_id=station.id,
                         timestamp=timestamp,
                         dock_position=current_dock_position,
                         bike_status=current_bike_status
-                    )
-                    db.session.add(arrival)
+                    ))
                 
                 # Update bike current status
                 bike.current_station_id = station.id
@@ -173,65 +165,288 @@ class VelibScraper:
                 
                 # Only create snapshot if something meaningful changed
                 if needs_snapshot:
-                    snapshot = BikeSnapshot(
-                        bike_id=bike.id,
-                        station_id=station.id,
-                        timestamp=timestamp,
-                        bike_status=current_bike_status,
-                        dock_position=current_dock_position,
-                        bike_rate=current_bike_rate,
-                        number_of_rates=bike_data.get('numberOfRates', 0),
-                        bike_block_cause=bike_data.get('bikeBlockCause', '')
-                    )
-                    
-                    # Parse last rate date if available
-                    if bike_data.get('lastRateDate'):
-                        try:
-                            snapshot.last_rate_date = datetime.fromisoformat(
-                                bike_data['lastRateDate'].replace('Z', '+00:00')
-                            )
-                        except:
-                            pass
-                    
-                    db.session.add(snapshot)
+                    snapshot_rows.append(self._snapshot_row(bike.id, station.id, bike_data, timestamp))
             
             station_bikes_current[station.id] = bikes_at_station
         
+        # Every bike seen above now has last_seen_at == timestamp
+        db.session.flush()
+        
+        # Mark bikes not seen as potentially in transit or missing
+        self._mark_unseen_bikes(timestamp, movement_rows)
+        
+        bike_movements.insert(movement_rows)
+        bike_snapshots.insert(snapshot_rows)
+        
         # Store current state in database for trip detection
         self._store_station_state_in_db(station_bikes_current, timestamp)
         
-        # Mark bikes not seen as potentially in transit or missing
-        all_bikes = Bike.query.filter(Bike.current_status.in_(['disponible', 'indisponible'])).all()
-        for bike in all_bikes:
-            if bike.bike_name not in seen_bike_ids:
-                time_since_last_seen = (timestamp - bike.last_seen_at).total_seconds()
-                if time_since_last_seen < 10800:  # 3 hours
-                    bike.current_status = 'in_transit'
-                else:
-                    bike.current_status = 'missing'
-                bike.current_station_id = None
-        
-        db.session.commit()
+        self._commit_scrape(timestamp)
         logger.info(f"Updated {len(station_data_list)} stations and {len(seen_bike_ids)} bikes")
     
+    def _update_station(self, data: Dict, timestamp: datetime, stations: Dict[str, Station] = None) -> Optional[Station]:
+        """Create or refresh a station from its API entry"""
+        station_info = data['station']
+        station_code = station_info['code']
+        
+        # Update or create station with error handling
+        if stations is not None:
+            station = stations.get(station_code)
+        else:
+            station = Station.query.filter_by(code=station_code).first()
+        if not station:
+            # Only the leader writes, so no other process can have created it meanwhile.
+            # A failure here fails the whole scrape rather than rolling back its writes
+            station = Station(
+                code=station_code,
+                name=station_info['name'],
+                latitude=station_info['gps']['latitude'],
+                longitude=station_info['gps']['longitude'],
+                station_type=station_info.get('stationType', 'PUBLIC'),
+                state=station_info.get('state', 'Operative')
+            )
+            db.session.add(station)
+            db.session.flush()  # Get station ID
+            if stations is not None:
+                stations[station_code] = station
+        
+        previous_state = dynamic_state(station)
+        
+        # Update station metrics
+        station.nb_bike = data.get('nbBike', 0)
+        station.nb_ebike = data.get('nbEbike', 0)
+        station.nb_free_dock = data.get('nbFreeDock', 0)
+        station.nb_free_edock = data.get('nbFreeEDock', 0)
+        station.total_capacity = data.get('nbDock', 0) + data.get('nbEDock', 0)
+        station.credit_card = data.get('creditCard', 'no') == 'yes'
+        station.kiosk_state = data.get('kioskState', 'no')
+        station.updated_at = timestamp
+        if dynamic_state(station) != previous_state:
+            self.changed_stations.add(station.id)
+        return station
+    
+    def _snapshot_row(self, bike_id: int, station_id: int, bike_data: Dict, timestamp: datetime) -> Dict:
+        """Snapshot row for a bike as reported by the API"""
+        snapshot = dict(
+            bike_id=bike_id,
+            station_id=station_id,
+            timestamp=timestamp,
+            bike_status=bike_data.get('bikeStatus', 'unknown'),
+            dock_position=bike_data.get('dockPosition'),
+            bike_rate=bike_data.get('bikeRate'),
+            number_of_rates=bike_data.get('numberOfRates', 0),
+            bike_block_cause=bike_data.get('bikeBlockCause', ''),
+            last_rate_date=None
+        )
+        
+        # Parse last rate date if available
+        if bike_data.get('lastRateDate'):
+            try:
+                snapshot['last_rate_date'] = datetime.fromisoformat(
+                    bike_data['lastRateDate'].replace('Z', '+00:00')
+                )
+            except:
+                pass
+        
+        return snapshot
+    
+    def _mark_unseen_bikes(self, timestamp: datetime, movement_rows: List[Dict]) -> int:
+        """
+        Move docked bikes missing from this scrape to in_transit (or missing
+        after 3 hours) with set-based statements, recording their departure.
+        """
+        unseen = and_(Bike.current_status.in_(['disponible', 'indisponible']),
+                      Bike.last_seen_at < timestamp)
+        docked = Bike.current_station_id.isnot(None)
+        
+        departed = db.session.execute(
+            select(Bike.id, Bike.current_station_id, Bike.current_status).where(unseen, docked)
+        ).all()
+        for row in departed:
+            movement_rows.append(dict(
+                bike_id=row.id,
+                event_type='departed',
+                station_id=row.current_station_id,
+                timestamp=timestamp,
+                bike_status=row.current_status
+            ))
+        
+        # The departure is stamped when first noticed, like arrivals
+        result = db.session.execute(
+            update(Bike).where(unseen).values(
+                previous_station_id=case((docked, Bike.current_station_id), else_=Bike.previous_station_id),
+                left_station_at=case((docked, timestamp), else_=Bike.left_station_at),
+                current_status=case((Bike.last_seen_at > timestamp - timedelta(hours=3), 'in_transit'),
+                                    else_='missing'),
+                current_station_id=None
+            ).execution_options(synchronize_session=False)
+        )
+        return result.rowcount
+    
+    def _reconcile_after_gap(self, station_data_list: List[Dict], timestamp: datetime, previous_scrape: datetime):
+        """
+        Apply a scrape that follows an outage in one pass.
+        
+        Bikes are loaded with a single query and written back with one bulk
+        UPDATE and one bulk INSERT instead of a round trip per bike. Every move
+        observed here happened somewhere inside the gap, so the resulting trips
+        are flagged as low-confidence.
+        """
+        logger.warning(f"Scrape gap of {timestamp - previous_scrape} since {previous_scrape}, "
+                       f"reconciling {len(station_data_list)} stations in bulk")
+        
+        stations = {station.code: station for station in Station.query.all()}
+        stations_by_id = {}
+        observed = {}  # {bike_name: (station, bike_data)}
+        station_bikes_current = {}
+        
+        for data in station_data_list:
+            station = self._update_station(data, timestamp, stations)
+            if not station:
+                continue
+            stations_by_id[station.id] = station
+            bikes_at_station = set()
+            for bike_data in data.get('bikes', []):
+                observed[bike_data['bikeName']] = (station, bike_data)
+                bikes_at_station.add(bike_data['bikeName'])
+            station_bikes_current[station.id] = bikes_at_station
+        
+        columns = (Bike.id, Bike.bike_name, Bike.current_station_id, Bike.current_status, Bike.last_seen_at,
+                   Bike.arrived_at_station, Bike.previous_station_id, Bike.left_station_at,
+                   Bike.total_trips, Bike.total_distance, Bike.total_duration, Bike.boomerang_count)
+        known = {row.bike_name: row for row in db.session.execute(select(*columns)).all()}
+        
+        movement_rows = []
+        snapshot_rows = []
+        bike_updates = []
+        trips = []
+        
+        # Bikes never seen before are inserted already docked
+        new_names = [name for name in observed if name not in known]
+        if new_names:
+            new_bikes = db.session.execute(
+                insert(Bike).returning(Bike.id, Bike.bike_name),
+                [dict(
+                    bike_name=name,
+                    bike_electric=(observed[name][1].get('bikeElectric', 'no') == 'yes'),
+                    current_station_id=observed[name][0].id,
+                    current_status=observed[name][1].get('bikeStatus', 'unknown'),
+                    last_seen_at=timestamp,
+                    arrived_at_station=timestamp
+                ) for name in new_names]
+            ).all()
+            for row in new_bikes:
+                station, bike_data = observed[row.bike_name]
+                movement_rows.append(dict(bike_id=row.id, event_type='arrived', station_id=station.id,
+                                          timestamp=timestamp, dock_position=bike_data.get('dockPosition'),
+                                          bike_status=bike_data.get('bikeStatus', 'unknown')))
+                snapshot_rows.append(self._snapshot_row(row.id, station.id, bike_data, timestamp))
+        
+        for name, (station, bike_data) in observed.items():
+            row = known.get(name)
+            if row is None:
+                continue
+            
+            status = bike_data.get('bikeStatus', 'unknown')
+            values = dict(
+                id=row.id,
+                current_station_id=station.id,
+                current_status=status,
+                last_seen_at=timestamp,
+                arrived_at_station=row.arrived_at_station,
+                previous_station_id=row.previous_station_id,
+                left_station_at=row.left_station_at,
+                total_trips=row.total_trips or 0,
+                total_distance=row.total_distance or 0,
+                total_duration=row.total_duration or 0,
+                boomerang_count=row.boomerang_count or 0
+            )
+            
+            moved = row.current_station_id != station.id
+            if moved or row.arrived_at_station is None:
+                if moved and row.current_station_id is not None:
+                    # Left its station at some point during the gap
+                    movement_rows.append(dict(bike_id=row.id, event_type='departed',
+                                              station_id=row.current_station_id,
+                                              timestamp=row.last_seen_at, bike_status=row.current_status))
+                    values['previous_station_id'] = row.current_station_id
+                    values['left_station_at'] = row.last_seen_at
+                
+                movement_rows.append(dict(bike_id=row.id, event_type='arrived', station_id=station.id,
+                                          timestamp=timestamp, dock_position=bike_data.get('dockPosition'),
+                                          bike_status=status))
+                values['arrived_at_station'] = timestamp
+                
+                if moved and values['previous_station_id'] and values['left_station_at']:
+                    trip = Trip(
+                        bike_id=row.id,
+                        start_station_id=values['previous_station_id'],
+                        end_station_id=station.id,
+                        start_station=stations_by_id.get(values['previous_station_id']) or
+                                      db.session.get(Station, values['previous_station_id']),
+                        end_station=station,
+                        start_time=values['left_station_at'],
+                        end_time=timestamp,
+                        low_confidence=True
+                    )
+                    db.session.add(trip)
+                    trip.calculate_metrics()
+                    trips.append(trip)
+                    
+                    values['total_trips'] += 1
+                    values['total_distance'] += trip.distance or 0
+                    values['total_duration'] += trip.duration or 0
+                    values['boomerang_count'] += 1 if trip.is_boomerang else 0
+            
+            if moved or row.current_status != status or \
+                    abs((timestamp - row.last_seen_at).total_seconds()) > 3600:
+                snapshot_rows.append(self._snapshot_row(row.id, station.id, bike_data, timestamp))
+            
+            bike_updates.append(values)
+        
+        if bike_updates:
+            db.session.execute(update(Bike), bike_updates)
+        
+        # Folded into the in-memory stats only once the trips are committed
+        samples = [bike_stats.trip_sample(trip) for trip in trips]
+        write_behind.after_commit(lambda: bike_stats.record_samples(samples))
+        
+        self._mark_unseen_bikes(timestamp, movement_rows)
+        
+        bike_movements.insert(movement_rows)
+        bike_snapshots.insert(snapshot_rows)
+        self._store_station_state_in_db(station_bikes_current, timestamp)
+        
+        self._commit_scrape(timestamp)
+        logger.info(f"Reconciled {len(observed)} bikes after gap: {len(bike_updates)} updated, "
+                    f"{len(new_names)} new, {len(trips)} low-confidence trips")
+    
     def _store_station_state_in_db(self, station_bikes: Dict[int, Set[str]], timestamp: datetime):
         """Store current station state in database for trip detection"""
-        # Clean up old states (older than 24 hours)
-        cutoff = timestamp - timedelta(hours=24)
-        db.session.query(StationState).filter(StationState.timestamp < cutoff).delete()
-        
         # Store current state for each station
-        for station_id, bikes in station_bikes.items():
-            state = StationState(
+        station_states.insert([
+            dict(
                 timestamp=timestamp,
                 station_id=station_id,
                 bike_names=json.dumps(list(bikes))
             )
-            db.session.add(state)
-        
-        db.session.commit()
+            for station_id, bikes in station_bikes.items()
+        ])
     
-    def _create_trip_from_movement(self, bike: Bike, arrival_time: datetime):
+    def _commit_scrape(self, timestamp: datetime):
+        """Commit the scrape in one transaction, then publish it"""
+        # The change log is written with the scrape, tagged with the generation it publishes
+        record_station_changes(scrape_generation.current() + 1, timestamp, self.changed_stations,
+                               scrape_generation.last_updated())
+        self.changed_stations = set()
+        write_behind.commit()
+        # Clean up old states (older than 24 hours) - only drops a partition once a day has expired.
+        # Done before the bump, which tells other processes to re-read their partition lists.
+        # Separate callbacks, so a failed drop is logged and the scrape is still published
+        write_behind.after_commit(lambda: station_states.drop_before(timestamp - timedelta(hours=24)))
+        write_behind.after_commit(lambda: scrape_generation.bump(timestamp))
+    
+    def _create_trip_from_movement(self, bike: Bike, arrival_time: datetime, departure_noticed_at: datetime):
         """Create a trip record from precise movement data"""
         if not bike.previous_station_id or not bike.left_station_at:
             return
@@ -248,13 +463,19 @@ class VelibScraper:
         if existing_trip:
             return
         
-        # Create new trip with precise timing
+        # Create new trip with precise timing - the departure is only as precise as
+        # the scrape that noticed it. A bike swept to in_transit by the bulk pass after
+        # a gap, or one not seen for a while, went unobserved longer than a gap
+        unobserved = departure_noticed_at - bike.last_seen_at if bike.last_seen_at else None
         trip = Trip(
             bike_id=bike.id,
             start_station_id=bike.previous_station_id,
             end_station_id=bike.current_station_id,
+            start_station=db.session.get(Station, bike.previous_station_id),
+            end_station=db.session.get(Station, bike.current_station_id),
             start_time=bike.left_station_at,
-            end_time=arrival_time
+            end_time=arrival_time,
+            low_confidence=unobserved is not None and unobserved > self.gap_threshold
         )
         
         # Calculate metrics using the Trip model's method
@@ -270,20 +491,24 @@ class VelibScraper:
             bike.boomerang_count += 1
         
         db.session.add(trip)
+        # Folded into the in-memory stats only once the trip is committed
+        sample = bike_stats.trip_sample(trip)
+        write_behind.after_commit(lambda: bike_stats.record_samples([sample]))
         
         logger.info(f"Created precise trip for bike {bike.bike_name}: "
                    f"{trip.start_station.name if trip.start_station else 'Unknown'} -> "
                    f"{trip.end_station.name if trip.end_station else 'Unknown'}, "
-                   f"duration: {trip.duration}s, distance: {trip.distance:.2f if trip.distance else 0}km")
+                   f"duration: {trip.duration}s, distance: {(trip.distance or 0):.2f}km")
     
     def run_update(self):
         """Main update method to be called periodically"""
-        try:
-            station_data = self.fetch_all_stations()
-            if station_data:
-                self.update_stations_and_bikes(station_data)
-                return True
+        station_data = self.fetch_all_stations()
+        if not station_data:
             return False
+        try:
+            self.update_stations_and_bikes(station_data)
         except Exception as e:
+            # Raised so the queue task's unit rolls the whole scrape back
             logger.error(f"Error in update cycle: {e}")
-            return False
\ No newline at end of file
+            raise
+        return True
\ No newline at end of file
@@ -0,0 +1,357 @@
+import os
+import struct
+import threading
+import logging
+from array import array
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from flask import current_app
+from app.utils.scrape_generation import scrape_generation
+from app.utils.timezone import get_paris_time
+
+logger = logging.getLogger(__name__)
+
+
+class BikeStatsStore:
+    """
+    Streaming per-bike trip statistics kept in flat arrays indexed by bike id.
+
+    Every trip updates the store in O(1): an EWMA of the trip speed, a rolling
+    3-day count of speed samples (daily buckets) and a rolling 24h boomerang
+    count (hourly buckets). Malfunction detection then only compares the
+    current state against its thresholds instead of re-aggregating trips.
+
+    The leader records trips and saves the file. Other processes re-read
+    the file when the scrape generation moves and the file changed. An EWMA
+    cannot give a trip back, so removing trips calls `invalidate()`. The
+    store is then rebuilt from the database on its next access.
+    """
+
+    MAGIC = b'VLBS'
+    VERSION = 1
+
+    SPEED_ALPHA = 0.3  # Weight of the newest trip in the speed EWMA
+    MIN_SPEED_TRIP_DURATION = 300  # Same 5 minute filter as the low speed rule
+    SPEED_WINDOW_DAYS = 3
+    BOOMERANG_WINDOW_HOURS = 24
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dirty = False
+        self.size = 0
+        self.generation = None  # Scrape generation the file was last checked at
+        self.file_version = None  # (mtime, size) of the file as last loaded or saved
+
+        # Per-bike scalar state
+        self.ewma_speed = array('d')
+        self.last_trip_at = array('d')  # Epoch seconds of the latest recorded trip
+
+        # Per-bike ring buffers, flattened as [bike_id * width + slot]
+        self.speed_days = array('H')
+        self.speed_day_head = array('q')  # Absolute day index of the newest bucket
+        self.boomerang_hours = array('H')
+        self.boomerang_hour_head = array('q')  # Absolute hour index of the newest bucket
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+
+    @classmethod
+    def trip_sample(cls, trip) -> Optional[tuple]:
+        """
+        The fields of a trip the store folds in, read while the trip is loaded.
+
+        Writers take the sample when they add the trip and record it with
+        write_behind.after_commit(), so a rolled back trip never reaches the store.
+        """
+        if trip.bike_id is None or trip.start_time is None:
+            return None
+        return (trip.bike_id, cls._epoch(trip.start_time), trip.duration, trip.avg_speed, trip.is_boomerang)
+
+    def record_samples(self, samples):
+        """Fold samples from trip_sample() into the bikes' statistics"""
+        samples = [sample for sample in samples if sample is not None]
+        if not samples:
+            return
+
+        self._ensure_loaded()
+        with self.lock:
+            for sample in samples:
+                self._record(*sample)
+
+    def _record(self, bike_id, epoch, duration, avg_speed, is_boomerang):
+        self._grow(bike_id + 1)
+
+        if avg_speed is not None and duration and duration > self.MIN_SPEED_TRIP_DURATION:
+            day = int(epoch // 86400)
+            self._advance(self.speed_days, self.speed_day_head, bike_id, day, self.SPEED_WINDOW_DAYS)
+            if self._window_count(self.speed_days, self.speed_day_head, bike_id, day, self.SPEED_WINDOW_DAYS) == 0:
+                # First sample in the window - start the average from scratch
+                self.ewma_speed[bike_id] = avg_speed
+            else:
+                alpha = self.SPEED_ALPHA
+                self.ewma_speed[bike_id] = alpha * avg_speed + (1 - alpha) * self.ewma_speed[bike_id]
+            self._increment(self.speed_days, self.speed_day_head, bike_id, day, self.SPEED_WINDOW_DAYS)
+
+        if is_boomerang:
+            hour = int(epoch // 3600)
+            self._advance(self.boomerang_hours, self.boomerang_hour_head, bike_id, hour, self.BOOMERANG_WINDOW_HOURS)
+            self._increment(self.boomerang_hours, self.boomerang_hour_head, bike_id, hour, self.BOOMERANG_WINDOW_HOURS)
+
+        self.last_trip_at[bike_id] = max(self.last_trip_at[bike_id], epoch)
+        self.dirty = True
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def boomerang_count(self, bike_id, now=None) -> int:
+        """Boomerangs recorded for a bike over the last 24 hours"""
+        self._ensure_loaded()
+        hour = int(self._epoch(now or get_paris_time()) // 3600)
+        with self.lock:
+            if bike_id >= self.size:
+                return 0
+            return self._window_count(self.boomerang_hours, self.boomerang_hour_head, bike_id,
+                                      hour, self.BOOMERANG_WINDOW_HOURS)
+
+    def boomerang_offenders(self, threshold, now=None) -> List[Tuple[int, int]]:
+        """Return (bike_id, boomerang_count) for bikes at or above the threshold"""
+        self._ensure_loaded()
+        hour = int(self._epoch(now or get_paris_time()) // 3600)
+        offenders = []
+        with self.lock:
+            for bike_id in range(self.size):
+                if hour - self.boomerang_hour_head[bike_id] >= self.BOOMERANG_WINDOW_HOURS:
+                    continue
+                count = self._window_count(self.boomerang_hours, self.boomerang_hour_head, bike_id,
+                                           hour, self.BOOMERANG_WINDOW_HOURS)
+                if count >= threshold:
+                    offenders.append((bike_id, count))
+        return offenders
+
+    def low_speed_candidates(self, speed_threshold, min_trips=3, now=None) -> List[Tuple[int, float, int]]:
+        """Return (bike_id, ewma_speed, recent_trip_count) for slow bikes with enough recent trips"""
+        self._ensure_loaded()
+        day = int(self._epoch(now or get_paris_time()) // 86400)
+        candidates = []
+        with self.lock:
+            for bike_id in range(self.size):
+                if day - self.speed_day_head[bike_id] >= self.SPEED_WINDOW_DAYS:
+                    continue
+                if self.ewma_speed[bike_id] >= speed_threshold:
+                    continue
+                count = self._window_count(self.speed_days, self.speed_day_head, bike_id,
+                                           day, self.SPEED_WINDOW_DAYS)
+                if count >= min_trips:
+                    candidates.append((bike_id, self.ewma_speed[bike_id], count))
+        return candidates
+
+    def get(self, bike_id, now=None) -> dict:
+        """Current statistics for a single bike"""
+        self._ensure_loaded()
+        now = now or get_paris_time()
+        epoch = self._epoch(now)
+        with self.lock:
+            if bike_id >= self.size:
+                return {'ewma_speed': None, 'recent_trips': 0, 'boomerangs_24h': 0}
+            recent = self._window_count(self.speed_days, self.speed_day_head, bike_id,
+                                        int(epoch // 86400), self.SPEED_WINDOW_DAYS)
+            return {
+                'ewma_speed': round(self.ewma_speed[bike_id], 2) if recent else None,
+                'recent_trips': recent,
+                'boomerangs_24h': self._window_count(self.boomerang_hours, self.boomerang_hour_head, bike_id,
+                                                     int(epoch // 3600), self.BOOMERANG_WINDOW_HOURS)
+            }
+
+    # ------------------------------------------------------------------
+    # Ring buffer helpers
+    # ------------------------------------------------------------------
+
+    def _advance(self, buckets, heads, bike_id, index, width):
+        """Move a bike's ring forward to `index`, clearing the slots that fell out of the window"""
+        head = heads[bike_id]
+        if index <= head:
+            return
+        base = bike_id * width
+        if index - head >= width:
+            for slot in range(width):
+                buckets[base + slot] = 0
+        else:
+            for step in range(head + 1, index + 1):
+                buckets[base + step % width] = 0
+        heads[bike_id] = index
+
+    def _increment(self, buckets, heads, bike_id, index, width):
+        # Late trips older than the window are ignored, trips within it land in their own slot
+        if index <= heads[bike_id] - width:
+            return
+        slot = bike_id * width + index % width
+        if buckets[slot] < 0xFFFF:
+            buckets[slot] += 1
+
+    def _window_count(self, buckets, heads, bike_id, index, width) -> int:
+        """Sum of the slots covering (index - width, index]"""
+        head = heads[bike_id]
+        age = index - head
+        if age >= width:
+            return 0
+        base = bike_id * width
+        total = 0
+        # Slots newer than `head` were never written, older ones may still be in the window
+        for offset in range(width - max(age, 0)):
+            total += buckets[base + (head - offset) % width]
+        return total
+
+    def _grow(self, size):
+        if size <= self.size:
+            return
+        extra = size - self.size
+        self.ewma_speed.extend([0.0] * extra)
+        self.last_trip_at.extend([0.0] * extra)
+        self.speed_days.extend([0] * (extra * self.SPEED_WINDOW_DAYS))
+        self.speed_day_head.extend([-self.SPEED_WINDOW_DAYS] * extra)
+        self.boomerang_hours.extend([0] * (extra * self.BOOMERANG_WINDOW_HOURS))
+        self.boomerang_hour_head.extend([-self.BOOMERANG_WINDOW_HOURS] * extra)
+        self.size = size
+
+    @staticmethod
+    def _epoch(dt: datetime) -> float:
+        # Trip timestamps are naive, treat them as UTC for bucketing only
+        return (dt - datetime(1970, 1, 1)).total_seconds()
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+
+    def _resolve_path(self):
+        if self.path:
+            return self.path
+        return os.environ.get('BIKE_STATS_PATH',
+                              os.path.join(current_app.instance_path, 'bike_stats.bin'))
+
+    def _ensure_loaded(self):
+        generation = scrape_generation.current()
+        if self.loaded and generation == self.generation:
+            return
+        with self.lock:
+            if self.loaded and generation == self.generation:
+                return
+            self.path = self._resolve_path()
+            if not self.loaded:
+                if not self._load_file():
+                    self._warm_from_database()
+                self.loaded = True
+            elif self._file_version() != self.file_version:
+                # Saved by the leader since this process read it
+                self._clear()
+                if not self._load_file():
+                    self._warm_from_database()
+            self.generation = generation
+
+    def _file_version(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _clear(self):
+        self.dirty = False
+        self.size = 0
+        for arr, _ in self._persisted_arrays():
+            del arr[:]
+
+    def _load_file(self) -> bool:
+        self.file_version = self._file_version()
+        if self.file_version is None:
+            return False
+        try:
+            with open(self.path, 'rb') as f:
+                magic, version, size = struct.unpack('<4sII', f.read(12))
+                if magic != self.MAGIC or version != self.VERSION:
+                    logger.warning(f"Ignoring incompatible bike statistics file {self.path}")
+                    return False
+                self._grow(size)
+                for arr, width in self._persisted_arrays():
+                    values = array(arr.typecode)
+                    values.fromfile(f, size * width)
+                    arr[:] = values
+            logger.info(f"Loaded streaming statistics for {size} bikes from {self.path}")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to load bike statistics from {self.path}: {e}")
+            self._clear()
+            return False
+
+    def _warm_from_database(self):
+        """Rebuild the store from the trips still inside the statistics windows"""
+        from app import db
+        from app.models import Trip
+
+        cutoff = get_paris_time() - timedelta(days=self.SPEED_WINDOW_DAYS)
+        rows = db.session.query(
+            Trip.bike_id, Trip.start_time, Trip.duration, Trip.avg_speed, Trip.is_boomerang
+        ).filter(Trip.start_time >= cutoff).order_by(Trip.start_time).yield_per(5000)
+
+        count = 0
+        for row in rows:
+            self._record(row.bike_id, self._epoch(row.start_time), row.duration, row.avg_speed, row.is_boomerang)
+            count += 1
+
+        self.dirty = True
+        logger.info(f"Warmed streaming bike statistics from {count} recent trips")
+
+    def _persisted_arrays(self):
+        return [
+            (self.ewma_speed, 1),
+            (self.last_trip_at, 1),
+            (self.speed_days, self.SPEED_WINDOW_DAYS),
+            (self.speed_day_head, 1),
+            (self.boomerang_hours, self.BOOMERANG_WINDOW_HOURS),
+            (self.boomerang_hour_head, 1),
+        ]
+
+    def save(self):
+        """Persist the store atomically if it changed since the last save"""
+        if not self.loaded or not self.dirty:
+            return
+        with self.lock:
+            tmp_path = f"{self.path}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(tmp_path, 'wb') as f:
+                    f.write(struct.pack('<4sII', self.MAGIC, self.VERSION, self.size))
+                    for arr, _ in self._persisted_arrays():
+                        arr.tofile(f)
+                os.replace(tmp_path, self.path)
+                self.file_version = self._file_version()
+                self.dirty = False
+            except Exception as e:
+                logger.error(f"Failed to save bike statistics to {self.path}: {e}")
+
+    def unload(self):
+        """Drop the in-memory state, the next access loads the file again"""
+        with self.lock:
+            self.loaded = False
+            self._clear()
+
+    def invalidate(self):
+        """Forget the state after trips were removed, the next access warms it from the database"""
+        with self.lock:
+            self.loaded = False
+            self._clear()
+            path = self._resolve_path()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Failed to remove bike statistics file {path}: {e}")
+        logger.info("Bike statistics invalidated, rebuilding from the database on next use")
+
+
+# Global store instance
+bike_stats = BikeStatsStore()
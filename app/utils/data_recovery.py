@@ -1,8 +1,16 @@
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import List, Dict
-from sqlalchemy import func, and_, or_
+from sqlalchemy import func, and_, or_, case, select, update, delete, union_all
 from app import db
-from app.models import Bike, Trip, Station, StationState, BikeSnapshot, MalfunctionLog
+from app.models import Bike, Trip, Station, MalfunctionLog
+from app.utils.retention import purge_expired
+from app.utils.partitions import bike_snapshots, station_states
+from app.utils.scrape_generation import scrape_generation
+from app.utils.rollups import trip_rollups
+from app.utils.bike_stats import bike_stats
+from app.utils.write_behind import write_behind
 import logging
 
 logger = logging.getLogger(__name__)
@@ -11,10 +19,15 @@ logger = logging.getLogger(__name__)
 class DataRecovery:
     """Handle data cleanup and recovery for when the scraper was offline"""
     
+    # Health report shared by all instances, recomputed after each scrape or once the TTL expires
+    _report_cache = None
+    _report_lock = threading.Lock()
+    
     def __init__(self):
         self.max_trip_duration = 8 * 3600  # 8 hours max realistic trip
         self.missing_threshold = 24 * 3600  # 24 hours before marking as missing
         self.cleanup_age = 7 * 24 * 3600  # 7 days for old data cleanup
+        self.report_ttl = 15  # Seconds a cached health report stays valid
         
     def run_full_recovery(self):
         """Run all recovery procedures"""
@@ -32,13 +45,16 @@ class DataRecovery:
         # 4. Clean up old snapshots
         self.cleanup_old_snapshots()
         
-        # 5. Resolve orphaned malfunctions
+        # 5. Clean up old bike movements
+        self.cleanup_old_movements()
+        
+        # 6. Resolve orphaned malfunctions
         self.cleanup_orphaned_malfunctions()
         
-        # 6. Update bike statistics
+        # 7. Update bike statistics
         self.recalculate_bike_statistics()
         
-        # 7. Mark truly missing bikes
+        # 8. Mark truly missing bikes
         self.mark_missing_bikes()
         
         db.session.commit()
@@ -69,8 +85,8 @@ class DataRecovery:
             or_(
                 Trip.duration < 0,
                 Trip.duration > self.max_trip_duration,
-                Trip.distance.isnot(None) and (Trip.distance < 0),
-                Trip.distance.isnot(None) and (Trip.distance > 100)  # 100km max realistic
+                and_(Trip.distance.isnot(None), Trip.distance < 0),
+                and_(Trip.distance.isnot(None), Trip.distance > 100)  # 100km max realistic
             )
         ).all()
         
@@ -80,67 +96,87 @@ class DataRecovery:
             logger.warning(f"Removing impossible trip for bike {trip.bike.bike_name}: "
                          f"duration={trip.duration}s, distance={trip.distance}km")
             db.session.delete(trip)
+        
+        removed_count = len(incomplete_trips) + len(impossible_trips)
+        if removed_count:
+            # The per-bike statistics cannot subtract trips, rebuild them once the deletes are committed
+            write_behind.after_commit(bike_stats.invalidate)
+        return removed_count
     
     def fix_stuck_in_transit_bikes(self):
-        """Fix bikes that are stuck in 'in_transit' status for too long"""
+        """Fix bikes that are stuck in 'in_transit' status for too long, in two set-based UPDATEs"""
         cutoff = datetime.utcnow() - timedelta(seconds=self.max_trip_duration)
         
-        stuck_bikes = Bike.query.filter(
-            and_(
-                Bike.current_status == 'in_transit',
-                Bike.last_seen_at < cutoff
-            )
-        ).all()
+        stuck = and_(Bike.current_status == 'in_transit', Bike.last_seen_at < cutoff)
         
-        logger.info(f"Found {len(stuck_bikes)} bikes stuck in transit")
+        # Only snapshots newer than the cutoff can relocate a bike
+        snapshots = bike_snapshots.select(cutoff)
         
-        for bike in stuck_bikes:
-            # Check if we have recent snapshots to determine actual location
-            recent_snapshot = BikeSnapshot.query.filter_by(bike_id=bike.id)\
-                                               .order_by(BikeSnapshot.timestamp.desc())\
-                                               .first()
-            
-            if recent_snapshot and recent_snapshot.timestamp > cutoff:
-                # Bike was seen recently at a station
-                bike.current_station_id = recent_snapshot.station_id
-                bike.current_status = recent_snapshot.bike_status or 'disponible'
-                bike.last_seen_at = recent_snapshot.timestamp
-                logger.info(f"Recovered bike {bike.bike_name} to station {recent_snapshot.station_id}")
-            else:
-                # Mark as missing
-                bike.current_status = 'missing'
-                bike.current_station_id = None
-                logger.warning(f"Marked bike {bike.bike_name} as missing (stuck in transit)")
+        def latest(column):
+            # Value from the bike's most recent snapshot, correlated to the bike being updated
+            return select(column).where(snapshots.c.bike_id == Bike.id)\
+                                 .order_by(snapshots.c.timestamp.desc()).limit(1).scalar_subquery()
+        
+        has_recent_snapshot = select(snapshots.c.id).where(snapshots.c.bike_id == Bike.id).exists()
+        
+        # Bikes seen recently at a station go back to it
+        recovered = db.session.execute(
+            update(Bike).where(stuck, has_recent_snapshot).values(
+                current_station_id=latest(snapshots.c.station_id),
+                current_status=func.coalesce(latest(snapshots.c.bike_status), 'disponible'),
+                last_seen_at=latest(snapshots.c.timestamp)
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        
+        # The rest are marked as missing
+        missing = db.session.execute(
+            update(Bike).where(stuck).values(
+                current_status='missing',
+                current_station_id=None
+            ).execution_options(synchronize_session=False)
+        ).rowcount
+        
+        db.session.expire_all()
+        
+        logger.info(f"Fixed {recovered + missing} bikes stuck in transit: "
+                    f"{recovered} recovered from snapshots, {missing} marked as missing")
+        return recovered + missing
     
     def cleanup_old_station_states(self):
         """Remove old station state records to save space"""
         cutoff = datetime.utcnow() - timedelta(seconds=self.cleanup_age)
         
-        old_states = StationState.query.filter(StationState.timestamp < cutoff)
-        count = old_states.count()
-        old_states.delete()
+        stats = purge_expired('station_states', cutoff=cutoff)
         
-        logger.info(f"Cleaned up {count} old station state records")
+        logger.info(f"Cleaned up {stats['deleted']} old station state records")
+        return stats['deleted']
     
     def cleanup_old_snapshots(self):
         """Remove old bike snapshots, keeping only recent ones"""
         cutoff = datetime.utcnow() - timedelta(seconds=self.cleanup_age)
         
-        old_snapshots = BikeSnapshot.query.filter(BikeSnapshot.timestamp < cutoff)
-        count = old_snapshots.count()
-        old_snapshots.delete()
+        stats = purge_expired('bike_snapshots', cutoff=cutoff)
+        
+        logger.info(f"Cleaned up {stats['deleted']} old bike snapshot records")
+        return stats['deleted']
+    
+    def cleanup_old_movements(self):
+        """Drop bike movements past their retention period"""
+        stats = purge_expired('bike_movements')
         
-        logger.info(f"Cleaned up {count} old bike snapshot records")
+        logger.info(f"Cleaned up {stats['partitions_dropped']} movement partitions "
+                    f"and {stats['deleted']} old movement records")
+        return stats['deleted']
     
     def cleanup_orphaned_malfunctions(self):
         """Clean up malfunction logs for bikes that no longer exist or are resolved"""
         # Remove malfunctions for non-existent bikes
-        orphaned = db.session.query(MalfunctionLog)\
-                            .outerjoin(Bike, MalfunctionLog.bike_id == Bike.id)\
-                            .filter(Bike.id.is_(None))
-        
-        count = orphaned.count()
-        orphaned.delete(synchronize_session=False)
+        result = db.session.execute(
+            delete(MalfunctionLog)
+            .where(MalfunctionLog.bike_id.not_in(select(Bike.id)))
+            .execution_options(synchronize_session=False)
+        )
+        count = result.rowcount
         
         # Auto-resolve old active malfunctions (older than 30 days)
         old_cutoff = datetime.utcnow() - timedelta(days=30)
@@ -156,21 +192,31 @@ class DataRecovery:
             malfunction.resolved_at = datetime.utcnow()
         
         logger.info(f"Cleaned up {count} orphaned malfunctions and auto-resolved {len(old_malfunctions)} old ones")
+        return count + len(old_malfunctions)
     
     def recalculate_bike_statistics(self):
-        """Recalculate bike statistics from actual trip data"""
-        bikes = Bike.query.all()
-        
-        for bike in bikes:
-            # Recalculate from actual trips
-            trips = Trip.query.filter_by(bike_id=bike.id).all()
-            
-            bike.total_trips = len(trips)
-            bike.total_distance = sum(trip.distance or 0 for trip in trips)
-            bike.total_duration = sum(trip.duration or 0 for trip in trips)
-            bike.boomerang_count = sum(1 for trip in trips if trip.is_boomerang)
-        
-        logger.info(f"Recalculated statistics for {len(bikes)} bikes")
+        """Recalculate bike statistics from actual trip data in a single UPDATE"""
+        trips = Trip.__table__
+        
+        def per_bike(expr, *conditions):
+            # Correlated to the bike being updated, resolved through idx_trip_bike_time
+            return select(expr).where(trips.c.bike_id == Bike.id, *conditions).scalar_subquery()
+        
+        result = db.session.execute(
+            update(Bike).values(
+                total_trips=per_bike(func.count(trips.c.id)),
+                total_distance=per_bike(func.coalesce(func.sum(trips.c.distance), 0)),
+                total_duration=per_bike(func.coalesce(func.sum(trips.c.duration), 0)),
+                boomerang_count=per_bike(func.count(trips.c.id), trips.c.is_boomerang == True),
+                updated_at=Bike.updated_at  # Statistics refresh is not a bike update
+            ).execution_options(synchronize_session=False)
+        )
+        
+        # Bikes already loaded in this session must not keep their old totals
+        db.session.expire_all()
+        
+        logger.info(f"Recalculated statistics for {result.rowcount} bikes")
+        return result.rowcount
     
     def mark_missing_bikes(self):
         """Mark bikes as missing if they haven't been seen for too long"""
@@ -204,21 +250,24 @@ class DataRecovery:
                 db.session.add(malfunction)
         
         logger.info(f"Marked {len(potentially_missing)} bikes as missing")
+        return len(potentially_missing)
     
     def reset_bike_status_from_snapshots(self):
         """Reset all bike statuses based on latest snapshots"""
         logger.info("Resetting bike statuses from latest snapshots...")
         
         # Get latest snapshot for each bike
+        Snapshot = bike_snapshots.between()
         latest_snapshots = db.session.query(
-            BikeSnapshot.bike_id,
-            func.max(BikeSnapshot.timestamp).label('latest_time')
-        ).group_by(BikeSnapshot.bike_id).subquery()
+            Snapshot.bike_id,
+            func.max(Snapshot.timestamp).label('latest_time')
+        ).group_by(Snapshot.bike_id).subquery()
         
-        current_snapshots = db.session.query(BikeSnapshot)\
+        Current = bike_snapshots.between()
+        current_snapshots = db.session.query(Current)\
                                     .join(latest_snapshots, 
-                                          and_(BikeSnapshot.bike_id == latest_snapshots.c.bike_id,
-                                               BikeSnapshot.timestamp == latest_snapshots.c.latest_time))\
+                                          and_(Current.bike_id == latest_snapshots.c.bike_id,
+                                               Current.timestamp == latest_snapshots.c.latest_time))\
                                     .all()
         
         for snapshot in current_snapshots:
@@ -229,71 +278,141 @@ class DataRecovery:
         
         logger.info(f"Reset status for {len(current_snapshots)} bikes from snapshots")
         db.session.commit()
+        return len(current_snapshots)
     
     def cleanup_duplicate_trips(self):
-        """Remove duplicate trip entries"""
-        # Find trips with same bike, start time, and stations
-        duplicates = db.session.query(Trip)\
-                              .group_by(Trip.bike_id, Trip.start_time, Trip.start_station_id, Trip.end_station_id)\
-                              .having(func.count(Trip.id) > 1)\
-                              .all()
-        
-        removed_count = 0
-        for trip in duplicates:
-            # Keep the first one, remove the rest
-            other_trips = Trip.query.filter(
-                and_(
-                    Trip.bike_id == trip.bike_id,
-                    Trip.start_time == trip.start_time,
-                    Trip.start_station_id == trip.start_station_id,
-                    Trip.end_station_id == trip.end_station_id,
-                    Trip.id != trip.id
-                )
-            ).all()
-            
-            for dup_trip in other_trips:
-                db.session.delete(dup_trip)
-                removed_count += 1
+        """Remove duplicate trip entries, keeping the first recorded trip of each group"""
+        # Rank trips within each (bike, start time, stations) group - everything after the first is a duplicate
+        ranked = select(
+            Trip.id,
+            func.row_number().over(
+                partition_by=(Trip.bike_id, Trip.start_time, Trip.start_station_id, Trip.end_station_id),
+                order_by=Trip.id
+            ).label('position')
+        ).subquery()
+        duplicates = select(ranked.c.id).where(ranked.c.position > 1)
+        
+        # Malfunctions pointing at a removed duplicate lose their trip reference
+        db.session.execute(
+            update(MalfunctionLog)
+            .where(MalfunctionLog.related_trip_id.in_(duplicates))
+            .values(related_trip_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        # The bulk delete bypasses the session, take the duplicates out of the rollups first
+        trip_rollups.subtract_where(Trip.id.in_(duplicates))
+        result = db.session.execute(
+            delete(Trip).where(Trip.id.in_(duplicates)).execution_options(synchronize_session=False)
+        )
+        removed_count = result.rowcount
         
         logger.info(f"Removed {removed_count} duplicate trips")
         db.session.commit()
+        if removed_count:
+            write_behind.after_commit(bike_stats.invalidate)
+        return removed_count
     
-    def get_recovery_report(self) -> Dict:
-        """Generate a report of current data health"""
+    def rebuild_rollups(self):
+        """Recompute the hourly trip and station rollups from the whole trip history"""
+        return trip_rollups.rebuild()
+    
+    def get_recovery_report(self, use_cache=True) -> Dict:
+        """Generate a report of current data health, cached until the next scrape or TTL expiry"""
+        generation = scrape_generation.current()
+        now = time.monotonic()
+        
+        with DataRecovery._report_lock:
+            cached = DataRecovery._report_cache
+            if (use_cache and cached and cached['generation'] == generation
+                    and now - cached['computed_at'] < self.report_ttl):
+                return cached['report']
+        
+        report = self._build_recovery_report()
+        
+        with DataRecovery._report_lock:
+            DataRecovery._report_cache = {
+                'generation': generation,
+                'computed_at': now,
+                'report': report
+            }
+        return report
+    
+    @classmethod
+    def invalidate_report_cache(cls):
+        """Drop the cached report after recovery actions changed the data"""
+        with cls._report_lock:
+            cls._report_cache = None
+    
+    def _build_recovery_report(self) -> Dict:
+        """Compute the report with one conditional aggregate per table"""
         now = datetime.utcnow()
         
         # Count various issues
         old_cutoff = now - timedelta(hours=24)
         very_old_cutoff = now - timedelta(days=7)
         
-        report = {
+        def flag(condition):
+            return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+        
+        bikes = db.session.query(
+            func.count(Bike.id).label('total'),
+            flag(Bike.current_status == 'in_transit').label('in_transit'),
+            flag(Bike.current_status == 'missing').label('missing'),
+            flag(Bike.last_seen_at < old_cutoff).label('not_seen_24h')
+        ).one()
+        
+        trips = db.session.query(
+            func.count(Trip.id).label('total'),
+            func.min(Trip.start_time).label('oldest'),
+            func.max(Trip.start_time).label('newest')
+        ).one()
+        
+        total_stations = db.session.query(func.count(Station.id)).scalar()
+        active_malfunctions = db.session.query(func.count(MalfunctionLog.id))\
+                                        .filter(MalfunctionLog.is_active == True).scalar()
+        
+        snapshots = self._partitioned_summary(bike_snapshots, very_old_cutoff)
+        states = self._partitioned_summary(station_states, very_old_cutoff)
+        
+        def iso(value):
+            return value.isoformat() if value else None
+        
+        return {
             'timestamp': now.isoformat(),
-            'total_bikes': Bike.query.count(),
-            'total_stations': Station.query.count(),
-            'total_trips': Trip.query.count(),
+            'generation': scrape_generation.current(),
+            'total_bikes': bikes.total,
+            'total_stations': total_stations,
+            'total_trips': trips.total,
             'issues': {
-                'bikes_in_transit': Bike.query.filter_by(current_status='in_transit').count(),
-                'missing_bikes': Bike.query.filter_by(current_status='missing').count(),
-                'bikes_not_seen_24h': Bike.query.filter(Bike.last_seen_at < old_cutoff).count(),
-                'active_malfunctions': MalfunctionLog.query.filter_by(is_active=True).count(),
-                'old_station_states': StationState.query.filter(StationState.timestamp < very_old_cutoff).count(),
-                'old_snapshots': BikeSnapshot.query.filter(BikeSnapshot.timestamp < very_old_cutoff).count(),
+                'bikes_in_transit': bikes.in_transit,
+                'missing_bikes': bikes.missing,
+                'bikes_not_seen_24h': bikes.not_seen_24h,
+                'active_malfunctions': active_malfunctions,
+                'old_station_states': states.old_rows,
+                'old_snapshots': snapshots.old_rows,
             },
             'data_age': {
-                'newest_snapshot': BikeSnapshot.query.order_by(BikeSnapshot.timestamp.desc()).first(),
-                'oldest_snapshot': BikeSnapshot.query.order_by(BikeSnapshot.timestamp.asc()).first(),
-                'newest_trip': Trip.query.order_by(Trip.start_time.desc()).first(),
-                'oldest_trip': Trip.query.order_by(Trip.start_time.asc()).first(),
+                'newest_snapshot': iso(snapshots.newest),
+                'oldest_snapshot': iso(snapshots.oldest),
+                'newest_trip': iso(trips.newest),
+                'oldest_trip': iso(trips.oldest),
             }
         }
-        
-        # Convert datetime objects to strings
-        for key in ['newest_snapshot', 'oldest_snapshot']:
-            if report['data_age'][key]:
-                report['data_age'][key] = report['data_age'][key].timestamp.isoformat()
-        
-        for key in ['newest_trip', 'oldest_trip']:
-            if report['data_age'][key]:
-                report['data_age'][key] = report['data_age'][key].start_time.isoformat()
-        
-        return report
\ No newline at end of file
+    
+    def _partitioned_summary(self, partitions, old_cutoff):
+        """Oldest, newest and expired row count across a partitioned table in one statement"""
+        per_table = []
+        for table in partitions.tables():
+            timestamp = table.c.timestamp
+            per_table.append(select(
+                func.min(timestamp).label('oldest'),
+                func.max(timestamp).label('newest'),
+                func.sum(case((timestamp < old_cutoff, 1), else_=0)).label('old_rows')
+            ))
+        
+        combined = union_all(*per_table).subquery() if len(per_table) > 1 else per_table[0].subquery()
+        return db.session.query(
+            func.min(combined.c.oldest).label('oldest'),
+            func.max(combined.c.newest).label('newest'),
+            func.coalesce(func.sum(combined.c.old_rows), 0).label('old_rows')
+        ).one()
@@ -0,0 +1,134 @@
+import os
+import re
+import gzip
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List
+from flask import Response, jsonify, request
+
+try:
+    import msgpack
+except ImportError:  # Optional - the binary format is only offered when installed
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # Optional - gzip is used otherwise
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+JSON = 'application/json'
+COLUMNAR = 'application/vnd.velib.columnar+json'
+MSGPACK = 'application/x-msgpack'
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Fast enough to run per request
+
+COMPRESSIBLE = (JSON, COLUMNAR, MSGPACK, 'text/html', 'text/css', 'text/javascript', 'application/javascript')
+
+ISO_TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+
+
+def available_formats() -> List[str]:
+    return [JSON, COLUMNAR] + ([MSGPACK] if msgpack else [])
+
+
+def negotiated_format() -> str:
+    """Representation picked from the Accept header, plain JSON unless asked otherwise"""
+    return request.accept_mimetypes.best_match(available_formats(), default=JSON) or JSON
+
+
+def _epoch(value: str):
+    # Stored timestamps are naive - treated as UTC, like the time buckets
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp())
+
+
+def to_columns(rows: List[Dict]) -> Dict:
+    """
+    Turn a list of row dicts into one array per field.
+
+    Fields holding ISO timestamps become epoch seconds, and are listed in
+    `time_columns` so clients know which arrays to turn back into dates.
+    """
+    columns = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+
+    data = {}
+    time_columns = []
+    for name in columns:
+        values = [row.get(name) for row in rows]
+        sample = next((value for value in values if value is not None), None)
+        if isinstance(sample, str) and ISO_TIMESTAMP.match(sample):
+            values = [_epoch(value) if value is not None else None for value in values]
+            time_columns.append(name)
+        data[name] = values
+
+    return {'columns': columns, 'time_columns': time_columns, 'rows': len(rows), 'data': data}
+
+
+def list_response(key: str, rows: List[Dict], **meta) -> Response:
+    """
+    Response for a list endpoint in the representation the client accepts.
+
+    `application/json` (default) keeps the usual array of objects under `key`.
+    `application/vnd.velib.columnar+json` and `application/x-msgpack` (when
+    msgpack is installed) carry the same rows as columns, with `meta` alongside.
+    """
+    mimetype = negotiated_format()
+
+    if mimetype == JSON:
+        response = jsonify({key: rows, **meta})
+    else:
+        payload = {key: to_columns(rows), 'format': 'columnar', **meta}
+        if mimetype == MSGPACK:
+            response = Response(msgpack.packb(payload, use_bin_type=True), mimetype=MSGPACK)
+        else:
+            response = jsonify(payload)
+            response.mimetype = COLUMNAR
+
+    response.vary.add('Accept')
+    return response
+
+
+def compress_response(response: Response) -> Response:
+    """Compress the body with br or gzip when the client accepts it"""
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed \
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE:
+        return response
+
+    body = response.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding, body = 'br', brotli.compress(body, quality=BROTLI_QUALITY)
+    elif accepted['gzip']:
+        encoding, body = 'gzip', gzip.compress(body, compresslevel=GZIP_LEVEL)
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    # The compressed bytes differ from the identity ones - the validator becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
@@ -0,0 +1,257 @@
+import os
+import zlib
+import time
+import threading
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Optional
+from sqlalchemy import text
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+class NotLeader(Exception):
+    """A write was attempted after this process lost the leader lock"""
+
+
+class FileLock:
+    """Exclusive lock on a local file, released by the OS if the process dies"""
+
+    backend = 'file'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.handle = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        handle = open(self.path, 'a+')
+        try:
+            if fcntl:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            handle.close()
+            return False
+
+        # Record the holder for the status endpoint
+        handle.seek(0)
+        handle.truncate()
+        handle.write(str(os.getpid()))
+        handle.flush()
+        self.handle = handle
+        return True
+
+    def alive(self) -> bool:
+        return self.handle is not None
+
+    def held(self) -> bool:
+        return self.handle is not None
+
+    def release(self):
+        if self.handle is None:
+            return
+        try:
+            if fcntl:
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            else:
+                self.handle.seek(0)
+                msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+        except OSError:
+            pass
+        self.handle.close()
+        self.handle = None
+
+    def holder(self) -> Optional[int]:
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+
+class AdvisoryLock:
+    """
+    PostgreSQL session-level advisory lock held on a dedicated connection.
+
+    The server drops the lock as soon as that connection goes away, so a
+    crashed leader (or one cut off from the database) is replaced by the next
+    process that polls.
+    """
+
+    backend = 'postgresql'
+
+    def __init__(self, engine, key: int):
+        self.engine = engine
+        self.key = key
+        self.connection = None
+
+    def acquire(self) -> bool:
+        connection = self.engine.connect()
+        try:
+            acquired = connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': self.key}).scalar()
+            connection.commit()
+        except Exception as e:
+            logger.warning(f"Advisory lock attempt failed: {e}")
+            connection.close()
+            return False
+        if not acquired:
+            connection.close()
+            return False
+        self.connection = connection
+        return True
+
+    def alive(self) -> bool:
+        if self.connection is None:
+            return False
+        try:
+            self.connection.execute(text("SELECT 1"))
+            self.connection.commit()
+            return True
+        except Exception as e:
+            logger.warning(f"Lost the leader connection: {e}")
+            self.connection.invalidate()
+            self.connection = None
+            return False
+
+    def held(self) -> bool:
+        # Without a round trip - a lost connection is noticed by alive() on the next poll
+        return self.connection is not None
+
+    def release(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': self.key})
+            self.connection.commit()
+        except Exception:
+            pass
+        self.connection.close()
+        self.connection = None
+
+    def holder(self) -> Optional[int]:
+        try:
+            with self.engine.connect() as connection:
+                return connection.execute(text(
+                    "SELECT pid FROM pg_locks WHERE locktype = 'advisory' AND granted "
+                    "AND ((classid::bigint << 32) | objid::bigint) = :key"
+                ), {'key': self.key}).scalar()
+        except Exception:
+            return None
+
+
+class LeaderElection:
+    """
+    Elects the single process that runs ingestion and background jobs.
+
+    Under gunicorn every worker imports run.py, so every worker would start its
+    own scheduler and queue worker. Instead each process runs a candidate thread
+    that polls a lock: a file lock next to the SQLite database, or an advisory
+    lock when the database is PostgreSQL. The holder is the leader. It keeps
+    checking that it still holds the lock and steps down if it lost it, while
+    followers take over within one poll interval of the leader dying.
+    """
+
+    def __init__(self, interval: float = None):
+        self.interval = interval if interval is not None else \
+            float(os.environ.get('LEADER_POLL_INTERVAL', 2))
+        self.lock_backend = None
+        self.is_leader = False
+        self.leader_since: Optional[datetime] = None
+        self.elections = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.on_elected: Optional[Callable] = None
+        self.on_demoted: Optional[Callable] = None
+
+    def _create_lock(self, app):
+        from app import db
+        with app.app_context():
+            engine = db.engine
+        if engine.url.get_backend_name() == 'postgresql':
+            key = int(os.environ.get('LEADER_LOCK_KEY', zlib.crc32(b'velib-tracker:scheduler')))
+            return AdvisoryLock(engine, key)
+        path = os.environ.get('LEADER_LOCK_PATH', os.path.join(app.instance_path, 'scheduler.lock'))
+        return FileLock(path)
+
+    def start(self, app, on_elected: Callable, on_demoted: Callable):
+        """Start campaigning - on_elected/on_demoted run on the candidate thread"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.lock_backend = self._create_lock(app)
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._campaign, name='leader-election', daemon=True)
+        self.thread.start()
+        logger.info(f"Leader election started ({self.lock_backend.backend} lock, pid {os.getpid()})")
+
+    def _campaign(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.is_leader:
+                    if not self.lock_backend.alive():
+                        self._demote()
+                elif self.lock_backend.acquire():
+                    self._elect()
+            except Exception as e:
+                logger.error(f"Leader election error: {e}")
+            self.stop_event.wait(self.interval)
+
+    def _elect(self):
+        self.is_leader = True
+        self.leader_since = datetime.utcnow()
+        self.elections += 1
+        logger.info(f"Process {os.getpid()} elected leader, starting background jobs")
+        try:
+            self.on_elected()
+        except Exception as e:
+            logger.error(f"Failed to start background jobs as leader: {e}")
+            self._demote()
+
+    def _demote(self):
+        logger.warning(f"Process {os.getpid()} is no longer leader, stopping background jobs")
+        try:
+            self.on_demoted()
+        except Exception as e:
+            logger.error(f"Failed to stop background jobs: {e}")
+        self.is_leader = False
+        self.leader_since = None
+        self.lock_backend.release()
+
+    def holds_lock(self) -> bool:
+        """Whether this process may write - always true for processes that do not campaign"""
+        if self.thread is None:
+            return True
+        return self.lock_backend is not None and self.lock_backend.held()
+
+    def stop(self):
+        """Stop campaigning and hand leadership over if held"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=self.interval + 5)
+        if self.is_leader:
+            self._demote()
+
+    def status(self) -> Dict:
+        return {
+            'pid': os.getpid(),
+            'is_leader': self.is_leader,
+            'leader_since': self.leader_since.isoformat() if self.leader_since else None,
+            'leader_pid': os.getpid() if self.is_leader else
+                          (self.lock_backend.holder() if self.lock_backend else None),
+            'backend': self.lock_backend.backend if self.lock_backend else None,
+            'elections': self.elections
+        }
+
+
+# Global leader election for this process
+leader = LeaderElection()
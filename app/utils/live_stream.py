@@ -0,0 +1,230 @@
+import os
+import json
+import queue
+import threading
+import logging
+from typing import Dict, List, Optional
+from app import db
+from app.models import Trip, Station
+from app.utils.scrape_generation import scrape_generation
+from app.utils.station_changes import changes_since
+
+logger = logging.getLogger(__name__)
+
+
+class LiveClient:
+    """One connected event stream with its own bounded buffer"""
+
+    def __init__(self, buffer_size: int, generation: int):
+        self.events = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        self.generation = generation  # At subscription, for the hello event
+
+    def push(self, event: str):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            # Slow consumer - throw its backlog away and tell it to reload instead
+            while True:
+                try:
+                    self.events.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    break
+            self.events.put_nowait(LiveBroadcaster.format_event('resync', {}))
+
+
+class LiveBroadcaster:
+    """
+    Server-Sent Events fan-out of per-scrape updates.
+
+    One thread per process watches the scrape generation file. When a scrape
+    lands it runs the station delta, new trip and overview queries once and
+    pushes the serialized events to every connected client, so the database
+    work per scrape does not depend on how many viewers are connected.
+
+    Each client has a bounded buffer. A client that falls behind has its
+    backlog dropped and receives a `resync` event, after which it reloads
+    through the (cached) REST endpoints.
+    """
+
+    def __init__(self):
+        self.poll_interval = float(os.environ.get('LIVE_POLL_INTERVAL', 2))
+        self.heartbeat_interval = float(os.environ.get('LIVE_HEARTBEAT', 15))
+        self.buffer_size = int(os.environ.get('LIVE_CLIENT_BUFFER', 16))
+        self.max_clients = int(os.environ.get('LIVE_MAX_CLIENTS', 500))
+        self.max_trips = 200  # Per event - beyond that clients just see the counters
+
+        self.clients: List[LiveClient] = []
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.app = None
+
+        self.generation = None
+        self.last_trip_id = None
+
+        # Metrics
+        self.broadcasts = 0
+        self.events_sent = 0
+
+    @staticmethod
+    def format_event(name: str, data: Dict, event_id=None) -> str:
+        lines = []
+        if event_id is not None:
+            lines.append(f"id: {event_id}")
+        lines.append(f"event: {name}")
+        lines.append(f"data: {json.dumps(data, separators=(',', ':'))}")
+        return '\n'.join(lines) + '\n\n'
+
+    def subscribe(self, app) -> Optional[LiveClient]:
+        """Register a client, or None when the process is at its client limit"""
+        # Read here, in the request - the stream itself runs outside the app context
+        generation = scrape_generation.current()
+        with self.lock:
+            if len(self.clients) >= self.max_clients:
+                return None
+            client = LiveClient(self.buffer_size, generation)
+            self.clients.append(client)
+            self._ensure_thread(app)
+            return client
+
+    def unsubscribe(self, client: LiveClient):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def _ensure_thread(self, app):
+        if self.thread and self.thread.is_alive():
+            return
+        self.app = app
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._watch, daemon=True, name='live-broadcaster')
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=5)
+
+    def _watch(self):
+        logger.info("Live broadcaster started")
+        with self.app.app_context():
+            self.generation = scrape_generation.current()
+            self.last_trip_id = db.session.query(db.func.max(Trip.id)).scalar() or 0
+            db.session.remove()
+
+            while not self.stop_event.wait(self.poll_interval):
+                with self.lock:
+                    if not self.clients:
+                        # Nobody listening - the next subscriber restarts the thread
+                        self.thread = None
+                        break
+
+                current = scrape_generation.current()
+                if current == self.generation:
+                    continue
+
+                try:
+                    events = self._build_events(self.generation, current)
+                except Exception as e:
+                    logger.error(f"Error building live events for generation {current}: {e}")
+                    events = [self.format_event('resync', {'generation': current}, current)]
+                finally:
+                    db.session.remove()
+
+                self.generation = current
+                self._broadcast(events)
+        logger.info("Live broadcaster stopped")
+
+    def _build_events(self, previous: int, current: int) -> List[str]:
+        """Serialized events for one generation step, computed once for all clients"""
+        from app.utils.statistics import StatisticsCalculator
+
+        events = []
+
+        changes = changes_since(previous, current)
+        if changes is not None:
+            events.append(self.format_event('stations', {
+                'generation': current,
+                'since': previous,
+                'stations': [station.to_dict() for station in changes['updated']],
+                'removed': changes['removed'],
+                'delta': True
+            }, current))
+        else:
+            # Too far behind for the change log - clients fetch the full list
+            events.append(self.format_event('stations', {'generation': current, 'delta': False}, current))
+
+        trips = Trip.query.filter(Trip.id > self.last_trip_id).order_by(Trip.id).limit(self.max_trips + 1).all()
+        if trips:
+            self.last_trip_id = max(self.last_trip_id, db.session.query(db.func.max(Trip.id)).scalar() or 0)
+            station_ids = {trip.start_station_id for trip in trips} | {trip.end_station_id for trip in trips}
+            codes = dict(db.session.query(Station.id, Station.code).filter(Station.id.in_(station_ids)).all())
+            events.append(self.format_event('trips', {
+                'generation': current,
+                'trips': [{
+                    'id': trip.id,
+                    'bike_id': trip.bike_id,
+                    'start_station_code': codes.get(trip.start_station_id),
+                    'end_station_code': codes.get(trip.end_station_id),
+                    'start_time': trip.start_time.isoformat(),
+                    'end_time': trip.end_time.isoformat(),
+                    'duration': trip.duration,
+                    'is_boomerang': trip.is_boomerang
+                } for trip in trips[:self.max_trips]],
+                'truncated': len(trips) > self.max_trips
+            }, current))
+
+        overview = StatisticsCalculator().get_system_overview()
+        events.append(self.format_event('overview', {
+            'total_bikes': overview['total_bikes'],
+            'total_stations': overview['total_stations'],
+            'bike_status': overview['bike_status_breakdown'],
+            'active_malfunctions': overview['active_malfunctions'],
+            'trips_today': overview['trips_today'],
+            'trips_last_hour': overview['trips_last_hour'],
+            'timestamp': overview['timestamp'].isoformat(),
+            'generation': current
+        }, current))
+
+        return events
+
+    def _broadcast(self, events: List[str]):
+        with self.lock:
+            clients = list(self.clients)
+            self.broadcasts += 1
+            self.events_sent += len(events) * len(clients)
+        for client in clients:
+            for event in events:
+                client.push(event)
+
+    def stream(self, client: LiveClient):
+        """Generator of SSE text for one client, with heartbeats while idle"""
+        try:
+            yield f"retry: {int(self.poll_interval * 1000) + 3000}\n\n"
+            yield self.format_event('hello', {'generation': client.generation})
+            while True:
+                try:
+                    yield client.events.get(timeout=self.heartbeat_interval)
+                except queue.Empty:
+                    # Comment line - keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(client)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'clients': len(self.clients),
+                'max_clients': self.max_clients,
+                'running': bool(self.thread and self.thread.is_alive()),
+                'generation': self.generation,
+                'broadcasts': self.broadcasts,
+                'events_sent': self.events_sent,
+                'dropped': sum(client.dropped for client in self.clients)
+            }
+
+
+# Global broadcaster
+live_broadcaster = LiveBroadcaster()
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
 from typing import List, Dict
-from sqlalchemy import func
+from sqlalchemy import func, update
 from app import db
 from app.models import Bike, Trip, MalfunctionLog, BikeSnapshot
+from app.utils.bike_stats import bike_stats
+from app.utils.write_behind import write_behind
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,22 +28,9 @@ class MalfunctionDetector:
         
     def detect_boomerang_bikes(self):
         """Detect bikes with excessive boomerang trips"""
-        # Find bikes with recent boomerangs
-        recent_cutoff = datetime.utcnow() - timedelta(days=1)
-        
-        boomerang_stats = db.session.query(
-            Trip.bike_id,
-            func.count(Trip.id).label('boomerang_count'),
-            func.max(Trip.end_time).label('last_boomerang')
-        ).filter(
-            Trip.is_boomerang == True,
-            Trip.start_time >= recent_cutoff
-        ).group_by(Trip.bike_id).having(
-            func.count(Trip.id) >= self.boomerang_threshold
-        ).all()
-        
-        for stat in boomerang_stats:
-            bike = Bike.query.get(stat.bike_id)
+        # Rolling 24h boomerang counts are maintained as trips are created
+        for bike_id, boomerang_count in bike_stats.boomerang_offenders(self.boomerang_threshold):
+            bike = Bike.query.get(bike_id)
             if bike:
                 # Check if already flagged
                 existing = MalfunctionLog.query.filter_by(
@@ -54,36 +43,24 @@ class MalfunctionDetector:
                     malfunction = MalfunctionLog(
                         bike_id=bike.id,
                         malfunction_type='boomerang',
-                        severity=min(5, stat.boomerang_count // 3),
-                        description=f"Bike returned to same station {stat.boomerang_count} times in 24h"
+                        severity=min(5, boomerang_count // 3),
+                        description=f"Bike returned to same station {boomerang_count} times in 24h"
                     )
                     db.session.add(malfunction)
                     bike.potential_malfunction = True
                     
-                    logger.info(f"Flagged bike {bike.bike_name} for excessive boomerangs: {stat.boomerang_count}")
+                    logger.info(f"Flagged bike {bike.bike_name} for excessive boomerangs: {boomerang_count}")
         
-        db.session.commit()
+        write_behind.commit()
     
     def detect_low_speed_bikes(self):
         """Detect bikes with consistently low speeds"""
-        recent_cutoff = datetime.utcnow() - timedelta(days=3)
+        # Speed EWMA over recent trips of at least 5 minutes, at least 3 trips in the last 3 days
+        candidates = bike_stats.low_speed_candidates(self.low_speed_threshold, min_trips=3)
         
-        # Get average speeds for bikes
-        speed_stats = db.session.query(
-            Trip.bike_id,
-            func.avg(Trip.avg_speed).label('avg_speed'),
-            func.count(Trip.id).label('trip_count')
-        ).filter(
-            Trip.start_time >= recent_cutoff,
-            Trip.avg_speed.isnot(None),
-            Trip.duration > 300  # At least 5 minute trips
-        ).group_by(Trip.bike_id).having(
-            func.count(Trip.id) >= 3  # At least 3 trips
-        ).all()
-        
-        for stat in speed_stats:
-            bike = Bike.query.get(stat.bike_id)
-            if bike and bike.bike_electric and stat.avg_speed < self.low_speed_threshold:
+        for bike_id, avg_speed, trip_count in candidates:
+            bike = Bike.query.get(bike_id)
+            if bike and bike.bike_electric:
                 existing = MalfunctionLog.query.filter_by(
                     bike_id=bike.id,
                     malfunction_type='low_speed',
@@ -95,14 +72,14 @@ class MalfunctionDetector:
                         bike_id=bike.id,
                         malfunction_type='low_speed',
                         severity=3,
-                        description=f"Electric bike averaging only {stat.avg_speed:.1f} km/h over {stat.trip_count} trips"
+                        description=f"Electric bike averaging only {avg_speed:.1f} km/h over {trip_count} trips"
                     )
                     db.session.add(malfunction)
                     bike.potential_malfunction = True
                     
-                    logger.info(f"Flagged electric bike {bike.bike_name} for low speed: {stat.avg_speed:.1f} km/h")
+                    logger.info(f"Flagged electric bike {bike.bike_name} for low speed: {avg_speed:.1f} km/h")
         
-        db.session.commit()
+        write_behind.commit()
     
     def detect_missing_bikes(self):
         """Detect bikes that haven't been seen for extended periods"""
@@ -134,7 +111,7 @@ class MalfunctionDetector:
                 
                 logger.info(f"Marked bike {bike.bike_name} as missing")
         
-        db.session.commit()
+        write_behind.commit()
     
     def detect_stuck_bikes(self):
         """Detect bikes that haven't moved from a station"""
@@ -178,7 +155,7 @@ class MalfunctionDetector:
                 
                 logger.info(f"Flagged bike {bike.bike_name} as stuck at station")
         
-        db.session.commit()
+        write_behind.commit()
     
     def detect_battery_issues(self):
         """Detect electric bikes with potential battery issues"""
@@ -235,28 +212,31 @@ class MalfunctionDetector:
                         
                         logger.info(f"Flagged electric bike {bike.bike_name} for potential battery issues")
         
-        db.session.commit()
+        write_behind.commit()
     
     def update_malfunction_scores(self):
         """Update overall malfunction scores for bikes"""
-        bikes = Bike.query.all()
+        # Weighted score of the bikes with active malfunctions, from the active logs index
+        severities = db.session.query(
+            MalfunctionLog.bike_id, func.sum(MalfunctionLog.severity)
+        ).filter(MalfunctionLog.is_active == True).group_by(MalfunctionLog.bike_id).all()
         
-        for bike in bikes:
-            active_malfunctions = MalfunctionLog.query.filter_by(
-                bike_id=bike.id,
-                is_active=True
-            ).all()
-            
-            if active_malfunctions:
-                # Calculate weighted score
-                total_score = sum(m.severity for m in active_malfunctions)
-                bike.malfunction_score = min(10.0, total_score * 2.0)
-                bike.potential_malfunction = True
-            else:
-                bike.malfunction_score = 0.0
-                bike.potential_malfunction = False
+        if severities:
+            db.session.execute(update(Bike), [
+                {'id': bike_id, 'malfunction_score': min(10.0, (total or 0) * 2.0), 'potential_malfunction': True}
+                for bike_id, total in severities
+            ])
+        
+        # Bikes flagged before that have no active malfunction left
+        db.session.execute(
+            update(Bike).where(
+                Bike.potential_malfunction == True,
+                Bike.id.notin_(db.session.query(MalfunctionLog.bike_id).filter(MalfunctionLog.is_active == True))
+            ).values(malfunction_score=0.0, potential_malfunction=False)
+            .execution_options(synchronize_session=False)
+        )
         
-        db.session.commit()
+        write_behind.commit()
     
     def resolve_recovered_bikes(self):
         """Mark malfunctions as resolved for bikes that appear to be working again"""
@@ -285,4 +265,4 @@ class MalfunctionDetector:
                     malfunction.resolved_at = datetime.utcnow()
                     logger.info(f"Resolved {malfunction.malfunction_type} for bike {bike_id}")
         
-        db.session.commit()
\ No newline at end of file
+        write_behind.commit()
\ No newline at end of file
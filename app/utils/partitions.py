@@ -0,0 +1,285 @@
+import threading
+import time
+import logging
+from datetime import datetime, date, timedelta
+from functools import wraps
+from typing import Dict, List
+from sqlalchemy import Table, Column, Index, MetaData, BigInteger, Integer, inspect, insert, select, update, text, union_all
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import aliased
+from app import db
+from app.models import BikeSnapshot, StationState, BikeMovement
+from app.utils.scrape_generation import scrape_generation
+
+logger = logging.getLogger(__name__)
+
+# Partition tables live outside the Flask-SQLAlchemy metadata so create_all() ignores them
+partition_metadata = MetaData()
+metadata_lock = threading.RLock()
+
+
+class TimePartitions:
+    """
+    Daily partition tables for an append-only model pruned by timestamp.
+
+    Rows are written to `<table>_pYYYYMMDD` tables that share the model's
+    columns and indexes. Reads go through a UNION ALL of the partitions that
+    overlap the requested time range, plus the model's own table which still
+    holds rows written before partitioning. Retention drops whole partitions,
+    so its cost no longer depends on how many rows they contain.
+
+    Partition ids start at `day.toordinal() * ID_STRIDE` so rows from different
+    days never share an id and can be loaded as regular model instances.
+
+    The list of partitions is cached per process and re-read whenever the
+    scrape generation moves, since the scraper drops expired partitions
+    before it publishes a generation. Other drops are picked up after
+    CACHE_TTL, or by `tolerate_dropped_partitions` on the reads that hit them.
+    """
+
+    ID_STRIDE = 10 ** 8
+    CACHE_TTL = 60  # Seconds before the list of partitions is re-read from the database
+
+    def __init__(self, model, timestamp_column='timestamp'):
+        self.model = model
+        self.base = model.__table__
+        self.timestamp_column = timestamp_column
+        self.prefix = f"{self.base.name}_p"
+        self.known: Dict[date, Table] = {}  # Partitions that exist in the database, by day
+        self.lock = threading.Lock()
+        self.refreshed_at = 0.0
+        self.generation = None  # Scrape generation the list was read at
+
+    # ------------------------------------------------------------------
+    # Partition catalogue
+    # ------------------------------------------------------------------
+
+    def partition_name(self, day: date) -> str:
+        return f"{self.prefix}{day:%Y%m%d}"
+
+    def _table(self, day: date) -> Table:
+        """Table object for a day's partition (does not create it in the database)"""
+        name = self.partition_name(day)
+        with metadata_lock:
+            if name in partition_metadata.tables:
+                return partition_metadata.tables[name]
+
+            columns = []
+            for column in self.base.columns:
+                # SQLite only allows AUTOINCREMENT on INTEGER, which is 64-bit there anyway
+                column_type = BigInteger().with_variant(Integer(), 'sqlite') if column.primary_key else column.type
+                columns.append(Column(column.name, column_type,
+                                      primary_key=column.primary_key, nullable=column.nullable))
+
+            table = Table(name, partition_metadata, *columns, sqlite_autoincrement=True)
+
+            suffix = name[len(self.prefix):]
+            for index in self.base.indexes:
+                Index(f"{index.name}_p{suffix}", *[table.c[c.name] for c in index.columns])
+
+            return table
+
+    def _refresh(self, force=False):
+        generation = scrape_generation.current()
+        if (not force and generation == self.generation
+                and time.monotonic() - self.refreshed_at < self.CACHE_TTL):
+            return
+        names = inspect(db.engine).get_table_names()
+        tables = {}
+        for name in names:
+            if name.startswith(self.prefix):
+                try:
+                    day = datetime.strptime(name[len(self.prefix):], '%Y%m%d').date()
+                except ValueError:
+                    continue
+                tables[day] = self._table(day)
+        with self.lock:
+            self.known = tables
+            self.refreshed_at = time.monotonic()
+            self.generation = generation
+
+    def partitions(self, start: datetime = None, end: datetime = None) -> List[Table]:
+        """Partitions overlapping [start, end], oldest first"""
+        # Open-ended reads may reach partitions another process just dropped
+        self._refresh(force=start is None)
+        first = start.date() if start else None
+        last = end.date() if end else None
+        return [table for day, table in sorted(self.known.items())
+                if (first is None or day >= first) and (last is None or day <= last)]
+
+    def tables(self, start: datetime = None, end: datetime = None) -> List[Table]:
+        """The original table followed by the partitions overlapping [start, end]"""
+        return [self.base] + self.partitions(start, end)
+
+    def ensure(self, *days: date, connection=None):
+        """
+        Create the partitions for the given days if they don't exist yet.
+
+        Without a connection the DDL runs in its own short transaction, which
+        must happen before the caller's session takes the write lock.
+        """
+        self._refresh()
+        missing = [day for day in days if day not in self.known]
+        if not missing:
+            return
+
+        if connection is not None:
+            self._create(connection, missing)
+        else:
+            with db.engine.begin() as conn:
+                self._create(conn, missing)
+
+    def _create(self, connection, days):
+        for day in days:
+            table = self._table(day)
+            if inspect(connection).has_table(table.name):
+                self.known[day] = table
+                continue
+
+            table.create(connection)
+            first_id = day.toordinal() * self.ID_STRIDE
+            if connection.dialect.name == 'sqlite':
+                connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                                   {'name': table.name, 'seq': first_id})
+            elif connection.dialect.name == 'postgresql':
+                connection.execute(text(f"ALTER SEQUENCE {table.name}_id_seq RESTART WITH {first_id + 1}"))
+
+            self.known[day] = table
+            logger.info(f"Created partition {table.name}")
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+
+    def insert(self, rows: List[Dict]) -> int:
+        """Insert rows into their daily partitions within the current session transaction"""
+        if not rows:
+            return 0
+
+        # executemany needs every row to carry the same keys
+        columns = [column for column in self.base.columns if not column.primary_key]
+
+        by_day: Dict[date, List[Dict]] = {}
+        for row in rows:
+            for column in columns:
+                if row.get(column.name) is None:
+                    default = column.default
+                    if default is None:
+                        row[column.name] = None
+                    else:
+                        row[column.name] = default.arg(None) if default.is_callable else default.arg
+            by_day.setdefault(row[self.timestamp_column].date(), []).append(row)
+
+        connection = db.session.connection()
+        self.ensure(*by_day.keys(), connection=connection)
+
+        for day, day_rows in by_day.items():
+            db.session.execute(insert(self.known[day]), day_rows)
+
+        return len(rows)
+
+    def update(self, values: Dict, start: datetime, end: datetime, where=None) -> int:
+        """
+        Apply an UPDATE to the partitions overlapping [start, end].
+
+        `where` receives each table and returns the extra filter for it.
+        """
+        updated = 0
+        for table in self.tables(start, end):
+            timestamp = table.c[self.timestamp_column]
+            stmt = update(table).where(timestamp >= start, timestamp <= end)
+            if where is not None:
+                stmt = stmt.where(where(table))
+            updated += db.session.execute(stmt.values(**values)).rowcount
+        return updated
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def select(self, start: datetime = None, end: datetime = None):
+        """UNION ALL of the legacy table and the partitions overlapping [start, end]"""
+        selects = []
+        for table in self.tables(start, end):
+            timestamp = table.c[self.timestamp_column]
+            stmt = select(*[table.c[c.name] for c in self.base.columns])
+            if start is not None:
+                stmt = stmt.where(timestamp >= start)
+            if end is not None:
+                stmt = stmt.where(timestamp <= end)
+            selects.append(stmt)
+
+        name = f"{self.base.name}_all"
+        if len(selects) == 1:
+            return selects[0].subquery(name)
+        return union_all(*selects).subquery(name)
+
+    def between(self, start: datetime = None, end: datetime = None):
+        """
+        Model entity over the partitions overlapping [start, end].
+
+        Usage:
+            Movement = bike_movements.between(cutoff)
+            db.session.query(Movement).filter(Movement.event_type == 'departed')
+        """
+        return aliased(self.model, self.select(start, end), adapt_on_names=True)
+
+    # ------------------------------------------------------------------
+    # Retention
+    # ------------------------------------------------------------------
+
+    def drop_before(self, cutoff: datetime) -> int:
+        """Drop every partition whose whole day is older than cutoff"""
+        self._refresh()
+        expired = [day for day in self.known
+                   if datetime.combine(day + timedelta(days=1), datetime.min.time()) <= cutoff]
+        if not expired:
+            return 0
+
+        connection = db.session.connection()
+        for day in sorted(expired):
+            table = self.known.pop(day)
+            table.drop(connection, checkfirst=True)
+            with metadata_lock:
+                partition_metadata.remove(table)
+            logger.info(f"Dropped partition {table.name}")
+        db.session.commit()
+        return len(expired)
+
+
+bike_snapshots = TimePartitions(BikeSnapshot)
+station_states = TimePartitions(StationState)
+bike_movements = TimePartitions(BikeMovement)
+
+
+def _is_missing_table(error) -> bool:
+    orig = getattr(error, 'orig', None)
+    return getattr(orig, 'pgcode', None) == '42P01' or 'no such table' in str(orig)
+
+
+def tolerate_dropped_partitions(func):
+    """
+    Run a read again, once, if it hit a partition another process has dropped.
+
+    The catalogues are re-read from the database before the retry.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (OperationalError, ProgrammingError) as e:
+            if not _is_missing_table(e):
+                raise
+            db.session.rollback()
+            logger.info(f"Read hit a dropped partition, retrying: {e.orig}")
+            for partitions in (bike_snapshots, station_states, bike_movements):
+                partitions._refresh(force=True)
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def ensure_current_partitions(now: datetime):
+    """Create today's and tomorrow's partitions ahead of the writes that need them"""
+    days = (now.date(), now.date() + timedelta(days=1))
+    for partitions in (bike_snapshots, station_states, bike_movements):
+        partitions.ensure(*days)
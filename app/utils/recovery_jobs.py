@@ -0,0 +1,209 @@
+import json
+import uuid
+import logging
+from datetime import datetime
+from typing import Dict, List, Optional
+from app import db
+from app.models import RecoveryJob
+from app.queue_manager import db_queue, queued_db_operation, run_queued, QueueError, PRIORITY_RECOVERY
+from app.utils.data_recovery import DataRecovery
+from app.utils.retention import RETENTION_POLICIES, purge_expired
+
+logger = logging.getLogger(__name__)
+
+# Steps run for each recovery action, in order. Every step is a DataRecovery method.
+RECOVERY_ACTIONS: Dict[str, List[str]] = {
+    'full': [
+        'cleanup_incomplete_trips',
+        'fix_stuck_in_transit_bikes',
+        'cleanup_old_station_states',
+        'cleanup_old_snapshots',
+        'cleanup_old_movements',
+        'cleanup_orphaned_malfunctions',
+        'recalculate_bike_statistics',
+        'mark_missing_bikes',
+    ],
+    'cleanup_trips': ['cleanup_incomplete_trips'],
+    'fix_transit': ['fix_stuck_in_transit_bikes'],
+    'reset_status': ['reset_bike_status_from_snapshots'],
+    'cleanup_duplicates': ['cleanup_duplicate_trips'],
+    'cleanup_old': ['cleanup_old_station_states', 'cleanup_old_snapshots'],
+    'rebuild_rollups': ['rebuild_rollups'],
+}
+
+# Steps backed by the chunked retention deleter - they checkpoint the id they stopped at
+RETENTION_STEPS = {
+    'cleanup_old_station_states': 'station_states',
+    'cleanup_old_snapshots': 'bike_snapshots',
+    'cleanup_old_movements': 'bike_movements',
+}
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+
+def submit_recovery_job(action: str) -> RecoveryJob:
+    """Record a new recovery job and queue its first step"""
+    job = _create_job(action)
+    run_recovery_step(job.id)
+    logger.info(f"Queued recovery job {job.id} ({action})")
+    return job
+
+
+def _create_job(action: str) -> RecoveryJob:
+    if action not in RECOVERY_ACTIONS:
+        raise ValueError(f"Unknown recovery action: {action}")
+
+    job = RecoveryJob(
+        id=uuid.uuid4().hex,
+        action=action,
+        status='pending',
+        steps=json.dumps(RECOVERY_ACTIONS[action]),
+        current_step=0,
+        rows_processed=0
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def request_recovery_job(action: str, timeout: float = 10) -> Dict:
+    """
+    Submit a job for a request handler.
+
+    In the leader the job is submitted through the database worker. Other
+    processes have no worker: they only record the job as pending, and the
+    leader starts it on its next resume_recovery_jobs run.
+    """
+    if db_queue.running:
+        try:
+            return run_queued(_submit_as_dict, action, timeout=timeout)
+        except QueueError:
+            pass  # Stepped down meanwhile
+
+    job = _create_job(action)
+    logger.info(f"Recorded recovery job {job.id} ({action}) for the leader to pick up")
+    return job.to_dict()
+
+
+def _submit_as_dict(action: str) -> Dict:
+    # ORM instances stay on the worker's session, the caller gets plain data
+    return submit_recovery_job(action).to_dict()
+
+
+def get_recovery_job(job_id: str) -> Optional[RecoveryJob]:
+    return db.session.get(RecoveryJob, job_id)
+
+
+def list_recovery_jobs(limit: int = 20) -> List[RecoveryJob]:
+    return RecoveryJob.query.order_by(RecoveryJob.created_at.desc()).limit(limit).all()
+
+
+def run_recovery_step(job_id: str):
+    """
+    Queue the next step of a recovery job.
+
+    At most one step of a job waits in the queue. Outside the leader nothing
+    is queued and the job is left for the leader to resume.
+    """
+    return db_queue.enqueue_task(_run_recovery_step, job_id, priority=PRIORITY_RECOVERY,
+                                 key=f"run_recovery_step:{job_id}", coalesce=True)
+
+
+def _run_recovery_step(job_id: str):
+    """
+    Run the next step of a recovery job, then queue the one after it.
+
+    Each step is its own queue task, so scrapes queued meanwhile run between
+    steps. Progress is committed after every step (and after every chunk of a
+    retention step), which lets an interrupted job resume where it stopped.
+    """
+    job = db.session.get(RecoveryJob, job_id)
+    if job is None or job.status not in ACTIVE_STATUSES:
+        return None
+
+    steps = job.step_names
+    if job.current_step >= len(steps):
+        _finish(job)
+        return job.status
+
+    if job.status == 'pending':
+        job.status = 'running'
+        job.started_at = datetime.utcnow()
+
+    step = steps[job.current_step]
+    recovery = DataRecovery()
+
+    try:
+        if step in RETENTION_STEPS:
+            rows, done = _run_retention_step(job, RETENTION_STEPS[step])
+        else:
+            rows = getattr(recovery, step)() or 0
+            done = True
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(RecoveryJob, job_id)
+        job.status = 'failed'
+        job.error = f"{step}: {e}"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        logger.error(f"Recovery job {job_id} failed at step {step}: {e}")
+        return job.status
+
+    results = job.step_results
+    results[step] = results.get(step, 0) + rows
+    job.results = json.dumps(results)
+    job.rows_processed = (job.rows_processed or 0) + rows
+
+    if done:
+        job.current_step += 1
+        job.checkpoint = None
+        logger.info(f"Recovery job {job_id}: {step} done ({rows} rows, "
+                    f"step {job.current_step}/{len(steps)})")
+
+    if job.current_step >= len(steps):
+        _finish(job)
+    else:
+        db.session.commit()
+        run_recovery_step(job_id)
+
+    return job.status
+
+
+def _run_retention_step(job: RecoveryJob, table_name: str):
+    """Delete one stretch of expired rows, checkpointing the cutoff and next id"""
+    checkpoint = json.loads(job.checkpoint) if job.checkpoint else {}
+    if 'cutoff' in checkpoint:
+        cutoff = datetime.fromisoformat(checkpoint['cutoff'])
+    else:
+        cutoff = RETENTION_POLICIES[table_name].cutoff()
+
+    stats = purge_expired(table_name, cutoff=cutoff, start_id=checkpoint.get('next_id'), requeue=False)
+
+    if not stats['complete']:
+        job.checkpoint = json.dumps({'cutoff': cutoff.isoformat(), 'next_id': stats['next_id']})
+    return stats['deleted'], stats['complete']
+
+
+def _finish(job: RecoveryJob):
+    job.status = 'completed'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    DataRecovery.invalidate_report_cache()
+    logger.info(f"Recovery job {job.id} ({job.action}) completed, {job.rows_processed} rows processed")
+
+
+@queued_db_operation(priority=PRIORITY_RECOVERY, coalesce=True)
+def resume_recovery_jobs(statuses=ACTIVE_STATUSES):
+    """
+    Queue the jobs left pending or running by a previous leader.
+
+    The leader also runs it periodically for pending jobs only, to pick up
+    those recorded by other processes. Jobs whose next step is already
+    queued are not queued twice.
+    """
+    jobs = RecoveryJob.query.filter(RecoveryJob.status.in_(statuses))\
+                            .order_by(RecoveryJob.created_at).all()
+    for job in jobs:
+        logger.info(f"Resuming recovery job {job.id} ({job.action}) at step {job.current_step}")
+        run_recovery_step(job.id)
+    return len(jobs)
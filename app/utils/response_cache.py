@@ -0,0 +1,148 @@
+import os
+import zlib
+import time
+import threading
+import logging
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict
+from datetime import datetime, timezone
+from flask import Response, request
+from werkzeug.http import http_date
+from app.utils.scrape_generation import scrape_generation
+from app.utils.timezone import paris_to_utc
+from app.utils.encoding import negotiated_format
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Per-process cache of API responses, valid until the next scrape.
+
+    Entries are keyed on the endpoint, its arguments and the scrape generation.
+    A scrape bumps the generation, so every entry computed before it stops
+    matching without explicit invalidation. Data that changes between scrapes,
+    such as detector results, is bounded by TTL windows: wall-clock slots of
+    `ttl` seconds, shared by all processes. An entry is only valid in the
+    window it was computed in.
+
+    The ETag is derived from the key, the generation and the window, and
+    Last-Modified is the later of the scrape time and the window start.
+    Conditional requests are therefore answered with 304 from the generation
+    file alone, without touching the database, and stop matching once the
+    window rolls over. A TTL of 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int = None, ttl: float = None):
+        self.max_entries = max_entries if max_entries is not None else \
+            int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+        self.ttl = ttl if ttl is not None else float(os.environ.get('RESPONSE_CACHE_TTL', 300))
+        self.entries: OrderedDict = OrderedDict()  # key -> (generation, window, body, mimetype)
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def _key() -> str:
+        args = '&'.join(f"{name}={value}" for name, value in sorted(request.args.items(multi=True)))
+        # Each negotiated representation is cached (and tagged) separately
+        return f"{request.endpoint}:{request.view_args or {}}:{args}:{negotiated_format()}"
+
+    def _window(self) -> int:
+        return int(time.time() // self.ttl)
+
+    @staticmethod
+    def _etag(key: str, generation: int, window: int) -> str:
+        return f"{generation}-{window}-{zlib.crc32(key.encode()):08x}"
+
+    def _last_modified(self, window: int):
+        # The scrape time is naive Paris time - HTTP dates are UTC
+        scraped = paris_to_utc(scrape_generation.last_updated())
+        window_start = datetime.fromtimestamp(window * self.ttl, tz=timezone.utc)
+        return max(scraped, window_start) if scraped else window_start
+
+    def _not_modified(self, etag: str, last_modified) -> bool:
+        if request.if_none_match:
+            # Compressed responses carry the weak form of the same tag
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if since is not None and last_modified is not None:
+            # HTTP dates have a one second resolution
+            return last_modified.replace(microsecond=0) <= since
+        return False
+
+    def _finish(self, response: Response, etag: str, last_modified) -> Response:
+        response.set_etag(etag)
+        response.headers['Last-Modified'] = http_date(last_modified)
+        # Let browsers keep the body but revalidate it on every poll
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def cached(self, view):
+        """Decorator for GET views whose output only changes when a scrape lands"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or self.ttl <= 0:
+                return view(*args, **kwargs)
+
+            generation = scrape_generation.current()
+            window = self._window()
+            last_modified = self._last_modified(window)
+            key = self._key()
+            etag = self._etag(key, generation, window)
+
+            if self._not_modified(etag, last_modified):
+                with self.lock:
+                    self.not_modified += 1
+                return self._finish(Response(status=304), etag, last_modified)
+
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry[0] == generation and entry[1] == window:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    response = Response(entry[2], mimetype=entry[3])
+                    response.vary.add('Accept')
+                    return self._finish(response, etag, last_modified)
+                self.misses += 1
+
+            response = view(*args, **kwargs)
+            if isinstance(response, tuple) or response.status_code != 200:
+                # Errors and explicit status codes are not cached
+                return response
+
+            with self.lock:
+                self.entries[key] = (generation, window, response.get_data(), response.mimetype)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+            return self._finish(response, etag, last_modified)
+
+        return wrapper
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'not_modified': self.not_modified,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'generation': scrape_generation.current()
+            }
+
+
+# Global response cache
+response_cache = ResponseCache()
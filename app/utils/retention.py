@@ -0,0 +1,147 @@
+import time
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy import delete, func, select
+from app import db
+from app.models import StationState, BikeSnapshot, BikeMovement
+from app.queue_manager import db_queue, PRIORITY_RECOVERY
+from app.utils.partitions import bike_snapshots, station_states, bike_movements
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy:
+    """How long rows of a table are kept, based on one of its timestamp columns"""
+
+    def __init__(self, model, timestamp_column, max_age: timedelta, partitions=None):
+        self.model = model
+        self.timestamp_column = timestamp_column
+        self.max_age = max_age
+        self.partitions = partitions  # TimePartitions holding the bulk of the rows, if any
+
+    @property
+    def table_name(self):
+        return self.model.__tablename__
+
+    def cutoff(self, now: datetime = None) -> datetime:
+        return (now or datetime.utcnow()) - self.max_age
+
+
+# Tables pruned by age - expired partitions are dropped, leftover rows go through the chunked deleter
+RETENTION_POLICIES: Dict[str, RetentionPolicy] = {
+    'station_states': RetentionPolicy(StationState, StationState.timestamp, timedelta(days=7), station_states),
+    'bike_snapshots': RetentionPolicy(BikeSnapshot, BikeSnapshot.timestamp, timedelta(days=7), bike_snapshots),
+    'bike_movements': RetentionPolicy(BikeMovement, BikeMovement.timestamp, timedelta(days=30), bike_movements),
+}
+
+
+class ChunkedDeleter:
+    """
+    Delete expired rows in bounded primary-key ranges.
+
+    Each batch is its own short transaction, so the SQLite write lock is
+    released between batches. When running on the queue worker, the deleter
+    stops as soon as more urgent tasks are waiting and reports where it
+    stopped so the remainder can be re-queued behind them.
+    """
+
+    def __init__(self, model, timestamp_column, batch_size=5000, progress_interval=10):
+        self.table = model.__table__
+        self.pk = self.table.primary_key.columns.values()[0]
+        self.timestamp_column = self.table.c[timestamp_column.key]
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval  # Log progress every N batches
+
+    def run(self, cutoff: datetime, start_id: Optional[int] = None, yield_to_queue: bool = True) -> Dict:
+        """Delete rows older than cutoff, optionally resuming from start_id"""
+        expired = self.timestamp_column < cutoff
+        bounds = db.session.execute(
+            select(func.min(self.pk), func.max(self.pk)).where(expired)
+        ).first()
+        first_id, last_id = bounds
+
+        stats = {
+            'table': self.table.name,
+            'cutoff': cutoff.isoformat(),
+            'deleted': 0,
+            'batches': 0,
+            'elapsed': 0.0,
+            'rows_per_second': 0.0,
+            'complete': True,
+            'next_id': None
+        }
+
+        if first_id is None:
+            return stats
+
+        lower = max(first_id, start_id or first_id)
+        span = max(last_id - first_id + 1, 1)
+        yielding = yield_to_queue and db_queue.on_worker_thread()
+        started = time.monotonic()
+
+        while lower <= last_id:
+            upper = lower + self.batch_size
+            result = db.session.execute(
+                delete(self.table).where(self.pk >= lower, self.pk < upper, expired)
+            )
+            db.session.commit()
+
+            stats['deleted'] += result.rowcount
+            stats['batches'] += 1
+            lower = upper
+
+            elapsed = time.monotonic() - started
+            stats['elapsed'] = round(elapsed, 3)
+            stats['rows_per_second'] = round(stats['deleted'] / elapsed, 1) if elapsed > 0 else 0.0
+
+            if stats['batches'] % self.progress_interval == 0:
+                progress = min(100.0, (lower - first_id) * 100.0 / span)
+                logger.info(f"Retention on {self.table.name}: {stats['deleted']} rows deleted "
+                            f"({progress:.0f}%, {stats['rows_per_second']:.0f} rows/s)")
+
+            if yielding and lower <= last_id and db_queue.has_pending(above_priority=PRIORITY_RECOVERY):
+                stats['complete'] = False
+                stats['next_id'] = lower
+                logger.info(f"Retention on {self.table.name} yielding to queued tasks at id {lower}")
+                break
+
+        return stats
+
+
+def purge_expired(table_name: str, cutoff: datetime = None, start_id: int = None,
+                  batch_size: int = 5000, requeue: bool = True) -> Dict:
+    """
+    Apply the retention policy of a table.
+
+    Whole partitions older than the cutoff are dropped first. Rows left in the
+    table itself are deleted in chunks; if the deleter yields to other queued
+    tasks, the remainder is queued again with the same cutoff and picks up at
+    the id where it stopped. Callers that track their own progress pass
+    requeue=False and resume from `next_id` themselves.
+    """
+    policy = RETENTION_POLICIES[table_name]
+    cutoff = cutoff or policy.cutoff()
+
+    partitions_dropped = 0
+    if policy.partitions is not None and start_id is None:
+        partitions_dropped = policy.partitions.drop_before(cutoff)
+
+    deleter = ChunkedDeleter(policy.model, policy.timestamp_column, batch_size=batch_size)
+    stats = deleter.run(cutoff, start_id=start_id)
+    stats['partitions_dropped'] = partitions_dropped
+
+    if stats['complete']:
+        logger.info(f"Retention on {table_name} finished: {partitions_dropped} partitions dropped, "
+                    f"{stats['deleted']} rows in {stats['batches']} batches, {stats['rows_per_second']:.0f} rows/s")
+    elif requeue:
+        db_queue.enqueue_task(purge_expired, table_name, cutoff=cutoff,
+                              start_id=stats['next_id'], batch_size=batch_size,
+                              priority=PRIORITY_RECOVERY, key=f"purge_expired:{table_name}")
+
+    return stats
+
+
+def purge_all_expired() -> Dict[str, Dict]:
+    """Apply every registered retention policy"""
+    return {name: purge_expired(name) for name in RETENTION_POLICIES}
@@ -0,0 +1,377 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy import case, delete, desc, event, func, insert, inspect, select, true
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.database import RoutingSession
+from app.models import Trip, TripRollup, StationRollup, RouteRollup, BikeRollup, RollupState
+from app.utils.time_buckets import time_bucket, epoch_bucket, bucket_start
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 86400
+
+# Same 5 minute filter as the speed statistics
+MIN_SPEED_TRIP_DURATION = 300
+
+ROLLUP_MODELS = (TripRollup, StationRollup, RouteRollup, BikeRollup)
+
+# RollupState row recording the last full rebuild
+STATE_NAME = 'trips'
+
+# Trip columns the rollups are computed from
+ROLLUP_COLUMNS = ('bike_id', 'start_station_id', 'end_station_id', 'start_time', 'end_time',
+                  'duration', 'distance', 'avg_speed', 'is_boomerang')
+
+
+class TripRollups:
+    """
+    Hourly (daily per bike) aggregates of the trips table.
+
+    Every flush that inserts, updates or deletes Trip rows folds the change
+    into the rollups within the same transaction, as upserts adding the
+    deltas. An updated trip is subtracted with its previous values and added
+    back with the new ones. The
+    statistics endpoints then sum a handful of buckets instead of aggregating
+    every trip in their window. Bulk deletes that bypass the session call
+    `subtract_where()`, and `rebuild()` recomputes everything from the trips table.
+
+    Windows are read at bucket granularity: a window starting at 14:20 reads
+    from the 14:00 bucket (per-bike windows from midnight).
+    """
+
+    # ------------------------------------------------------------------
+    # Incremental maintenance
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _add(rows: Dict, key: tuple, **values):
+        row = rows.setdefault(key, defaultdict(int))
+        for column, value in values.items():
+            row[column] += value
+
+    def _contribute(self, deltas: Dict, trip, sign: int):
+        if trip.start_time is None:
+            return
+
+        hour = epoch_bucket(trip.start_time, HOUR)
+        measures = dict(
+            duration_sum=(trip.duration or 0) * sign,
+            duration_count=sign if trip.duration is not None else 0,
+            distance_sum=(trip.distance or 0) * sign,
+            distance_count=sign if trip.distance is not None else 0
+        )
+        boomerang = sign if trip.is_boomerang else 0
+
+        self._add(deltas[TripRollup], (hour,), trip_count=sign, boomerang_count=boomerang, **measures)
+        self._add(deltas[RouteRollup], (hour, trip.start_station_id, trip.end_station_id),
+                  trip_count=sign, speed_sum=(trip.avg_speed or 0) * sign,
+                  speed_count=sign if trip.avg_speed is not None else 0, **measures)
+        self._add(deltas[StationRollup], (trip.start_station_id, hour), departures=sign)
+        if trip.end_time is not None:
+            self._add(deltas[StationRollup], (trip.end_station_id, epoch_bucket(trip.end_time, HOUR)),
+                      arrivals=sign)
+
+        fast = trip.duration is not None and trip.duration > MIN_SPEED_TRIP_DURATION \
+            and trip.avg_speed is not None
+        self._add(deltas[BikeRollup], (trip.bike_id, epoch_bucket(trip.start_time, DAY)),
+                  trip_count=sign, boomerang_count=boomerang,
+                  speed_sum=trip.avg_speed * sign if fast else 0,
+                  speed_count=sign if fast else 0)
+
+    def apply(self, connection, added: Iterable = (), removed: Iterable = ()):
+        """Fold inserted and deleted trips (ORM instances or rows) into the rollups"""
+        deltas = {model: {} for model in ROLLUP_MODELS}
+        for trip in added:
+            self._contribute(deltas, trip, 1)
+        for trip in removed:
+            self._contribute(deltas, trip, -1)
+
+        dialect_insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+        for model, rows in deltas.items():
+            if rows:
+                self._upsert(connection, dialect_insert, model, rows)
+
+    @staticmethod
+    def _upsert(connection, dialect_insert, model, rows: Dict):
+        table = model.__table__
+        keys = [column.name for column in table.primary_key.columns]
+        values = [column.name for column in table.columns if column.name not in keys]
+
+        params = []
+        for key, measures in rows.items():
+            row = dict(zip(keys, key))
+            row.update({column: measures.get(column, 0) for column in values})
+            params.append(row)
+
+        stmt = dialect_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=keys,
+            set_={column: table.c[column] + stmt.excluded[column] for column in values}
+        )
+        connection.execute(stmt, params)
+
+    def subtract_where(self, condition):
+        """
+        Remove the trips matching `condition` from the rollups, before a bulk
+        DELETE of the same trips bypasses the session.
+
+        The trips are aggregated per bucket in SQL, like a rebuild, and the
+        negated aggregates are upserted - no Trip row is loaded.
+        """
+        connection = db.session.connection()
+        dialect_insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+        for model, rows in self._aggregate(condition, condition, condition).items():
+            keys = [column.name for column in model.__table__.primary_key.columns]
+            negated = {
+                tuple(row[key] for key in keys): {column: -value for column, value in row.items() if column not in keys}
+                for row in rows
+            }
+            if negated:
+                self._upsert(connection, dialect_insert, model, negated)
+
+    # ------------------------------------------------------------------
+    # Rebuild
+    # ------------------------------------------------------------------
+
+    def rebuild(self, since: datetime = None) -> int:
+        """Recompute the rollups from the trips table, from `since` or over the whole history"""
+        since_hour = bucket_start(epoch_bucket(since, HOUR)) if since else None
+        since_day = bucket_start(epoch_bucket(since, DAY)) if since else None
+
+        def after(column, start):
+            return column >= start if start is not None else true()
+
+        for column, start, width in ((TripRollup.bucket, since_hour, HOUR),
+                                     (RouteRollup.bucket, since_hour, HOUR),
+                                     (StationRollup.bucket, since_hour, HOUR),
+                                     (BikeRollup.day, since_day, DAY)):
+            db.session.execute(delete(column.class_).where(
+                after(column, epoch_bucket(start, width) if start is not None else None)))
+
+        aggregates = self._aggregate(after(Trip.start_time, since_hour), after(Trip.end_time, since_hour),
+                                     after(Trip.start_time, since_day))
+
+        written = 0
+        for model, rows in aggregates.items():
+            for offset in range(0, len(rows), 1000):
+                db.session.execute(insert(model), rows[offset:offset + 1000])
+            written += len(rows)
+
+        if since is None:
+            # Everything up to here is now covered, whatever the listener wrote before
+            db.session.merge(RollupState(name=STATE_NAME, rebuilt_at=datetime.utcnow(),
+                                         max_trip_id=db.session.query(func.max(Trip.id)).scalar()))
+
+        logger.info(f"Rebuilt trip rollups{f' since {since}' if since else ''}: {written} rows")
+        return written
+
+    def is_backfilled(self) -> bool:
+        """Whether a full rebuild has folded in the trips recorded before the rollups existed"""
+        return db.session.get(RollupState, STATE_NAME) is not None
+
+    @staticmethod
+    def _aggregate(by_start, by_end, by_day) -> Dict:
+        """
+        Rollup rows computed from the trips table, per model.
+
+        `by_start` filters trips counted by start hour, `by_end` arrivals
+        counted by end hour and `by_day` the per-bike days.
+        """
+        hour = time_bucket(Trip.start_time, HOUR)
+        measures = (
+            func.coalesce(func.sum(Trip.duration), 0),
+            func.count(Trip.duration),
+            func.coalesce(func.sum(Trip.distance), 0),
+            func.count(Trip.distance)
+        )
+        boomerangs = func.sum(case((Trip.is_boomerang == True, 1), else_=0))
+
+        trips = [
+            dict(bucket=row[0], trip_count=row[1], boomerang_count=row[2], duration_sum=row[3],
+                 duration_count=row[4], distance_sum=row[5], distance_count=row[6])
+            for row in db.session.execute(
+                select(hour, func.count(Trip.id), boomerangs, *measures)
+                .where(by_start).group_by(hour)
+            )
+        ]
+
+        routes = [
+            dict(bucket=row[0], start_station_id=row[1], end_station_id=row[2], trip_count=row[3],
+                 duration_sum=row[4], duration_count=row[5], distance_sum=row[6], distance_count=row[7],
+                 speed_sum=row[8], speed_count=row[9])
+            for row in db.session.execute(
+                select(hour, Trip.start_station_id, Trip.end_station_id, func.count(Trip.id), *measures,
+                       func.coalesce(func.sum(Trip.avg_speed), 0), func.count(Trip.avg_speed))
+                .where(by_start)
+                .group_by(hour, Trip.start_station_id, Trip.end_station_id)
+            )
+        ]
+
+        stations = {}
+        for station_id, bucket, count in db.session.execute(
+                select(Trip.start_station_id, hour, func.count(Trip.id))
+                .where(by_start).group_by(Trip.start_station_id, hour)):
+            stations[(station_id, bucket)] = dict(station_id=station_id, bucket=bucket,
+                                                  departures=count, arrivals=0)
+        end_hour = time_bucket(Trip.end_time, HOUR)
+        for station_id, bucket, count in db.session.execute(
+                select(Trip.end_station_id, end_hour, func.count(Trip.id))
+                .where(by_end).group_by(Trip.end_station_id, end_hour)):
+            row = stations.setdefault((station_id, bucket), dict(station_id=station_id, bucket=bucket,
+                                                                 departures=0, arrivals=0))
+            row['arrivals'] = count
+
+        day = time_bucket(Trip.start_time, DAY)
+        fast = (Trip.duration > MIN_SPEED_TRIP_DURATION) & Trip.avg_speed.isnot(None)
+        bikes = [
+            dict(bike_id=row[0], day=row[1], trip_count=row[2], boomerang_count=row[3],
+                 speed_sum=row[4], speed_count=row[5])
+            for row in db.session.execute(
+                select(Trip.bike_id, day, func.count(Trip.id), boomerangs,
+                       func.coalesce(func.sum(case((fast, Trip.avg_speed), else_=0)), 0),
+                       func.sum(case((fast, 1), else_=0)))
+                .where(by_day).group_by(Trip.bike_id, day)
+            )
+        ]
+
+        return {TripRollup: trips, RouteRollup: routes, StationRollup: list(stations.values()), BikeRollup: bikes}
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _average(total, count, digits=None):
+        if not count:
+            return 0
+        return round(total / count, digits) if digits is not None else round(total / count)
+
+    def hourly_activity(self, since: datetime) -> List[Dict]:
+        """Trips by hour of day since a time"""
+        hour = (TripRollup.bucket % DAY) // HOUR
+        rows = db.session.query(
+            hour.label('hour'),
+            func.sum(TripRollup.trip_count).label('trip_count'),
+            func.sum(TripRollup.duration_sum).label('duration_sum'),
+            func.sum(TripRollup.duration_count).label('duration_count'),
+            func.sum(TripRollup.distance_sum).label('distance_sum'),
+            func.sum(TripRollup.distance_count).label('distance_count')
+        ).filter(
+            TripRollup.bucket >= epoch_bucket(since, HOUR)
+        ).group_by(hour).order_by(hour).all()
+
+        return [
+            {
+                'hour': int(row.hour),
+                'trip_count': row.trip_count,
+                'avg_duration': self._average(row.duration_sum, row.duration_count),
+                'avg_distance': self._average(row.distance_sum, row.distance_count, 2)
+            }
+            for row in rows if row.trip_count
+        ]
+
+    def popular_routes(self, since: datetime, limit: int = 20):
+        """Most travelled origin-destination pairs since a time, boomerangs excluded"""
+        trip_count = func.sum(RouteRollup.trip_count)
+        return db.session.query(
+            RouteRollup.start_station_id,
+            RouteRollup.end_station_id,
+            trip_count.label('trip_count'),
+            func.sum(RouteRollup.duration_sum).label('duration_sum'),
+            func.sum(RouteRollup.duration_count).label('duration_count'),
+            func.sum(RouteRollup.distance_sum).label('distance_sum'),
+            func.sum(RouteRollup.distance_count).label('distance_count'),
+            func.sum(RouteRollup.speed_sum).label('speed_sum'),
+            func.sum(RouteRollup.speed_count).label('speed_count')
+        ).filter(
+            RouteRollup.bucket >= epoch_bucket(since, HOUR),
+            RouteRollup.start_station_id != RouteRollup.end_station_id
+        ).group_by(
+            RouteRollup.start_station_id, RouteRollup.end_station_id
+        ).having(trip_count > 0).order_by(desc('trip_count')).limit(limit).all()
+
+    def station_activity(self, station_id: int, since: datetime) -> Dict:
+        """Departures and arrivals of a station since a time"""
+        row = db.session.query(
+            func.coalesce(func.sum(StationRollup.departures), 0),
+            func.coalesce(func.sum(StationRollup.arrivals), 0)
+        ).filter(
+            StationRollup.station_id == station_id,
+            StationRollup.bucket >= epoch_bucket(since, HOUR)
+        ).one()
+        return {'departures': int(row[0]), 'arrivals': int(row[1])}
+
+    def busiest_station(self, since: datetime):
+        """(station_id, departures + arrivals) of the busiest station since a time"""
+        activity = func.sum(StationRollup.departures + StationRollup.arrivals)
+        return db.session.query(
+            StationRollup.station_id, activity.label('activity_count')
+        ).filter(
+            StationRollup.bucket >= epoch_bucket(since, HOUR)
+        ).group_by(StationRollup.station_id).having(activity > 0)\
+         .order_by(desc('activity_count')).first()
+
+    def top_bike(self, since: datetime, measure: str) -> Optional[tuple]:
+        """(bike_id, value) of the bike leading on trips, boomerangs or average speed since a time"""
+        if measure == 'avg_speed':
+            value = func.sum(BikeRollup.speed_sum) / func.sum(BikeRollup.speed_count)
+            having = func.sum(BikeRollup.speed_count) > 0
+        else:
+            value = func.sum(getattr(BikeRollup, measure))
+            having = value > 0
+        return db.session.query(
+            BikeRollup.bike_id, value.label('value')
+        ).filter(
+            BikeRollup.day >= epoch_bucket(since, DAY)
+        ).group_by(BikeRollup.bike_id).having(having).order_by(desc('value')).first()
+
+
+# Global rollup maintainer
+trip_rollups = TripRollups()
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    # Registered with active_history, so the value being replaced is loaded first
+    pass
+
+
+for _column in ROLLUP_COLUMNS:
+    event.listen(getattr(Trip, _column), 'set', _load_previous_value, active_history=True)
+
+
+def _changed_rollup_columns(trip) -> bool:
+    state = inspect(trip)
+    return any(state.attrs[column].history.has_changes() for column in ROLLUP_COLUMNS)
+
+
+def _previous(trip) -> SimpleNamespace:
+    """The trip as the rollups last counted it, from the attribute history"""
+    state = inspect(trip)
+    values = {}
+    for column in ROLLUP_COLUMNS:
+        history = state.attrs[column].history
+        if history.has_changes():
+            # A replaced None is not kept in the history
+            values[column] = history.deleted[0] if history.deleted else None
+        else:
+            values[column] = getattr(trip, column)
+    return SimpleNamespace(**values)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def fold_flushed_trips(session, flush_context):
+    """Keep the rollups in step with every Trip the session inserts, updates or deletes"""
+    added = [obj for obj in session.new if isinstance(obj, Trip)]
+    removed = [obj for obj in session.deleted if isinstance(obj, Trip)]
+
+    updated = [obj for obj in session.dirty if isinstance(obj, Trip) and _changed_rollup_columns(obj)]
+    removed += [_previous(obj) for obj in updated]
+    added += updated
+
+    if added or removed:
+        trip_rollups.apply(session.connection(), added, removed)
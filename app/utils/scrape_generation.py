@@ -0,0 +1,87 @@
+import os
+import json
+import threading
+import logging
+from datetime import datetime
+from typing import Optional
+from flask import current_app
+from app.utils.timezone import get_paris_time
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapeGeneration:
+    """
+    Monotonic counter bumped after every committed scrape.
+
+    The value lives in a small file next to the instance data so that every
+    process (scheduler and web workers alike) sees the same generation without
+    querying the database. Readers only re-read the file when its mtime changes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.timestamp: Optional[datetime] = None
+        self.file_version = None
+
+    def _resolve_path(self):
+        if not self.path:
+            if 'SCRAPE_GENERATION_PATH' in os.environ:
+                self.path = os.environ['SCRAPE_GENERATION_PATH']
+            else:
+                self.path = os.path.join(current_app.instance_path, 'scrape_generation.json')
+        return self.path
+
+    def _reload(self):
+        path = self._resolve_path()
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version == self.file_version:
+            return
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.generation = int(data['generation'])
+            self.timestamp = datetime.fromisoformat(data['timestamp']) if data.get('timestamp') else None
+            self.file_version = version
+        except (ValueError, KeyError, OSError) as e:
+            logger.warning(f"Could not read scrape generation from {path}: {e}")
+
+    def current(self) -> int:
+        """Latest committed scrape generation"""
+        with self.lock:
+            self._reload()
+            return self.generation
+
+    def last_updated(self) -> Optional[datetime]:
+        """Time of the scrape that produced the current generation (naive Paris time)"""
+        with self.lock:
+            self._reload()
+            return self.timestamp
+
+    def bump(self, timestamp: datetime = None) -> int:
+        """Publish a new generation once a scrape has been committed"""
+        with self.lock:
+            self._reload()
+            self.generation += 1
+            self.timestamp = timestamp or get_paris_time()
+
+            path = self._resolve_path()
+            tmp_path = f"{path}.tmp"
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'generation': self.generation, 'timestamp': self.timestamp.isoformat()}, f)
+            os.replace(tmp_path, path)
+
+            stat = os.stat(path)
+            self.file_version = (stat.st_mtime_ns, stat.st_size)
+            return self.generation
+
+
+# Global generation counter
+scrape_generation = ScrapeGeneration()
@@ -0,0 +1,194 @@
+import os
+import math
+import heapq
+import threading
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func
+from app import db
+from app.models import Station
+from app.utils.scrape_generation import scrape_generation
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 111.195  # Along a meridian, for the same earth radius
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Great-circle distance in km"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class StationIndex:
+    """
+    Uniform grid over station coordinates for radius, nearest and bounding-box queries.
+
+    Cells are CELL_KM wide (longitude cells are sized at the mean latitude of
+    the stations), so a query only looks at the handful of cells around it and
+    its cost does not depend on how many stations there are. Distances are
+    haversine.
+
+    The grid holds ids and coordinates only. It is checked once per scrape
+    generation against an aggregate of the stations table, and rebuilt only when
+    stations were added, removed or moved.
+    """
+
+    def __init__(self, cell_km: float = None):
+        self.cell_km = cell_km if cell_km is not None else float(os.environ.get('STATION_INDEX_CELL_KM', 0.5))
+        self.lock = threading.Lock()
+        self.cells: Dict[Tuple[int, int], List[Tuple[int, float, float]]] = {}
+        self.cell_lat = self.cell_km / KM_PER_DEGREE
+        self.cell_lon = self.cell_lat
+        self.bounds: Optional[Tuple[int, int, int, int]] = None  # min/max cell x and y
+        self.size = 0
+
+        self.signature = None
+        self.checked_generation = None
+        self.builds = 0
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return int(math.floor(lon / self.cell_lon)), int(math.floor(lat / self.cell_lat))
+
+    def _refresh(self):
+        generation = scrape_generation.current()
+        if generation == self.checked_generation:
+            return
+
+        # Any insert, delete or coordinate change moves this aggregate
+        signature = tuple(db.session.query(
+            func.count(Station.id), func.max(Station.id),
+            func.sum(Station.latitude), func.sum(Station.longitude)
+        ).one())
+
+        if signature != self.signature:
+            self._build(db.session.query(Station.id, Station.latitude, Station.longitude).all())
+            self.signature = signature
+        self.checked_generation = generation
+
+    def _build(self, rows):
+        rows = [row for row in rows if row.latitude is not None and row.longitude is not None]
+
+        mean_lat = sum(row.latitude for row in rows) / len(rows) if rows else 0.0
+        self.cell_lat = self.cell_km / KM_PER_DEGREE
+        self.cell_lon = self.cell_km / (KM_PER_DEGREE * max(math.cos(math.radians(mean_lat)), 0.01))
+
+        cells = defaultdict(list)
+        for row in rows:
+            cells[self._cell(row.latitude, row.longitude)].append((row.id, row.latitude, row.longitude))
+
+        self.cells = dict(cells)
+        self.size = len(rows)
+        if cells:
+            xs = [x for x, _ in cells]
+            ys = [y for _, y in cells]
+            self.bounds = (min(xs), max(xs), min(ys), max(ys))
+        else:
+            self.bounds = None
+        self.builds += 1
+        logger.info(f"Built station index: {self.size} stations in {len(self.cells)} cells")
+
+    def _ring(self, cx: int, cy: int, r: int):
+        """Entries of the cells exactly r cells away (Chebyshev) from (cx, cy)"""
+        if r == 0:
+            yield from self.cells.get((cx, cy), ())
+            return
+        for x in range(cx - r, cx + r + 1):
+            yield from self.cells.get((x, cy - r), ())
+            yield from self.cells.get((x, cy + r), ())
+        for y in range(cy - r + 1, cy + r):
+            yield from self.cells.get((cx - r, y), ())
+            yield from self.cells.get((cx + r, y), ())
+
+    def _ring_clearance_km(self, lat: float, r: int) -> float:
+        # Every point closer than this lies within rings 0..r
+        lon_km = self.cell_lon * KM_PER_DEGREE * math.cos(math.radians(lat))
+        return r * min(self.cell_lat * KM_PER_DEGREE, lon_km)
+
+    def within_radius(self, lat: float, lon: float, radius_km: float) -> List[Tuple[int, float]]:
+        """(station id, km) of stations within radius_km, nearest first"""
+        with self.lock:
+            self._refresh()
+            cx, cy = self._cell(lat, lon)
+            rings_y = int(math.ceil(radius_km / (self.cell_lat * KM_PER_DEGREE)))
+            lon_km = self.cell_lon * KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01)
+            rings_x = int(math.ceil(radius_km / lon_km))
+
+            found = []
+            for x in range(cx - rings_x, cx + rings_x + 1):
+                for y in range(cy - rings_y, cy + rings_y + 1):
+                    for station_id, s_lat, s_lon in self.cells.get((x, y), ()):
+                        distance = haversine_km(lat, lon, s_lat, s_lon)
+                        if distance <= radius_km:
+                            found.append((station_id, distance))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def nearest(self, lat: float, lon: float, k: int, max_km: float = None) -> List[Tuple[int, float]]:
+        """(station id, km) of the k nearest stations, optionally no further than max_km"""
+        with self.lock:
+            self._refresh()
+            if not self.bounds or k <= 0:
+                return []
+            cx, cy = self._cell(lat, lon)
+            min_x, max_x, min_y, max_y = self.bounds
+            # Beyond this ring every cell is outside the grid
+            last_ring = max(abs(cx - min_x), abs(cx - max_x), abs(cy - min_y), abs(cy - max_y))
+
+            best = []  # Max-heap on distance, as (-km, id)
+            r = 0
+            while r <= last_ring:
+                for station_id, s_lat, s_lon in self._ring(cx, cy, r):
+                    distance = haversine_km(lat, lon, s_lat, s_lon)
+                    if max_km is not None and distance > max_km:
+                        continue
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, station_id))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, station_id))
+
+                clearance = self._ring_clearance_km(lat, r)
+                if len(best) == k and -best[0][0] <= clearance:
+                    break
+                if max_km is not None and clearance >= max_km:
+                    break
+                r += 1
+
+        return sorted(((station_id, -negative) for negative, station_id in best), key=lambda item: item[1])
+
+    def in_bbox(self, south: float, west: float, north: float, east: float) -> List[int]:
+        """Ids of stations inside a bounding box"""
+        with self.lock:
+            self._refresh()
+            if not self.bounds:
+                return []
+            min_x, max_x, min_y, max_y = self.bounds
+            x0, y0 = self._cell(south, west)
+            x1, y1 = self._cell(north, east)
+
+            found = []
+            for x in range(max(x0, min_x), min(x1, max_x) + 1):
+                for y in range(max(y0, min_y), min(y1, max_y) + 1):
+                    for station_id, s_lat, s_lon in self.cells.get((x, y), ()):
+                        if south <= s_lat <= north and west <= s_lon <= east:
+                            found.append(station_id)
+        return found
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                'stations': self.size,
+                'cells': len(self.cells),
+                'cell_km': self.cell_km,
+                'builds': self.builds,
+                'checked_generation': self.checked_generation
+            }
+
+
+# Global station index
+station_index = StationIndex()
@@ -0,0 +1,66 @@
+import os
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+from sqlalchemy import delete, insert
+from app import db
+from app.models import Station, StationChange
+
+logger = logging.getLogger(__name__)
+
+# Generations kept in the change log - clients further behind get the full list
+KEEP_GENERATIONS = int(os.environ.get('STATION_CHANGE_GENERATIONS', 60))
+
+# Station fields that change from one scrape to the next
+DYNAMIC_FIELDS = ('nb_bike', 'nb_ebike', 'nb_free_dock', 'nb_free_edock', 'total_capacity',
+                  'credit_card', 'kiosk_state', 'state')
+
+
+def dynamic_state(station: Station) -> tuple:
+    return tuple(getattr(station, field) for field in DYNAMIC_FIELDS)
+
+
+def record_station_changes(generation: int, timestamp: datetime, changed_ids: Iterable[int],
+                           previous_scrape: Optional[datetime] = None) -> int:
+    """
+    Log the stations changed by the scrape that will publish `generation`.
+
+    Stations that were in the previous scrape (updated_at == its timestamp)
+    but are no longer in this one are logged as removed. Runs in the scrape's
+    transaction, so the log and the station rows become visible together.
+    """
+    rows = [dict(generation=generation, station_id=station_id, change_type='updated', timestamp=timestamp)
+            for station_id in changed_ids]
+
+    if previous_scrape is not None:
+        gone = db.session.query(Station.id).filter(Station.updated_at == previous_scrape).all()
+        rows += [dict(generation=generation, station_id=station_id, change_type='removed', timestamp=timestamp)
+                 for (station_id,) in gone]
+
+    if rows:
+        db.session.execute(insert(StationChange), rows)
+
+    db.session.execute(delete(StationChange).where(StationChange.generation <= generation - KEEP_GENERATIONS))
+    return len(rows)
+
+
+def changes_since(since: int, current: int) -> Optional[Dict]:
+    """Stations updated and removed after generation `since`, None if the log cannot answer"""
+    if since > current or since < current - KEEP_GENERATIONS:
+        return None
+
+    latest = {}
+    if since < current:
+        rows = db.session.query(StationChange.station_id, StationChange.change_type).filter(
+            StationChange.generation > since,
+            StationChange.generation <= current
+        ).order_by(StationChange.generation).all()
+        # The last change of each station wins
+        for station_id, change_type in rows:
+            latest[station_id] = change_type
+
+    stations = Station.query.filter(Station.id.in_(latest)).all() if latest else []
+    return {
+        'updated': [station for station in stations if latest[station.id] == 'updated'],
+        'removed': [station.code for station in stations if latest[station.id] == 'removed']
+    }
@@ -0,0 +1,152 @@
+import os
+import math
+import threading
+import logging
+from typing import Dict, List, Optional, Tuple
+from app import db
+from app.models import Station
+from app.utils.scrape_generation import scrape_generation
+
+logger = logging.getLogger(__name__)
+
+CELLS_PER_TILE = 4  # Cells across a 256px map tile, so about one cluster per 64px
+
+
+class StationClusters:
+    """
+    Station aggregates per map zoom level, from a hierarchical grid.
+
+    The finest level has cells of 1/CELLS_PER_TILE of a map tile at
+    max_zoom - 1. Each coarser level halves the resolution, so a cell at
+    zoom z is the union of four cells at z + 1 and is built by merging them
+    rather than by going back to the stations. Latitude cells are scaled by
+    the cosine of the mean latitude to stay roughly square on screen.
+
+    Everything is rebuilt from one query once per scrape generation. Requests
+    only walk the cells of their viewport.
+    """
+
+    def __init__(self, max_zoom: int = None):
+        # From this zoom on, stations are returned one by one
+        self.max_zoom = max_zoom if max_zoom is not None else int(os.environ.get('CLUSTER_MAX_ZOOM', 15))
+        self.lock = threading.Lock()
+        self.levels: Dict[int, Dict[Tuple[int, int], Dict]] = {}
+        self.stations: List[Dict] = []
+        self.cell_lon = 0.0
+        self.cell_lat = 0.0
+        self.generation = None
+
+    def _finest_zoom(self) -> int:
+        return self.max_zoom - 1
+
+    def _cell(self, lat: float, lon: float, zoom: int) -> Tuple[int, int]:
+        scale = 2 ** (self._finest_zoom() - zoom)
+        return (int(math.floor(lon / (self.cell_lon * scale))),
+                int(math.floor(lat / (self.cell_lat * scale))))
+
+    def _refresh(self):
+        generation = scrape_generation.current()
+        if generation == self.generation:
+            return
+
+        rows = db.session.query(
+            Station.code, Station.latitude, Station.longitude,
+            Station.nb_bike, Station.nb_ebike, Station.total_capacity
+        ).filter(Station.latitude.isnot(None), Station.longitude.isnot(None)).all()
+
+        mean_lat = sum(row.latitude for row in rows) / len(rows) if rows else 0.0
+        self.cell_lon = 360.0 / (2 ** self._finest_zoom()) / CELLS_PER_TILE
+        self.cell_lat = self.cell_lon * math.cos(math.radians(mean_lat))
+
+        self.stations = [{
+            'code': row.code,
+            'lat': row.latitude,
+            'lon': row.longitude,
+            'count': 1,
+            'bikes': row.nb_bike or 0,
+            'ebikes': row.nb_ebike or 0,
+            'capacity': row.total_capacity or 0
+        } for row in rows]
+
+        finest = {}
+        for station in self.stations:
+            key = self._cell(station['lat'], station['lon'], self._finest_zoom())
+            self._merge(finest, key, {**station, 'lat_sum': station['lat'], 'lon_sum': station['lon']})
+
+        levels = {self._finest_zoom(): finest}
+        for zoom in range(self._finest_zoom() - 1, -1, -1):
+            level = {}
+            for (x, y), cell in levels[zoom + 1].items():
+                self._merge(level, (x >> 1, y >> 1), cell)
+            levels[zoom] = level
+
+        self.levels = levels
+        self.generation = generation
+        logger.debug(f"Rebuilt station clusters for generation {generation}: {len(self.stations)} stations")
+
+    @staticmethod
+    def _merge(level: Dict, key: Tuple[int, int], item: Dict):
+        cell = level.get(key)
+        if cell is None:
+            level[key] = {
+                'lat_sum': item['lat_sum'],
+                'lon_sum': item['lon_sum'],
+                'count': item['count'],
+                'bikes': item['bikes'],
+                'ebikes': item['ebikes'],
+                'capacity': item['capacity'],
+                'code': item.get('code')
+            }
+            return
+        cell['lat_sum'] += item['lat_sum']
+        cell['lon_sum'] += item['lon_sum']
+        cell['count'] += item['count']
+        cell['bikes'] += item['bikes']
+        cell['ebikes'] += item['ebikes']
+        cell['capacity'] += item['capacity']
+        cell['code'] = None  # Only single-station cells point at a station
+
+    @staticmethod
+    def _output(cell: Dict) -> Dict:
+        bikes = cell['bikes'] + cell['ebikes']
+        return {
+            'lat': round(cell['lat_sum'] / cell['count'], 6),
+            'lon': round(cell['lon_sum'] / cell['count'], 6),
+            'count': cell['count'],
+            'bikes': cell['bikes'],
+            'ebikes': cell['ebikes'],
+            'fill_ratio': round(bikes / cell['capacity'], 3) if cell['capacity'] else None,
+            'code': cell['code']
+        }
+
+    def clusters(self, zoom: int, bbox: Optional[Tuple[float, float, float, float]] = None) -> List[Dict]:
+        """Clusters of the cells overlapping bbox, or single stations inside it from max_zoom on"""
+        zoom = max(zoom, 0)
+        with self.lock:
+            self._refresh()
+
+            if zoom >= self.max_zoom:
+                cells = [{**station, 'lat_sum': station['lat'], 'lon_sum': station['lon']}
+                         for station in self.stations
+                         if bbox is None or (bbox[0] <= station['lat'] <= bbox[2]
+                                             and bbox[1] <= station['lon'] <= bbox[3])]
+                return [self._output(cell) for cell in cells]
+
+            level = self.levels.get(zoom, {})
+            if bbox is None:
+                candidates = level.values()
+            else:
+                south, west, north, east = bbox
+                x0, y0 = self._cell(south, west, zoom)
+                x1, y1 = self._cell(north, east, zoom)
+                if (x1 - x0 + 1) * (y1 - y0 + 1) < len(level):
+                    candidates = [level[(x, y)] for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                                  if (x, y) in level]
+                else:
+                    candidates = [cell for (x, y), cell in level.items() if x0 <= x <= x1 and y0 <= y <= y1]
+
+            return [self._output(cell) for cell in candidates]
+
+
+# Global cluster grid
+station_clusters = StationClusters()
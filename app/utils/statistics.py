@@ -3,6 +3,7 @@ from typing import Dict, List, Tuple
 from sqlalchemy import func, desc
 from app import db
 from app.models import Bike, Trip, Station, MalfunctionLog
+from app.utils.rollups import trip_rollups
 import logging
 
 logger = logging.getLogger(__name__)
@@ -75,15 +76,8 @@ class StatisticsCalculator:
         cutoff = datetime.utcnow() - timedelta(hours=hours)
         
         # Departure and arrival counts
-        departures = Trip.query.filter(
-            Trip.start_station_id == station_id,
-            Trip.start_time >= cutoff
-        ).count()
-        
-        arrivals = Trip.query.filter(
-            Trip.end_station_id == station_id,
-            Trip.end_time >= cutoff
-        ).count()
+        activity = trip_rollups.station_activity(station_id, cutoff)
+        departures, arrivals = activity['departures'], activity['arrivals']
         
         # Average dwell time (time bikes spend at station)
         # This would require more complex logic with snapshots
@@ -100,22 +94,7 @@ class StatisticsCalculator:
         """Get most popular routes in the system"""
         cutoff = datetime.utcnow() - timedelta(hours=hours)
         
-        routes = db.session.query(
-            Trip.start_station_id,
-            Trip.end_station_id,
-            func.count(Trip.id).label('trip_count'),
-            func.avg(Trip.duration).label('avg_duration'),
-            func.avg(Trip.distance).label('avg_distance'),
-            func.avg(Trip.avg_speed).label('avg_speed')
-        ).filter(
-            Trip.start_time >= cutoff,
-            Trip.start_station_id != Trip.end_station_id
-        ).group_by(
-            Trip.start_station_id,
-            Trip.end_station_id
-        ).order_by(
-            desc('trip_count')
-        ).limit(limit).all()
+        routes = trip_rollups.popular_routes(cutoff, limit)
         
         result = []
         for route in routes:
@@ -134,10 +113,10 @@ class StatisticsCalculator:
                         'code': end_station.code,
                         'name': end_station.name
                     },
-                    'trip_count': route.trip_count,
-                    'avg_duration': round(route.avg_duration or 0),
-                    'avg_distance': round(route.avg_distance or 0, 2),
-                    'avg_speed': round(route.avg_speed or 0, 2)
+                    'trip_count': int(route.trip_count),
+                    'avg_duration': round(route.duration_sum / route.duration_count) if route.duration_count else 0,
+                    'avg_distance': round(route.distance_sum / route.distance_count, 2) if route.distance_count else 0,
+                    'avg_speed': round(route.speed_sum / route.speed_count, 2) if route.speed_count else 0
                 })
         
         return result
@@ -146,24 +125,7 @@ class StatisticsCalculator:
         """Get usage patterns by hour of day"""
         cutoff = datetime.utcnow() - timedelta(days=days)
         
-        patterns = db.session.query(
-            func.extract('hour', Trip.start_time).label('hour'),
-            func.count(Trip.id).label('trip_count'),
-            func.avg(Trip.duration).label('avg_duration'),
-            func.avg(Trip.distance).label('avg_distance')
-        ).filter(
-            Trip.start_time >= cutoff
-        ).group_by('hour').order_by('hour').all()
-        
-        return [
-            {
-                'hour': int(p.hour),
-                'trip_count': p.trip_count,
-                'avg_duration': round(p.avg_duration or 0),
-                'avg_distance': round(p.avg_distance or 0, 2)
-            }
-            for p in patterns
-        ]
+        return trip_rollups.hourly_activity(cutoff)
     
     def get_system_health_score(self) -> Dict:
         """Calculate overall system health metrics"""
@@ -0,0 +1,66 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import Integer, literal_column
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+# Supported bucket widths in minutes (1440 = one day)
+BUCKET_MINUTES = (1, 5, 15, 60, 1440)
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_seconds(minutes: int) -> Optional[int]:
+    """Width in seconds for a supported bucket size, None if unsupported"""
+    return minutes * 60 if minutes in BUCKET_MINUTES else None
+
+
+class time_bucket(FunctionElement):
+    """
+    Start of the fixed-width bucket a timestamp falls in, as epoch seconds.
+
+    Buckets are aligned on the Unix epoch, so one-day buckets start at
+    midnight of the stored (naive) timestamps. Only the selected and grouped
+    value is computed - range filters should stay on the raw column so they
+    keep using its index.
+
+    Usage:
+        bucket = time_bucket(Snapshot.timestamp, 15 * 60)
+        db.session.query(bucket.label('bucket'), func.count()).group_by(bucket)
+    """
+    type = Integer()
+    inherit_cache = True
+    name = 'time_bucket'
+
+    def __init__(self, column, seconds: int):
+        # The width is rendered inline so it is part of the statement's cache key
+        super().__init__(column, literal_column(str(int(seconds))))
+
+
+def _bucket_arguments(element, compiler, **kw):
+    column, seconds = element.clauses.clauses
+    return compiler.process(column, **kw), compiler.process(seconds, **kw)
+
+
+@compiles(time_bucket)
+def _time_bucket_default(element, compiler, **kw):
+    column, seconds = _bucket_arguments(element, compiler, **kw)
+    return f"CAST(FLOOR(EXTRACT(EPOCH FROM {column}) / {seconds}) AS BIGINT) * {seconds}"
+
+
+@compiles(time_bucket, 'sqlite')
+def _time_bucket_sqlite(element, compiler, **kw):
+    column, seconds = _bucket_arguments(element, compiler, **kw)
+    # Integer division on the epoch - stays in SQLite's integer arithmetic
+    return f"(CAST(strftime('%s', {column}) AS INTEGER) / {seconds}) * {seconds}"
+
+
+def epoch_bucket(value: datetime, seconds: int) -> int:
+    """Python counterpart of time_bucket for a naive timestamp"""
+    epoch = int((value - EPOCH).total_seconds())
+    return epoch - epoch % seconds
+
+
+def bucket_start(epoch_seconds) -> datetime:
+    """Naive datetime for a bucket value returned by time_bucket"""
+    return EPOCH + timedelta(seconds=int(epoch_seconds))
@@ -8,6 +8,12 @@ def get_paris_time():
     """Get current time in Paris timezone as naive datetime"""
     return datetime.now(PARIS_TZ).replace(tzinfo=None)
 
+def paris_to_utc(dt):
+    """Timezone-aware UTC datetime for a naive Paris time"""
+    if dt is None:
+        return None
+    return PARIS_TZ.localize(dt).astimezone(pytz.utc)
+
 def format_paris_time(dt, format_str='%H:%M:%S'):
     """Format datetime assuming it's already in Paris timezone"""
     if dt is None:
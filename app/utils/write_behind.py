@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict
+from sqlalchemy import event
+from app import db
+from app.queue_manager import LatencyHistogram
+from app.utils.leader import leader, NotLeader
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Batches the commits of a queued job into a single transaction.
+
+    Inside a unit (the queue worker opens one per task) `commit()` only
+    flushes: the job's inserts and updates reach the database but stay in one
+    transaction, committed when the task ends. On SQLite every commit is an
+    fsync, so a job that used to commit after each step now pays for one.
+
+    For long jobs on the live path a flush interval bounds how long writes may
+    stay uncommitted: a `commit()` requested once the interval has elapsed
+    since the last real commit goes through immediately.
+
+    Work that must become visible to other processes only after the data is
+    committed (e.g. bumping the scrape generation) is registered with
+    `after_commit()`.
+
+    A rollback inside a unit discards the writes flushed so far, so the
+    callbacks registered for them are dropped with them. Jobs should let
+    their errors propagate rather than roll the shared session back.
+
+    Every commit made inside a unit first checks that this process still holds
+    the leader lock, so a task still running when leadership moved is rolled
+    back instead of racing the new leader's writer.
+    """
+
+    def __init__(self, flush_interval: float = None):
+        self.flush_interval = flush_interval if flush_interval is not None else \
+            float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 10))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # Metrics
+        self.commits = 0
+        self.deferred = 0  # commit() calls folded into a later commit
+        self.rollbacks = 0
+        self.recent_commits = deque()  # Monotonic times of commits in the last minute
+        self.commit_latency = LatencyHistogram()  # Commit duration, dominated by the fsync
+
+    # ------------------------------------------------------------------
+    # Units
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def unit(self):
+        """Collect the commits of everything run inside into one transaction"""
+        if getattr(self.local, 'unit', None) is not None:
+            # Nested units join the outer one
+            yield
+            return
+
+        state = {'pending': False, 'committed_at': time.monotonic(), 'callbacks': []}
+        self.local.unit = state
+        try:
+            yield
+        except Exception:
+            self.local.unit = None
+            db.session.rollback()
+            with self.lock:
+                self.rollbacks += 1
+            raise
+        else:
+            if state['pending']:
+                self._commit(state)
+            else:
+                self._run_callbacks(state)
+        finally:
+            self.local.unit = None
+
+    def active(self) -> bool:
+        return getattr(self.local, 'unit', None) is not None
+
+    def commit(self):
+        """Commit now outside a unit, otherwise at the end of the unit or once the flush interval elapsed"""
+        state = getattr(self.local, 'unit', None)
+        if state is None:
+            self._commit(None)
+            return
+
+        state['pending'] = True
+        if self.flush_interval and time.monotonic() - state['committed_at'] >= self.flush_interval:
+            self._commit(state)
+            return
+
+        db.session.flush()
+        with self.lock:
+            self.deferred += 1
+
+    def after_commit(self, callback: Callable):
+        """Run callback once the current writes are committed"""
+        state = getattr(self.local, 'unit', None)
+        if state is None:
+            callback()
+        else:
+            state['callbacks'].append(callback)
+
+    def _commit(self, state):
+        started = time.perf_counter()
+        db.session.commit()
+        elapsed = time.perf_counter() - started
+
+        now = time.monotonic()
+        with self.lock:
+            self.commits += 1
+            self.commit_latency.record(elapsed)
+            self.recent_commits.append(now)
+            self._prune(now)
+
+        if state is not None:
+            state['pending'] = False
+            state['committed_at'] = now
+            self._run_callbacks(state)
+
+    @staticmethod
+    def _run_callbacks(state):
+        callbacks, state['callbacks'] = state['callbacks'], []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"After-commit callback failed: {e}")
+
+    def _rolled_back(self, state):
+        """The unit's uncommitted writes are gone - so is the work waiting on them"""
+        if state['pending'] or state['callbacks']:
+            logger.warning(f"Rollback inside a unit discarded its writes and "
+                           f"{len(state['callbacks'])} after-commit callbacks")
+        state['pending'] = False
+        state['callbacks'] = []
+        with self.lock:
+            self.rollbacks += 1
+
+    def _prune(self, now: float):
+        while self.recent_commits and now - self.recent_commits[0] > 60:
+            self.recent_commits.popleft()
+
+    # ------------------------------------------------------------------
+    # Metrics
+    # ------------------------------------------------------------------
+
+    def stats(self) -> Dict:
+        with self.lock:
+            self._prune(time.monotonic())
+            return {
+                'flush_interval': self.flush_interval,
+                'commits': self.commits,
+                'commits_last_minute': len(self.recent_commits),
+                'deferred_commits': self.deferred,
+                'rollbacks': self.rollbacks,
+                'commit_seconds': self.commit_latency.to_dict()
+            }
+
+
+# Global write-behind buffer
+write_behind = WriteBehind()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_rolled_back(session, previous_transaction):
+    # Savepoints only undo their own part, and only the outermost rollback counts
+    if previous_transaction.nested or previous_transaction.parent is not None:
+        return
+    state = getattr(write_behind.local, 'unit', None)
+    if state is not None:
+        write_behind._rolled_back(state)
+
+
+@event.listens_for(db.session, 'before_commit')
+def _check_leadership(session):
+    # Also covers plain session commits made by queued tasks
+    if write_behind.active() and not leader.holds_lock():
+        raise NotLeader("Leader lock lost, refusing to commit the queued task")
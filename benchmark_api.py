@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmark API read latency while the database is being written.
+
+A writer thread repeatedly holds a scrape-sized write transaction open while
+reader threads call the dashboard endpoints. The run is repeated for:
+  - delete:   rollback journal, one shared engine (previous setup)
+  - wal:      WAL journal, one shared engine
+  - wal+read: WAL journal, GET requests on the read-only engine
+
+Usage:
+    python benchmark_api.py --db instance/velib_tracker.db --seconds 10
+"""
+import sys
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ['/api/stations', '/api/statistics/overview', '/api/bikes?per_page=50', '/api/trips/live']
+MODES = [('delete', 'DELETE', '0'), ('wal', 'WAL', '0'), ('wal+read', 'WAL', '1')]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run_mode(db_path, journal_mode, read_engine, seconds, readers, hold):
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+    os.environ['API_READ_ENGINE'] = read_engine
+
+    from app import database
+    database.SQLITE_PRAGMAS['journal_mode'] = journal_mode
+
+    from app import create_app, db
+    from sqlalchemy import text
+    app = create_app()
+
+    stop = threading.Event()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def writer():
+        # Touch every bike and station inside one long transaction, like a scrape does
+        with app.app_context():
+            while not stop.is_set():
+                db.session.execute(text("UPDATE bikes SET last_seen_at = last_seen_at"))
+                db.session.execute(text("UPDATE stations SET updated_at = updated_at"))
+                time.sleep(hold)
+                db.session.commit()
+                time.sleep(0.05)
+
+    def reader(index):
+        client = app.test_client()
+        position = index
+        while not stop.is_set():
+            endpoint = ENDPOINTS[position % len(ENDPOINTS)]
+            position += 1
+            started = time.perf_counter()
+            response = client.get(endpoint)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=writer, daemon=True)]
+    threads += [threading.Thread(target=reader, args=(i,), daemon=True) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=hold + 15)
+
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+        read = app.extensions.get('read_engine')
+        if read is not None:
+            read.dispose()
+
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', required=True, help='SQLite database to benchmark (a copy is used)')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of each run')
+    parser.add_argument('--readers', type=int, default=4, help='Concurrent API reader threads')
+    parser.add_argument('--hold', type=float, default=0.5, help='Seconds each write transaction stays open')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    print(f"{'mode':<10} {'requests':>9} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+
+    for name, journal_mode, read_engine in MODES:
+        db_path = os.path.join(workdir, f"{name.replace('+', '_')}.db")
+        shutil.copy(args.db, db_path)
+        latencies, errors = run_mode(db_path, journal_mode, read_engine, args.seconds, args.readers, args.hold)
+        p50, p95 = percentile(latencies, 50), percentile(latencies, 95)
+        print(f"{name:<10} {len(latencies):>9} {errors:>7} "
+              f"{(p50 or 0) * 1000:>9.1f} {(p95 or 0) * 1000:>9.1f} {max(latencies or [0]) * 1000:>9.1f}")
+
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
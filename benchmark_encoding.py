@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark payload size and serialization time of the list endpoints.
+
+Each endpoint is requested in every representation (json, columnar, msgpack
+when installed) and every content coding (identity, gzip, br when installed).
+The response cache is bypassed so every request builds its body.
+
+Usage:
+    python benchmark_encoding.py --db instance/velib_tracker.db --runs 20
+"""
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ['/api/stations', '/api/bikes?per_page=1000', '/api/trips?per_page=500']
+
+
+def median(values):
+    ordered = sorted(values)
+    return ordered[len(ordered) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', required=True, help='SQLite database to read')
+    parser.add_argument('--runs', type=int, default=20, help='Requests per combination')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.abspath(args.db)}'
+    os.environ['RESPONSE_CACHE_TTL'] = '0'
+
+    from app import create_app
+    from app.utils import encoding
+    app = create_app()
+    client = app.test_client()
+
+    formats = [('json', encoding.JSON), ('columnar', encoding.COLUMNAR)]
+    if encoding.msgpack is not None:
+        formats.append(('msgpack', encoding.MSGPACK))
+    else:
+        print("msgpack not installed - skipping the binary format")
+    codings = ['identity', 'gzip'] + (['br'] if encoding.brotli is not None else [])
+
+    print(f"{'endpoint':<28} {'format':<9} {'coding':<9} {'bytes':>10} {'ratio':>7} {'median ms':>10}")
+    for endpoint in ENDPOINTS:
+        baseline = None
+        for format_name, mimetype in formats:
+            for coding in codings:
+                headers = {'Accept': mimetype, 'Accept-Encoding': coding}
+                timings = []
+                size = 0
+                for _ in range(args.runs):
+                    started = time.perf_counter()
+                    response = client.get(endpoint, headers=headers)
+                    timings.append(time.perf_counter() - started)
+                    size = len(response.get_data())
+                if baseline is None:
+                    baseline = size
+                print(f"{endpoint:<28} {format_name:<9} {coding:<9} {size:>10} "
+                      f"{size / baseline if baseline else 0:>7.2f} {median(timings) * 1000:>10.1f}")
+        print()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
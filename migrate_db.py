@@ -7,6 +7,8 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import create_app, db
+from app.models import Bike, MalfunctionLog, Trip
+from app.utils.rollups import trip_rollups
 from sqlalchemy import text
 from datetime import datetime
 
@@ -49,6 +51,40 @@ def migrate_database():
             else:
                 print('✗ arrived_at_station column not found')
         
+        # Flag for trips reconstructed across a scrape gap
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(text('ALTER TABLE trips ADD COLUMN low_confidence BOOLEAN DEFAULT 0'))
+                conn.commit()
+            print('✓ Successfully added low_confidence column')
+        except Exception as e:
+            print(f'! low_confidence column: {e}')
+
+        # Indexes for the hot filters (bike status sweep, detector rules, boomerang stats)
+        for table in (Bike.__table__, MalfunctionLog.__table__, Trip.__table__):
+            for index in table.indexes:
+                try:
+                    index.create(db.engine, checkfirst=True)
+                    print(f'✓ Index {index.name} present')
+                except Exception as e:
+                    print(f'! Index {index.name}: {e}')
+
+        # Refresh planner statistics for the new indexes
+        try:
+            with db.engine.connect() as conn:
+                conn.execute(text('ANALYZE'))
+                conn.commit()
+            print('✓ Planner statistics updated')
+        except Exception as e:
+            print(f'! ANALYZE: {e}')
+
+        # Fill the statistics rollups from the trips recorded so far. The insert listener may
+        # already have written rows for recent trips, so check the rebuild marker, not emptiness
+        if not trip_rollups.is_backfilled():
+            rows = trip_rollups.rebuild()
+            db.session.commit()
+            print(f'✓ Built statistics rollups ({rows} rows)')
+        
         # Commit changes
         db.session.commit()
         print("Database migration completed!")
@@ -1,6 +1,7 @@
 // Initialize map
 let map;
 let stationMarkers = new L.LayerGroup();
+let clusterMarkers = new L.LayerGroup();
 let bikeMarkers = new L.LayerGroup();
 let tripPaths = new L.LayerGroup();
 let selectedItem = null;
@@ -32,6 +33,7 @@ function initMap() {
     
     // Add layer groups
     stationMarkers.addTo(map);
+    clusterMarkers.addTo(map);
     bikeMarkers.addTo(map);
     tripPaths.addTo(map);
     
@@ -39,46 +41,196 @@ function initMap() {
     loadStations();
     loadLiveStats();
     
-    // Set up refresh intervals
-    setInterval(loadStations, 60000); // Refresh every minute
-    setInterval(loadLiveStats, 30000); // Refresh stats every 30 seconds
+    // Zoomed out, the viewport shows server-side clusters instead of every station
+    map.on('moveend', updateClusterView);
+    
+    // Updates are pushed after each scrape; poll only while the stream is down
+    connectLiveStream();
+    setInterval(() => { if (!liveStreamOpen) loadStations(); }, 60000); // Refresh every minute
+    setInterval(() => { if (!liveStreamOpen) loadLiveStats(); }, 30000); // Refresh stats every 30 seconds
+}
+
+// Server-Sent Events from /api/live
+let liveStreamOpen = false;
+
+function connectLiveStream() {
+    if (!window.EventSource) return;
+    
+    const source = new EventSource('/api/live');
+    
+    source.onopen = () => { liveStreamOpen = true; };
+    source.onerror = () => { liveStreamOpen = false; }; // EventSource reconnects by itself
+    
+    // Sent on every (re)connect - catch up on scrapes missed while disconnected
+    source.addEventListener('hello', event => {
+        const data = JSON.parse(event.data);
+        if (stationGeneration !== null && data.generation !== stationGeneration) {
+            loadStations();
+            loadLiveStats();
+        }
+    });
+    
+    source.addEventListener('stations', event => {
+        const data = JSON.parse(event.data);
+        if (data.delta && data.since === stationGeneration) {
+            applyStations(data);
+        } else if (data.generation !== stationGeneration) {
+            loadStations();
+        }
+    });
+    
+    source.addEventListener('overview', event => {
+        renderLiveStats(JSON.parse(event.data));
+        loadInTransitBikes();
+    });
+    
+    // Our buffer overflowed on the server - reload everything
+    source.addEventListener('resync', () => {
+        loadStations();
+        loadLiveStats();
+    });
 }
 
-// Load stations
+// Stations shown on the map, kept in step with /api/stations?since=<generation>
+let stationGeneration = null;
+const stationsByCode = new Map();
+const stationMarkerByCode = new Map();
+
+// Load stations - only the ones changed since the last load once the map has them all
 async function loadStations() {
     try {
-        const response = await fetch('/api/stations');
+        const url = stationGeneration === null ? '/api/stations' : `/api/stations?since=${stationGeneration}`;
+        const response = await fetch(url);
+        applyStations(await response.json());
+    } catch (error) {
+        console.error('Error loading stations:', error);
+    }
+}
+
+// Apply a full station list or a delta to the markers
+function applyStations(data) {
+    if (!data.delta) {
+        // Full list - first load, or too far behind for a delta
+        stationsByCode.clear();
+        stationMarkerByCode.clear();
+        stationMarkers.clearLayers();
+    }
+    
+    (data.removed || []).forEach(code => {
+        stationsByCode.delete(code);
+        removeStationMarker(code);
+    });
+    
+    data.stations.forEach(station => {
+        stationsByCode.set(station.code, station);
+        removeStationMarker(station.code);
+        addStationMarker(station);
+    });
+    
+    stationGeneration = data.generation;
+    updateClusterView();
+}
+
+// Station clusters from /api/stations/clusters for the visible viewport
+let clusterMaxZoom = null;
+
+async function updateClusterView() {
+    const zoom = map.getZoom();
+    if (clusterMaxZoom !== null && zoom >= clusterMaxZoom) {
+        showStationMarkers(true);
+        return;
+    }
+    
+    try {
+        const bounds = map.getBounds();
+        const bbox = [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()].join(',');
+        const response = await fetch(`/api/stations/clusters?zoom=${zoom}&bbox=${bbox}`);
         const data = await response.json();
         
-        stationMarkers.clearLayers();
+        clusterMaxZoom = data.max_zoom;
+        if (map.getZoom() !== data.zoom) return; // Zoomed again while loading
         
-        data.stations.forEach(station => {
-            const fillRate = (station.nb_bike + station.nb_ebike) / station.total_capacity;
-            let markerClass = 'station-marker';
-            
-            if (fillRate === 0) markerClass += ' empty';
-            else if (fillRate === 1) markerClass += ' full';
-            else if (fillRate < 0.2) markerClass += ' low';
-            
-            const icon = L.divIcon({
-                className: markerClass,
-                html: `<span>${station.nb_bike + station.nb_ebike}</span>`,
-                iconSize: [30, 30],
-                iconAnchor: [15, 15],
-                popupAnchor: [0, -15]
-            });
-            
-            const marker = L.marker([station.latitude, station.longitude], { icon })
-                .bindPopup(createStationPopup(station))
-                .on('click', () => selectStation(station));
-            
-            // Apply filters
-            if (shouldShowStation(station)) {
-                marker.addTo(stationMarkers);
-            }
-        });
+        showStationMarkers(!data.clustered);
+        if (data.clustered) {
+            clusterMarkers.clearLayers();
+            data.clusters.forEach(addClusterMarker);
+        }
     } catch (error) {
-        console.error('Error loading stations:', error);
+        console.error('Error loading station clusters:', error);
+    }
+}
+
+function showStationMarkers(visible) {
+    if (visible) {
+        clusterMarkers.clearLayers();
+        if (!map.hasLayer(stationMarkers)) stationMarkers.addTo(map);
+    } else if (map.hasLayer(stationMarkers)) {
+        map.removeLayer(stationMarkers);
+    }
+}
+
+function addClusterMarker(cluster) {
+    const total = cluster.bikes + cluster.ebikes;
+    let markerClass = 'station-marker cluster';
+    
+    if (cluster.fill_ratio === 0) markerClass += ' empty';
+    else if (cluster.fill_ratio !== null && cluster.fill_ratio < 0.2) markerClass += ' low';
+    
+    // Grow with the number of stations, within reason
+    const size = Math.min(60, 30 + Math.round(Math.sqrt(cluster.count) * 3));
+    const icon = L.divIcon({
+        className: markerClass,
+        html: `<span>${total}</span>`,
+        iconSize: [size, size],
+        iconAnchor: [size / 2, size / 2]
+    });
+    
+    L.marker([cluster.lat, cluster.lon], { icon })
+        .bindTooltip(`${cluster.count} station${cluster.count > 1 ? 's' : ''} - ${cluster.bikes} mechanical, ${cluster.ebikes} electric`)
+        .on('click', () => map.setView([cluster.lat, cluster.lon], Math.min(map.getZoom() + 2, clusterMaxZoom)))
+        .addTo(clusterMarkers);
+}
+
+// Redraw the known stations, e.g. after a filter change
+function renderStations() {
+    stationMarkers.clearLayers();
+    stationMarkerByCode.clear();
+    stationsByCode.forEach(station => addStationMarker(station));
+}
+
+function addStationMarker(station) {
+    const fillRate = (station.nb_bike + station.nb_ebike) / station.total_capacity;
+    let markerClass = 'station-marker';
+    
+    if (fillRate === 0) markerClass += ' empty';
+    else if (fillRate === 1) markerClass += ' full';
+    else if (fillRate < 0.2) markerClass += ' low';
+    
+    const icon = L.divIcon({
+        className: markerClass,
+        html: `<span>${station.nb_bike + station.nb_ebike}</span>`,
+        iconSize: [30, 30],
+        iconAnchor: [15, 15],
+        popupAnchor: [0, -15]
+    });
+    
+    const marker = L.marker([station.latitude, station.longitude], { icon })
+        .bindPopup(createStationPopup(station))
+        .on('click', () => selectStation(station));
+    
+    stationMarkerByCode.set(station.code, marker);
+    
+    // Apply filters
+    if (shouldShowStation(station)) {
+        marker.addTo(stationMarkers);
+    }
+}
+
+function removeStationMarker(code) {
+    const marker = stationMarkerByCode.get(code);
+    if (marker) {
+        stationMarkers.removeLayer(marker);
+        stationMarkerByCode.delete(code);
     }
 }
 
@@ -166,24 +318,26 @@ function createBikePopup(trip) {
 async function loadLiveStats() {
     try {
         const response = await fetch('/api/statistics/overview');
-        const data = await response.json();
-        
-        const statsHtml = `
-            <p><strong>Total Bikes:</strong> ${data.total_bikes}</p>
-            <p><strong>Available:</strong> ${data.bike_status.disponible || 0}</p>
-            <p><strong>In Transit:</strong> ${data.bike_status.in_transit || 0}</p>
-            <p><strong>Missing:</strong> ${data.bike_status.missing || 0}</p>
-            <p><strong>Malfunctions:</strong> ${data.active_malfunctions}</p>
-            <p><strong>Trips Today:</strong> ${data.trips_today}</p>
-            <p><strong>Last Hour:</strong> ${data.trips_last_hour}</p>
-        `;
-        
-        document.getElementById('liveStats').innerHTML = statsHtml;
+        renderLiveStats(await response.json());
     } catch (error) {
         console.error('Error loading statistics:', error);
     }
 }
 
+function renderLiveStats(data) {
+    const statsHtml = `
+        <p><strong>Total Bikes:</strong> ${data.total_bikes}</p>
+        <p><strong>Available:</strong> ${data.bike_status.disponible || 0}</p>
+        <p><strong>In Transit:</strong> ${data.bike_status.in_transit || 0}</p>
+        <p><strong>Missing:</strong> ${data.bike_status.missing || 0}</p>
+        <p><strong>Malfunctions:</strong> ${data.active_malfunctions}</p>
+        <p><strong>Trips Today:</strong> ${data.trips_today}</p>
+        <p><strong>Last Hour:</strong> ${data.trips_last_hour}</p>
+    `;
+    
+    document.getElementById('liveStats').innerHTML = statsHtml;
+}
+
 // Filter functions
 function shouldShowStation(station) {
     const showEmpty = document.getElementById('showEmptyStations').checked;
@@ -255,9 +409,9 @@ document.addEventListener('DOMContentLoaded', () => {
     initMap();
     
     // Filter change listeners
-    document.getElementById('showStations').addEventListener('change', loadStations);
-    document.getElementById('showEmptyStations').addEventListener('change', loadStations);
-    document.getElementById('showFullStations').addEventListener('change', loadStations);
+    document.getElementById('showStations').addEventListener('change', renderStations);
+    document.getElementById('showEmptyStations').addEventListener('change', renderStations);
+    document.getElementById('showFullStations').addEventListener('change', renderStations);
     document.getElementById('showInTransit').addEventListener('change', loadInTransitBikes);
     document.getElementById('showMalfunctions').addEventListener('change', loadMalfunctioningBikes);
 });
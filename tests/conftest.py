@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+# Configured before the app is imported - the models and stores read these at import
+_workdir = tempfile.mkdtemp(prefix='velib-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_workdir, 'test.db')}"
+os.environ['API_READ_ENGINE'] = '0'
+os.environ['RESPONSE_CACHE_TTL'] = '0'
+os.environ['SCRAPE_GENERATION_PATH'] = os.path.join(_workdir, 'scrape_generation.json')
+os.environ['BIKE_STATS_PATH'] = os.path.join(_workdir, 'bike_stats.bin')
+os.environ['LEADER_LOCK_PATH'] = os.path.join(_workdir, 'scheduler.lock')
+
+from app import create_app, db  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        seed(datetime.utcnow())
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+
+def seed(now: datetime):
+    """A few stations, bikes, trips and malfunctions, so every code path has rows to read"""
+    from app.models import Station, Bike, Trip, MalfunctionLog
+
+    stations = [Station(code=str(1000 + i), name=f"Station {i}", latitude=48.85 + i * 0.003,
+                        longitude=2.35 + i * 0.002, total_capacity=20, nb_bike=3)
+                for i in range(6)]
+    db.session.add_all(stations)
+    db.session.flush()
+
+    statuses = ['disponible', 'disponible', 'indisponible', 'in_transit', 'missing']
+    bikes = []
+    for i in range(20):
+        status = statuses[i % len(statuses)]
+        docked = status in ('disponible', 'indisponible')
+        bikes.append(Bike(bike_name=f"B{i:04d}", bike_electric=bool(i % 2), current_status=status,
+                          current_station_id=stations[i % len(stations)].id if docked else None,
+                          previous_station_id=stations[(i + 1) % len(stations)].id,
+                          left_station_at=now - timedelta(hours=i),
+                          last_seen_at=now - timedelta(hours=i), arrived_at_station=now - timedelta(hours=i),
+                          malfunction_score=float(i % 4)))
+    db.session.add_all(bikes)
+    db.session.flush()
+
+    for i in range(40):
+        start = stations[i % len(stations)]
+        end = stations[(i * 7) % len(stations)]
+        trip = Trip(bike_id=bikes[i % len(bikes)].id, start_station_id=start.id, end_station_id=end.id,
+                    start_station=start, end_station=end,
+                    start_time=now - timedelta(hours=i, minutes=20), end_time=now - timedelta(hours=i))
+        trip.calculate_metrics()
+        db.session.add(trip)
+
+    for i, bike in enumerate(bikes[:8]):
+        db.session.add(MalfunctionLog(bike_id=bike.id, malfunction_type=['boomerang', 'low_speed'][i % 2],
+                                      severity=1 + i % 5, is_active=i % 3 != 0,
+                                      detected_at=now - timedelta(hours=i)))
+    db.session.commit()
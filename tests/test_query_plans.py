@@ -0,0 +1,123 @@
+"""
+Query plan regression tests for the hot paths.
+
+Each test runs the real code of an endpoint or background job against the
+seeded SQLite database, captures every SELECT it sends and checks the
+EXPLAIN QUERY PLAN of each: a large table may be read through an index or a
+covering index, never scanned whole. The schema has no ANALYZE statistics
+here, so SQLite plans on its default heuristics like on a fresh install.
+"""
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List, Tuple
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import db
+
+# Tables that grow with the fleet or with time - never scan them whole
+LARGE_TABLES = ('bikes', 'trips', 'malfunction_logs', 'bike_snapshots', 'station_states', 'bike_movements')
+
+SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?(.*)$')
+
+HOT_ENDPOINTS = [
+    '/api/trips/live',
+    '/api/statistics/overview',
+    '/api/statistics/system-health',
+    '/api/statistics/malfunction-summary',
+    '/api/bikes/malfunctioning',
+    '/api/bikes/malfunctioning?type=boomerang&per_page=5',
+    '/api/stations/1000',
+]
+
+
+def _mark_unseen_bikes():
+    from app.scrapers.velib_scraper import VelibScraper
+    VelibScraper()._mark_unseen_bikes(datetime.utcnow(), [])
+
+
+def _detect_malfunctions():
+    from app.utils.malfunction_detector import MalfunctionDetector
+    detector = MalfunctionDetector()
+    detector.detect_all_malfunctions()
+    detector.resolve_recovered_bikes()
+
+
+def _fix_stuck_in_transit():
+    from app.utils.data_recovery import DataRecovery
+    DataRecovery().fix_stuck_in_transit_bikes()
+
+
+HOT_JOBS = [
+    ('scrape sweep', _mark_unseen_bikes),
+    ('malfunction detection', _detect_malfunctions),
+    ('stuck in transit recovery', _fix_stuck_in_transit),
+]
+
+
+def is_large(table_name: str) -> bool:
+    # Partitions (<table>_pYYYYMMDD) and ORM aliases (<table>_1) count as their table
+    base = re.sub(r'(_p\d{8}|_\d+)$', '', table_name)
+    return base in LARGE_TABLES
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    """Plan rows that read a large table without an index"""
+    scans = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match and is_large(match.group(1)) and 'COVERING INDEX' not in match.group(2):
+            scans.append(detail)
+    return scans
+
+
+@contextmanager
+def captured_selects():
+    """Collect (statement, parameters) of every SELECT sent while inside"""
+    captured: List[Tuple[str, object]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    event.listen(Engine, 'before_cursor_execute', capture)
+    try:
+        yield captured
+    finally:
+        event.remove(Engine, 'before_cursor_execute', capture)
+
+
+def scans_of(captured) -> List[str]:
+    """Full table scans in the plans of the captured statements, with the statement"""
+    raw = db.session.connection().connection.driver_connection
+    found = []
+    for statement, parameters in captured:
+        plan = [row[3] for row in raw.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)]
+        found += [f"{scan}\n    in: {' '.join(statement.split())}" for scan in full_scans(plan)]
+    return found
+
+
+@pytest.mark.parametrize('url', HOT_ENDPOINTS)
+def test_endpoint_uses_indexes(app, client, url):
+    with captured_selects() as captured:
+        response = client.get(url)
+    assert response.status_code == 200
+
+    with app.app_context():
+        assert captured, f"{url} sent no queries"
+        assert scans_of(captured) == []
+
+
+@pytest.mark.parametrize('name, job', HOT_JOBS, ids=[name for name, _ in HOT_JOBS])
+def test_job_uses_indexes(app, name, job):
+    with app.app_context():
+        with captured_selects() as captured:
+            job()
+        try:
+            assert captured, f"{name} sent no queries"
+            assert scans_of(captured) == []
+        finally:
+            db.session.rollback()